@@ -15,9 +15,6 @@ REDIS_PORT = 6379
 REDIS_DB = 0
 REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
 
-INDEX_LOCK_KEY = "full_scan_lock"
-LOCK_EXPIRATION = 3600  # 1 hour (seconds)
-
 SESSION_LIFETIME_MINUTES = 60
 
 # === Logging ===
@@ -70,6 +67,19 @@ def make_celery(flask_app: Flask) -> Celery:
     celery.conf.update(
         task_track_started=True,
         result_expires=3600,
+        # Drive scans and content hashing get their own queue/worker so several
+        # drives can be scanned in parallel without starving merges and
+        # single-file indexing
+        task_routes={
+            "celery_worker.index_drive_path": {"queue": "indexing"},
+            "celery_worker.hash_file_contents": {"queue": "indexing"},
+            "celery_worker.rebase_remounted_drives": {"queue": "indexing"},
+            # Thumbnail pre-rendering is best effort and must never delay merges
+            "celery_worker.pregenerate_thumbnails": {"queue": "thumbs"},
+            "celery_worker.enrich_media": {"queue": "thumbs"},
+        },
+        # Long scans are acked late; don't let one worker hoard queued scans
+        worker_prefetch_multiplier=1,
     )
 
     class ContextTask(celery.Task):
@@ -93,11 +103,20 @@ def refresh_session():
 
 
 @app.after_request
-def disable_caching(response):
-    """Ensure browsers do not cache responses."""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = "0"
-    response.headers["Pragma"] = "no-cache"
+def default_cache_policy(response):
+    """
+    Authenticated HTML pages are never stored by browsers. Other responses
+    keep the policy their route chose (media: validators / immutable
+    versioned URLs, static: revalidation) or must be revalidated.
+    """
+    if "Cache-Control" in response.headers:
+        return response
+    if response.mimetype == "text/html":
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Expires"] = "0"
+        response.headers["Pragma"] = "no-cache"
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
     return response
 
 
@@ -3,9 +3,20 @@
 import os
 import shutil
 import logging
-from storage_utils import is_hidden_folder, PHOTO_EXTENSIONS, VIDEO_EXTENSIONS
 from helpers import get_file_index_db
-from app import celery, redis_client, INDEX_LOCK_KEY
+from indexer import (
+    normalize_root, subtree_bounds, folder_parent, relative_path, is_media_ext, created_time_from_stat,
+    BatchWriter, sync_directory, sync_root_folder, stage_directory, reset_staging, swap_in_staging,
+    FolderStatsDelta,
+)
+from drive_registry import register_drive, drive_for_path, remounted_drives, attach_drive
+from hashing import hash_pending, HASH_LOCK_KEY, HASH_RERUN_KEY, HASH_LOCK_SECONDS
+from media_render import pregenerate_gallery_thumbnails, gallery_media, GALLERY_EXTENSIONS
+from enrichment import enrich_pending, ENRICH_LOCK_KEY, ENRICH_RERUN_KEY, ENRICH_LOCK_SECONDS
+from scanner import ScandirWalker
+from scan_state import ScanCheckpoint, ScanProgress
+from app import celery, redis_client
+from locks import DriveLock, LockLostError
 import sqlite3
 from config import UPLOAD_TMP
 
@@ -26,37 +37,55 @@ def index_single_file(file_path):
     db = get_file_index_db()
     file_path = os.path.normpath(file_path)
     parent_path = os.path.dirname(file_path)
+    drive = drive_for_path(db, file_path)
+
+    def identity(path):
+        return (drive.uuid, relative_path(drive.root, path)) if drive else (None, None)
 
     try:
+        stats = FolderStatsDelta(db)
+        stats.snapshot([parent_path, file_path])
+
         # --- 1. Index the Parent Folder ---
-        db.execute(
+        cur = db.execute(
             """
-            INSERT OR IGNORE INTO file_index (name, path, parent_path, is_folder, type, modified_time)
-            VALUES (?, ?, ?, 1, 'folder', ?)
+            INSERT OR IGNORE INTO file_index
+            (name, path, parent_path, is_folder, is_media, size, type, modified_time, drive_uuid, rel_path)
+            VALUES (?, ?, ?, 1, 0, 0, 'folder', ?, ?, ?)
             """,
-            (os.path.basename(parent_path), 
+            (os.path.basename(parent_path) or parent_path,
              parent_path, 
-             os.path.dirname(parent_path), 
-             os.path.getmtime(parent_path))
+             folder_parent(parent_path), 
+             os.path.getmtime(parent_path),
+             *identity(parent_path))
         )
+        if cur.rowcount:
+            stats.add_folder(parent_path, folder_parent(parent_path))
 
         # --- 2. Index the File Itself ---
         stat = os.stat(file_path)
         filename = os.path.basename(file_path)
         file_type_ext = os.path.splitext(filename)[1].lower() 
-        is_media = 1 if file_type_ext in PHOTO_EXTENSIONS or file_type_ext in VIDEO_EXTENSIONS else 0
         
+        stats.remove(file_path)
+        stats.add_file(parent_path, is_media_ext(file_type_ext), stat.st_size, stat.st_mtime)
         db.execute(
             """
             INSERT OR REPLACE INTO file_index 
-            (name, path, parent_path, is_folder, is_media, size, modified_time, created_time, type)
-            VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?)
+            (name, path, parent_path, is_folder, is_media, size, modified_time, created_time, type, drive_uuid, rel_path,
+             sort_time)
+            VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            (filename, file_path, parent_path, is_media, stat.st_size, stat.st_mtime, stat.st_birthtime, file_type_ext)
+            (filename, file_path, parent_path, is_media_ext(file_type_ext), stat.st_size, stat.st_mtime,
+             created_time_from_stat(stat), file_type_ext, *identity(file_path), created_time_from_stat(stat))
         )
+        stats.apply()
 
         db.commit()
         logger.info(f"[INDEX SUCCESS] Indexed single file and parent: {file_path}")
+        _queue_hashing()
+        _queue_enrichment()
+        _queue_thumbnails(paths=[file_path])
         
         return {'status': 'success'}
 
@@ -69,158 +98,333 @@ def index_single_file(file_path):
         db.rollback()
         return {'status': 'failure', 'error': f"Database error: {e}"}
 
-@celery.task
-def index_drive_path(root_path):
+@celery.task(acks_late=True, reject_on_worker_lost=True)
+def index_drive_path(root_path, concurrency=None, mode="auto", lock_token=None):
     """
-    Scans a directory (root_path) and indexes all files and sub-folders,
-    clearing existing entries first.
-    Releases Redis lock at the end.
+    Indexes a directory (root_path) and all sub-folders.
+
+    - "incremental": folder mtimes and file (size, mtime) are compared against
+      file_index and only rows that were added, changed or removed on disk are
+      written, so the existing index stays browsable for the whole scan.
+    - "full": every row is bulk-loaded into file_index_staging and swapped in
+      for the drive's rows in one transaction at the end, so readers see the
+      old index until the new one is complete.
+    - "auto" (default): "full" for a drive that has never been indexed,
+      "incremental" otherwise.
+
+    Folders are listed by a scandir thread pool (`concurrency` threads,
+    defaults to SCAN_CONCURRENCY); rows are written with executemany() in
+    batches of INDEX_BATCH_SIZE.
+
+    Progress is checkpointed with every batch. The task is acked late, so if
+    the worker dies the broker re-delivers it and the scan resumes from the
+    last checkpoint instead of starting over. Live progress is published to
+    Redis for /api/indexing.
+
+    Rows are tagged with the drive's filesystem UUID; a drive that was
+    indexed under another mountpoint is rebased first (see drive_registry.py),
+    so a remount turns into a cheap incremental pass instead of a full rescan.
+
+    The drive's lease (taken by the web request, `lock_token`) is renewed
+    while the scan runs and every batch commit is fenced by its token, so
+    scans of different drives run in parallel, scans of nested roots on one
+    drive take turns, and a scan that lost its lease cannot overwrite a newer
+    one (on any root of the drive).
+    Releases the drive lock at the end.
     """
-    try:
-        # Normalize the root path
-        root_path = os.path.normpath(root_path)
-
-        # Fix drive roots: "D:" → "D:\"
-        drive, tail = os.path.splitdrive(root_path)
-        if drive and not tail:
-            root_path = drive + os.path.sep
+    root_path = normalize_root(root_path)
+    lock = DriveLock(redis_client, root_path, token=lock_token) if redis_client else None
 
+    try:
         db = get_file_index_db()
-        insert_count = 0
+        checkpoint = ScanCheckpoint(db, root_path)
+        progress = None
+        scanned = 0
 
         try:
-            # Clear existing index entries for this drive
-            logger.info(f"Clearing old index entries for {root_path}")
-            db.execute("DELETE FROM file_index WHERE path LIKE ?", (root_path + '%',))
-            db.commit()
-
-            logger.info(f"Starting index scan for {root_path}...")
-
-            # ------------------------------------------------------------
-            # 1. Insert the ROOT FOLDER unconditionally (this fixes your bug)
-            # ------------------------------------------------------------
-            try:
-                db.execute(
-                    """
-                    INSERT OR IGNORE INTO file_index 
-                    (name, path, parent_path, is_folder, is_media, size, modified_time, type)
-                    VALUES (?, ?, ?, 1, 0, 0, ?, 'folder')
-                    """,
-                    (
-                        os.path.basename(root_path) or root_path,
-                        root_path,
-                        root_path,  # root parent = itself for drive roots
-                        os.path.getmtime(root_path)
-                    )
+            if lock:
+                if lock.adopt() is None:
+                    logger.warning(f"[INDEX SKIPPED] {root_path} is already being scanned by another worker.")
+                    return {'status': 'skipped', 'root': root_path, 'error': 'Drive is locked by another scan'}
+                lock.start_renewing()
+            else:
+                logger.error("Indexing without a drive lock (Redis client unavailable).")
+
+            # Rebase rows indexed under an older mountpoint before claiming the checkpoint
+            drive = register_drive(db, root_path)
+            if drive is None:
+                logger.warning(f"No filesystem UUID for {root_path}; rows will not survive a remount.")
+            if lock:
+                checkpoint.claim(lock.token, lock.drive_id)
+
+            if not checkpoint.load(mode):
+                low, high = subtree_bounds(root_path)
+                indexed_files = db.execute(
+                    "SELECT COUNT(*) FROM file_index WHERE is_folder = 0 AND path > ? AND path < ?",
+                    (low, high)
+                ).fetchone()[0]
+                if mode == "auto":
+                    already_indexed = db.execute(
+                        "SELECT 1 FROM file_index WHERE path = ?", (root_path,)
+                    ).fetchone()
+                    mode = "incremental" if already_indexed else "full"
+                checkpoint.start(mode, estimated_total=indexed_files or None)
+                if mode == "full":
+                    reset_staging(db, root_path)
+            mode = checkpoint.mode
+
+            logger.info(
+                f"{'Resuming' if checkpoint.resumed else 'Starting'} {mode} index scan for {root_path}..."
+            )
+            progress = ScanProgress(redis_client, checkpoint)
+            progress.publish(force=True)
+
+            if mode == "full":
+                table = "file_index_staging"
+                writer = BatchWriter(db, table=table, checkpoint=checkpoint, drive=drive)
+                apply_listing = stage_directory
+                writer.insert_folder(
+                    os.path.basename(root_path) or root_path,
+                    root_path,
+                    root_path,  # root parent = itself for drive roots
+                    os.path.getmtime(root_path)
                 )
-                insert_count += 1
-            except Exception as e:
-                logger.warning(f"Failed to insert root folder {root_path}: {e}")
+            else:
+                table = "file_index"
+                writer = BatchWriter(db, checkpoint=checkpoint, drive=drive)
+                apply_listing = sync_directory
+                # ------------------------------------------------------------
+                # 1. Sync the ROOT FOLDER row itself
+                # ------------------------------------------------------------
+                try:
+                    change = sync_root_folder(db, root_path, drive=drive)
+                    if change:
+                        writer.counts[change] += 1
+                except OSError as e:
+                    logger.warning(f"Failed to sync root folder {root_path}: {e}")
 
             # ------------------------------------------------------------
-            # 2. Walk the filesystem and index subfolders and files
+            # 2. Walk the filesystem and apply each folder listing
             # ------------------------------------------------------------
-            for current_dir, dirs, files in os.walk(root_path):
-
-                # Remove system/hidden dot-prefixed folders
-                dirs[:] = [d for d in dirs if not d.startswith('.')]
-
-                # Skip hidden Windows folders (like System Volume Information)
-                if current_dir != root_path and is_hidden_folder(current_dir):
-                    dirs[:] = []
+            walker = ScandirWalker(
+                root_path,
+                concurrency=concurrency,
+                resume=checkpoint.resume_children(table),
+            )
+            for listing in walker.walk():
+                # Unreadable folder: keep whatever the index already has for it
+                if not listing.ok:
                     continue
 
-                # Determine this folder's parent
-                parent_path = os.path.dirname(current_dir)
-                if parent_path == os.path.splitdrive(current_dir)[0]:
-                    parent_path = os.path.splitdrive(current_dir)[0] + os.path.sep
-
-                # --------------------------------------------------------
-                # Insert CURRENT DIRECTORY (including empty folders)
-                # --------------------------------------------------------
-                if current_dir != root_path:  # root already inserted above
-                    try:
-                        db.execute(
-                            """
-                            INSERT OR IGNORE INTO file_index
-                            (name, path, parent_path, is_folder, is_media, size, modified_time, type)
-                            VALUES (?, ?, ?, 1, 0, 0, ?, 'folder')
-                            """,
-                            (
-                                os.path.basename(current_dir),
-                                current_dir,
-                                parent_path,
-                                os.path.getmtime(current_dir)
-                            )
-                        )
-                        insert_count += 1
-                    except sqlite3.IntegrityError:
-                        logger.warning(f"Duplicate folder skipped: {current_dir}")
-
-                # --------------------------------------------------------
-                # Insert FILES within this folder
-                # --------------------------------------------------------
-                for filename in files:
-                    if filename.startswith('.'):
-                        continue
-
-                    file_path = os.path.join(current_dir, filename)
-
-                    try:
-                        stat = os.stat(file_path)
-                        size = stat.st_size
-                        modified_time = stat.st_mtime
-                        created_time = stat.st_birthtime
-
-                        ext = os.path.splitext(filename)[1].lower()
-                        is_media = 1 if ext in PHOTO_EXTENSIONS or ext in VIDEO_EXTENSIONS else 0
-
-                        db.execute(
-                            """
-                            INSERT OR IGNORE INTO file_index
-                            (name, path, parent_path, is_folder, is_media, size, modified_time, created_time, type)
-                            VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?)
-                            """,
-                            (
-                                filename,
-                                file_path,
-                                current_dir,
-                                is_media,
-                                size,
-                                modified_time,
-                                created_time,
-                                ext
-                            )
-                        )
-                        insert_count += 1
-
-                    except FileNotFoundError:
-                        logger.warning(f"File not found during index: {file_path}")
-                    except sqlite3.IntegrityError:
-                        logger.warning(f"Duplicate file skipped: {file_path}")
-                    except Exception as e:
-                        logger.error(f"Unexpected error indexing {file_path}: {e}")
-
-            db.commit()
-            logger.info(f"[INDEXING COMPLETE] {root_path}: Indexed {insert_count} entries.")
-            return {'status': 'success', 'root': root_path, 'count': insert_count}
+                if lock:
+                    lock.check()
+                apply_listing(writer, listing.path, listing.subdirs, listing.files)
+                writer.mark_done(listing.path, len(listing.files))
+                scanned += len(listing.subdirs) + len(listing.files)
+                progress.publish()
+
+            writer.flush()
+            totals = writer.counts
+
+            if mode == "full":
+                swapped = swap_in_staging(db, root_path, checkpoint=checkpoint)
+                logger.info(f"Swapped {swapped} staged rows into file_index for {root_path}.")
+
+            checkpoint.finish()
+            progress.publish(status="complete", force=True)
+            _queue_hashing()
+            _queue_enrichment()
+            _queue_thumbnails(root_path=root_path)
+
+            logger.info(
+                f"[INDEXING COMPLETE] {root_path}: Scanned {scanned} entries "
+                f"({totals['inserted']} inserted, {totals['updated']} updated, {totals['deleted']} deleted) "
+                f"in {walker.elapsed:.1f}s — {walker.files_per_second} files/s "
+                f"with {walker.concurrency} threads."
+            )
+            return {
+                'status': 'success',
+                'root': root_path,
+                'mode': mode,
+                'resumed': checkpoint.resumed,
+                'count': scanned,
+                'files_per_sec': walker.files_per_second,
+                **totals,
+            }
+
+        # A failed scan is marked "interrupted" (see ScanCheckpoint.interrupt):
+        # the next run resumes it and the watcher stops deferring to it
+        except LockLostError as e:
+            # A newer scan owns the checkpoint now; leave it alone
+            logger.error(f"[INDEXING ABORTED] {e}")
+            db.rollback()
+            return {'status': 'failure', 'root': root_path, 'error': str(e)}
 
         except sqlite3.Error as e:
             logger.error(f"[DB ERROR] Indexing failed for {root_path}: {e}")
             db.rollback()
+            _interrupt(checkpoint)
+            if progress:
+                progress.publish(status="failed", force=True)
             return {'status': 'failure', 'root': root_path, 'error': f"Database error: {e}"}
 
         except Exception as e:
             logger.error(f"[INDEXING FAILED] Unexpected exception for {root_path}: {e}")
             db.rollback()
+            _interrupt(checkpoint)
+            if progress:
+                progress.publish(status="failed", force=True)
             return {'status': 'failure', 'root': root_path, 'error': f"General error: {e}"}
 
+    finally:
+        if lock:
+            try:
+                if lock.release():
+                    logger.info(f"Released index lock for {root_path}.")
+            except Exception as e:  # noqa: BLE001
+                logger.error(f"Could not release index lock for {root_path}: {e}")
+
+
+@celery.task
+def rebase_remounted_drives(drives):
+    """
+    Re-attaches known drives that came back under another mountpoint
+    (`drives` as listed by the dashboard), rebasing their rows (see
+    drive_registry.py). Each rebase holds the leases of the new and the old
+    mountpoint, so it never runs alongside a scan's fenced writes. A drive
+    whose lease is taken is left alone: a scan of the new mountpoint rebases
+    it itself (register_drive), else the next dashboard visit queues it again.
+    """
+    db = get_file_index_db()
+    rebased, busy = [], []
+
+    for drive, old_root in remounted_drives(db, drives):
+        root_path = normalize_root(drive["path"])
+        paths = {root_path, normalize_root(old_root)} if old_root else {root_path}
+        locks = _lock_drives(paths) if redis_client else []
+        if locks is None:
+            busy.append(root_path)
+            continue
+
+        try:
+            attach_drive(db, drive["uuid"], root_path, label=drive.get("name"))
+            rebased.append(root_path)
+        except sqlite3.Error as e:
+            logger.error(f"[DB ERROR] Rebase of {drive['uuid']} to {root_path} failed: {e}")
+            db.rollback()
+        finally:
+            for lock in locks:
+                lock.release()
+
+    if busy:
+        logger.info(f"[DRIVE] Rebase deferred to the running scans of {busy}.")
+    return {'status': 'success', 'rebased': rebased, 'busy': busy}
+
+
+@celery.task
+def hash_file_contents():
+    """
+    Fills partial_hash/content_hash for duplicate detection (see hashing.py).
+    Only one run at a time; a request arriving during a run makes the
+    running task go over the index once more when it is done.
+    """
+    if redis_client and not redis_client.set(HASH_LOCK_KEY, 1, nx=True, ex=HASH_LOCK_SECONDS):
+        redis_client.set(HASH_RERUN_KEY, 1, ex=HASH_LOCK_SECONDS)
+        return {'status': 'skipped', 'error': 'Hashing already running'}
+
+    db = get_file_index_db()
+    totals = {"partial": 0, "full": 0}
+    try:
+        while True:
+            counts = hash_pending(db)
+            for key, value in counts.items():
+                totals[key] += value
+            if not (redis_client and redis_client.delete(HASH_RERUN_KEY)):
+                break
+        logger.info(
+            f"[HASH COMPLETE] {totals['partial']} partial hashes, {totals['full']} full hashes."
+        )
+        return {'status': 'success', **totals}
+
+    except sqlite3.Error as e:
+        logger.error(f"[DB ERROR] Content hashing failed: {e}")
+        db.rollback()
+        return {'status': 'failure', 'error': f"Database error: {e}"}
+
     finally:
         if redis_client:
-            redis_client.delete(INDEX_LOCK_KEY)
-            logger.info(f"Released index lock for {root_path}.")
-        else:
-            logger.error("Could not release index lock (Redis client unavailable).")
+            redis_client.delete(HASH_LOCK_KEY)
+
+
+@celery.task
+def pregenerate_thumbnails(root_path=None, paths=None):
+    """
+    Pre-renders the gallery thumbnails (see media_render.py) for every photo
+    and video below `root_path` or for the given `paths`, so galleries are served from
+    the cache on first open. Runs on the low-priority "thumbs" queue.
+    """
+    if root_path:
+        root_path = normalize_root(root_path)
+        folders = gallery_media(get_file_index_db(), root_path)
+    else:
+        media = [os.path.normpath(p) for p in paths or []
+                 if os.path.splitext(p)[1].lower() in GALLERY_EXTENSIONS]
+        folders = {}
+        for path in media:
+            folders.setdefault(os.path.dirname(path), []).append(path)
+        folders = list(folders.items())
+
+    try:
+        coverage = pregenerate_gallery_thumbnails(folders)
+    except Exception as e:
+        logger.error(f"[THUMBS FAILED] {root_path or paths}: {e}")
+        return {'status': 'failure', 'error': str(e)}
+
+    complete = sum(1 for cached, total in coverage.values() if cached == total)
+    logger.info(f"[THUMBS COMPLETE] {root_path or paths}: {complete}/{len(coverage)} folders fully covered.")
+    # Placeholders are computed from the thumbnails just cached
+    _queue_enrichment()
+    return {
+        'status': 'success',
+        'root': root_path,
+        'folders': len(coverage),
+        'complete_folders': complete,
+        'items': sum(total for _, total in coverage.values()),
+        'cached': sum(cached for cached, _ in coverage.values()),
+    }
+
+
+
+@celery.task
+def enrich_media():
+    """
+    Fills derived media data (gallery placeholders, see enrichment.py).
+    Only one run at a time; a request arriving during a run makes the
+    running task go over the index once more when it is done.
+    """
+    if redis_client and not redis_client.set(ENRICH_LOCK_KEY, 1, nx=True, ex=ENRICH_LOCK_SECONDS):
+        redis_client.set(ENRICH_RERUN_KEY, 1, ex=ENRICH_LOCK_SECONDS)
+        return {'status': 'skipped', 'error': 'Enrichment already running'}
+
+    db = get_file_index_db()
+    totals = {}
+    try:
+        while True:
+            for key, value in enrich_pending(db).items():
+                totals[key] = totals.get(key, 0) + value
+            if not (redis_client and redis_client.delete(ENRICH_RERUN_KEY)):
+                break
+        logger.info(f"[ENRICH COMPLETE] {totals}")
+        return {'status': 'success', **totals}
+
+    except sqlite3.Error as e:
+        logger.error(f"[DB ERROR] Media enrichment failed: {e}")
+        db.rollback()
+        return {'status': 'failure', 'error': f"Database error: {e}"}
+
+    finally:
+        if redis_client:
+            redis_client.delete(ENRICH_LOCK_KEY)
 
     
 @celery.task(bind=True, max_retries=3, default_retry_delay=10)
@@ -287,6 +491,50 @@ def perform_merge(self, dz_uuid, destination, final_filename, dz_total_chunks=No
             shutil.rmtree(temp_dir, ignore_errors=True)
             logger.info(f"[CLEANUP] Removed temp folder {temp_dir}")
             
+def _interrupt(checkpoint):
+    """Marks a failed scan resumable; if even that fails, the watcher still only defers to live leases."""
+    try:
+        checkpoint.interrupt()
+    except sqlite3.Error as e:
+        logger.error(f"[DB ERROR] Could not mark the scan of {checkpoint.root_path} interrupted: {e}")
+        checkpoint.db.rollback()
+
+def _lock_drives(paths):
+    """Renewed leases of the drives of `paths`, or None (holding nothing) if one is taken."""
+    locks = []
+    for path in paths:
+        lock = DriveLock(redis_client, path)
+        if any(held.drive_id == lock.drive_id for held in locks):
+            continue
+        if lock.acquire() is None:
+            for held in locks:
+                held.release()
+            return None
+        lock.start_renewing()
+        locks.append(lock)
+    return locks
+
+def _queue_hashing():
+    """Queues a content-hashing pass; the index itself is already up to date if this fails."""
+    try:
+        hash_file_contents.delay()
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"Could not queue content hashing: {e}")
+
+def _queue_thumbnails(root_path=None, paths=None):
+    """Queues thumbnail pre-generation; galleries still render on demand if this fails."""
+    try:
+        pregenerate_thumbnails.delay(root_path=root_path, paths=paths)
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"Could not queue thumbnail pre-generation: {e}")
+
+def _queue_enrichment():
+    """Queues a media enrichment pass; the gallery works without placeholders if this fails."""
+    try:
+        enrich_media.delay()
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"Could not queue media enrichment: {e}")
+
 # ---------------------------------------------------------
 # Celery Status Utilities
 # ---------------------------------------------------------
@@ -1,7 +1,70 @@
 import os
+import shutil
 
 # The absolute path to the directory of this file
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 
 # The shared absolute path for chunk storage
-UPLOAD_TMP = os.path.join(PROJECT_ROOT, "chunks")
\ No newline at end of file
+UPLOAD_TMP = os.path.join(PROJECT_ROOT, "chunks")
+# Number of folders listed concurrently per drive scan (USB 3 SSDs handle many
+# requests at once; spinning disks are usually happiest around 2-4)
+SCAN_CONCURRENCY = int(os.environ.get("NESTBOX_SCAN_CONCURRENCY", 8))
+
+# Rows written per executemany()/commit while indexing
+INDEX_BATCH_SIZE = int(os.environ.get("NESTBOX_INDEX_BATCH_SIZE", 5000))
+
+# Live index updates (watcher.py): events are coalesced per folder until the
+# folder has been quiet for WATCH_DEBOUNCE seconds (or WATCH_MAX_DELAY passed)
+WATCH_DEBOUNCE = float(os.environ.get("NESTBOX_WATCH_DEBOUNCE", 1.0))
+WATCH_MAX_DELAY = float(os.environ.get("NESTBOX_WATCH_MAX_DELAY", 5.0))
+WATCH_POLL_INTERVAL = float(os.environ.get("NESTBOX_WATCH_POLL_INTERVAL", 60.0))
+WATCH_BATCH_SIZE = int(os.environ.get("NESTBOX_WATCH_BATCH_SIZE", 500))
+
+# Content hashing (hashing.py): processes reading files, total read budget
+# (MB/s, 0 = unthrottled) and bytes hashed from each end of a file for the
+# partial-hash tier
+HASH_WORKERS = int(os.environ.get("NESTBOX_HASH_WORKERS", 2))
+HASH_MAX_MBPS = float(os.environ.get("NESTBOX_HASH_MAX_MBPS", 40.0))
+HASH_PARTIAL_BYTES = int(os.environ.get("NESTBOX_HASH_PARTIAL_BYTES", 64 * 1024))
+
+# On-disk cache of rendered thumbnails (disk_cache.py), evicted least recently
+# used first once either budget is exceeded
+THUMB_CACHE_DIR = os.environ.get("NESTBOX_THUMB_CACHE_DIR", os.path.join(PROJECT_ROOT, "instance", "thumb_cache"))
+THUMB_CACHE_MAX_MB = int(os.environ.get("NESTBOX_THUMB_CACHE_MAX_MB", 2048))
+THUMB_CACHE_MAX_ENTRIES = int(os.environ.get("NESTBOX_THUMB_CACHE_MAX_ENTRIES", 200000))
+
+# Thumbnail pre-generation (media_render.py): render processes on the
+# low-priority "thumbs" queue
+THUMB_WORKERS = int(os.environ.get("NESTBOX_THUMB_WORKERS", 2))
+
+# On-demand renders (routes/media.py) run on a fixed pool of RENDER_WORKERS
+# processes with at most RENDER_QUEUE_SIZE waiting; past that requests get a
+# 503 with Retry-After, or the default thumbnail with NESTBOX_RENDER_BUSY=fallback
+RENDER_WORKERS = int(os.environ.get("NESTBOX_RENDER_WORKERS", 2))
+RENDER_QUEUE_SIZE = int(os.environ.get("NESTBOX_RENDER_QUEUE_SIZE", 16))
+RENDER_TIMEOUT = int(os.environ.get("NESTBOX_RENDER_TIMEOUT", 120))
+RENDER_RETRY_AFTER = int(os.environ.get("NESTBOX_RENDER_RETRY_AFTER", 2))
+RENDER_BUSY_FALLBACK = os.environ.get("NESTBOX_RENDER_BUSY") == "fallback"
+
+# Video posters / scrub sprites (media_render.py) need a local ffmpeg; without
+# it video tiles fall back to the default thumbnail. Sprite sheets read the
+# whole file, so they are only pre-rendered when NESTBOX_VIDEO_SPRITES=1
+FFMPEG_BIN = os.environ.get("NESTBOX_FFMPEG") or shutil.which("ffmpeg")
+FFPROBE_BIN = os.environ.get("NESTBOX_FFPROBE") or shutil.which("ffprobe")
+VIDEO_SPRITES = os.environ.get("NESTBOX_VIDEO_SPRITES") == "1"
+
+# HLS streaming (video_stream.py) of videos browsers can't play directly:
+# segments are transcoded on first request by up to HLS_WORKERS ffmpeg
+# processes, HLS_PREFETCH segments ahead of playback, and kept in their own
+# size-bounded cache. NESTBOX_HLS_MIN_MB > 0 also streams larger web videos as HLS
+HLS_SEGMENT_SECONDS = int(os.environ.get("NESTBOX_HLS_SEGMENT_SECONDS", 6))
+HLS_WORKERS = int(os.environ.get("NESTBOX_HLS_WORKERS", 2))
+HLS_PREFETCH = int(os.environ.get("NESTBOX_HLS_PREFETCH", 2))
+HLS_MAX_HEIGHT = int(os.environ.get("NESTBOX_HLS_MAX_HEIGHT", 1080))
+HLS_MIN_MB = int(os.environ.get("NESTBOX_HLS_MIN_MB", 0))
+HLS_CACHE_DIR = os.environ.get("NESTBOX_HLS_CACHE_DIR", os.path.join(PROJECT_ROOT, "instance", "hls_cache"))
+HLS_CACHE_MAX_MB = int(os.environ.get("NESTBOX_HLS_CACHE_MAX_MB", 4096))
+
+# Full-screen previews use a screen-sized "display" rendition instead of the
+# original; pre-rendered with the gallery thumbnails when NESTBOX_DISPLAY_PREGENERATE=1
+DISPLAY_PREGENERATE = os.environ.get("NESTBOX_DISPLAY_PREGENERATE") == "1"
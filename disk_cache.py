@@ -0,0 +1,215 @@
+# disk_cache.py
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+from config import THUMB_CACHE_DIR, THUMB_CACHE_MAX_MB, THUMB_CACHE_MAX_ENTRIES, HLS_CACHE_DIR, HLS_CACHE_MAX_MB
+
+logger = logging.getLogger(__name__)
+
+TOUCH_INTERVAL = 60.0  # seconds; coarser access times mean fewer index writes on hits
+EVICT_TARGET = 0.9     # evict down to 90% of the budgets so puts don't evict one by one
+
+
+def cache_key(*parts):
+    """Stable key for any combination of values (paths, mtimes, render options)."""
+    return hashlib.sha1("\0".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+def thumbnail_key(path, modified_time, size, w, h, q, fmt):
+    """Key of a rendered thumbnail; any change to the source file gives a new key."""
+    return cache_key(os.path.normpath(path), modified_time, size, w, h, q, fmt)
+
+
+def media_version(modified_time, size):
+    """
+    Short content version of a source file for URLs (?v=). A URL carrying the
+    current version can be cached by browsers as immutable: a changed file
+    gets a new version and therefore a new URL.
+    """
+    return cache_key(modified_time, size)[:12]
+
+
+class DiskCache:
+    """
+    Content-addressed file cache with LRU eviction bounded in bytes and in
+    entry count. Entries are files under `directory` (fanned out by key
+    prefix); a small SQLite index next to them tracks size, mimetype and
+    last access. Writes go to a temp file that is renamed into place, so
+    readers (other threads, processes) never see a partial entry.
+    """
+
+    def __init__(self, directory, max_bytes, max_entries):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.index_path = os.path.join(directory, "index.db")
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    # --- Index ---
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with self._init_lock:
+                if not self._initialized:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._create_index()
+                    self._initialized = True
+            conn = sqlite3.connect(self.index_path, timeout=5)
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _create_index(self):
+        db = sqlite3.connect(self.index_path)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mimetype TEXT,
+                last_access REAL NOT NULL
+            );
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_entries_access ON entries (last_access);")
+        # Running totals kept by triggers, so budget checks don't scan the table
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS totals (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                bytes INTEGER NOT NULL,
+                entries INTEGER NOT NULL
+            );
+        """)
+        db.execute("INSERT OR IGNORE INTO totals (id, bytes, entries) VALUES (1, 0, 0)")
+        db.executescript("""
+            CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+                UPDATE totals SET bytes = bytes + new.size, entries = entries + 1 WHERE id = 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+                UPDATE totals SET bytes = bytes - old.size, entries = entries - 1 WHERE id = 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS entries_au AFTER UPDATE OF size ON entries BEGIN
+                UPDATE totals SET bytes = bytes - old.size + new.size WHERE id = 1;
+            END;
+        """)
+        db.commit()
+        db.close()
+
+    def _file_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    # --- Public API ---
+    def get(self, key):
+        """Returns (file path, mimetype) of a cached entry or None."""
+        db = self._db()
+        row = db.execute("SELECT mimetype, last_access FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        path = self._file_path(key)
+        if not os.path.exists(path):
+            # Removed behind our back: forget it
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            db.commit()
+            return None
+
+        now = time.time()
+        if now - row[1] > TOUCH_INTERVAL:
+            try:
+                db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                db.commit()
+            except sqlite3.OperationalError:
+                # Index busy: a stale access time only makes eviction slightly less exact
+                db.rollback()
+        return path, row[0]
+
+    def put(self, key, data, mimetype=None):
+        """Stores `data` (bytes) under `key` and returns its file path."""
+        db = self._db()
+        path = self._file_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        db.execute(
+            """
+            INSERT INTO entries (key, size, mimetype, last_access) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                size = excluded.size, mimetype = excluded.mimetype, last_access = excluded.last_access
+            """,
+            (key, len(data), mimetype, time.time())
+        )
+        db.commit()
+        self._maybe_evict(db)
+        return path
+
+    def existing(self, keys):
+        """Subset of `keys` that are cached (no access-time update)."""
+        db = self._db()
+        keys = list(keys)
+        found = set()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            found.update(r[0] for r in db.execute(
+                f"SELECT key FROM entries WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+            ))
+        return found
+
+    def entry_path(self, key):
+        """
+        File path of entry `key` without touching the index (for other
+        processes); the entry may be evicted at any time, so opening it can fail.
+        """
+        return self._file_path(key)
+
+    def stats(self):
+        total_bytes, entries = self._db().execute("SELECT bytes, entries FROM totals WHERE id = 1").fetchone()
+        return {"bytes": total_bytes, "entries": entries, "max_bytes": self.max_bytes, "max_entries": self.max_entries}
+
+    # --- Eviction ---
+    def _maybe_evict(self, db):
+        total_bytes, entries = db.execute("SELECT bytes, entries FROM totals WHERE id = 1").fetchone()
+        if total_bytes <= self.max_bytes and entries <= self.max_entries:
+            return
+
+        target_bytes = self.max_bytes * EVICT_TARGET
+        target_entries = self.max_entries * EVICT_TARGET
+        evicted = []
+        for key, size in db.execute("SELECT key, size FROM entries ORDER BY last_access"):
+            if total_bytes <= target_bytes and entries <= target_entries:
+                break
+            evicted.append((key,))
+            total_bytes -= size
+            entries -= 1
+
+        db.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        db.commit()
+        for (key,) in evicted:
+            try:
+                os.unlink(self._file_path(key))
+            except OSError:
+                pass
+        logger.info(f"[CACHE] Evicted {len(evicted)} entries from {self.directory}.")
+
+
+# Rendered thumbnails (routes/media.py)
+thumb_cache = DiskCache(THUMB_CACHE_DIR, THUMB_CACHE_MAX_MB * 1024 * 1024, THUMB_CACHE_MAX_ENTRIES)
+
+# Transcoded HLS segments (video_stream.py); few but large entries
+segment_cache = DiskCache(HLS_CACHE_DIR, HLS_CACHE_MAX_MB * 1024 * 1024, THUMB_CACHE_MAX_ENTRIES)
@@ -0,0 +1,190 @@
+# drive_registry.py
+
+import os
+import time
+import logging
+from collections import namedtuple
+from storage_utils import find_mountpoint, get_volume_uuid
+from indexer import subtree_bounds, rebuild_folder_stats
+
+logger = logging.getLogger(__name__)
+
+# Rows of a drive whose last mountpoint was taken by another drive are parked
+# under this (never existing) prefix until the drive shows up again.
+OFFLINE_ROOT = os.path.join(os.path.sep, ".nestbox-offline")
+
+# A drive as the index writers see it: identity + where it is mounted now
+DriveRef = namedtuple("DriveRef", "uuid root")
+
+
+def _offline_root(uuid):
+    return os.path.join(OFFLINE_ROOT, uuid)
+
+
+def _prefix(root):
+    return root if root.endswith(os.path.sep) else root + os.path.sep
+
+
+# ---------------------------------------------------------
+# Rebasing
+# ---------------------------------------------------------
+def _rebase(db, uuid, old_root, new_root):
+    """
+    Moves every row of drive `uuid` from `old_root` to `new_root`: one
+    set-based UPDATE per table, no filesystem access. path is rebuilt from
+    rel_path; parent_path is rewritten by prefix.
+    """
+    new_prefix = _prefix(new_root)
+    cut = len(_prefix(old_root)) + 1
+
+    db.execute(
+        """
+        UPDATE file_index SET
+            path = CASE WHEN rel_path = '' THEN :new ELSE :new_prefix || rel_path END,
+            parent_path = CASE WHEN parent_path = :old THEN :new
+                               ELSE :new_prefix || substr(parent_path, :cut) END
+        WHERE drive_uuid = :uuid
+        """,
+        {"new": new_root, "new_prefix": new_prefix, "old": old_root, "cut": cut, "uuid": uuid}
+    )
+
+    # Scan cursors follow the drive; an interrupted scan restarts its folder
+    # list (and re-stages a full rebuild from scratch)
+    low, high = subtree_bounds(old_root)
+    db.execute(
+        "DELETE FROM file_index_staging WHERE path = ? OR (path > ? AND path < ?)",
+        (old_root, low, high)
+    )
+    for (root_path,) in db.execute(
+        "SELECT root_path FROM scan_checkpoints WHERE root_path = ? OR (root_path > ? AND root_path < ?)",
+        (old_root, low, high)
+    ).fetchall():
+        new_root_path = new_root if root_path == old_root else new_prefix + root_path[cut - 1:]
+        db.execute("DELETE FROM scan_finished_dirs WHERE root_path = ?", (root_path,))
+        db.execute("DELETE FROM scan_checkpoints WHERE root_path = ?", (new_root_path,))
+        db.execute(
+            # Fencing tokens are counted per path (locks.py), so the old one is meaningless here
+            "UPDATE scan_checkpoints SET root_path = ?, fence = NULL WHERE root_path = ?",
+            (new_root_path, root_path)
+        )
+    # Folder stats are keyed by path: drop the old ones, recount at the new root
+    rebuild_folder_stats(db, old_root)
+    rebuild_folder_stats(db, new_root)
+    logger.info(f"[DRIVE] Rebased index of {uuid}: {old_root} → {new_root}")
+
+
+def attach_drive(db, uuid, mountpoint, label=None):
+    """
+    Records that drive `uuid` is mounted at `mountpoint` and makes its rows
+    point there:
+      1. drives still mapped to this mountpoint are gone: park their rows;
+      2. rows indexed at an older mountpoint (or parked) are rebased;
+      3. rows indexed before drives were tracked are adopted.
+    Returns True if anything had to be rewritten.
+    """
+    changed = False
+    row = db.execute("SELECT mountpoint FROM drives WHERE uuid = ?", (uuid,)).fetchone()
+
+    # 1. Whoever was here before has been unplugged
+    for (other,) in db.execute(
+        "SELECT uuid FROM drives WHERE mountpoint = ? AND uuid != ?", (mountpoint, uuid)
+    ).fetchall():
+        _rebase(db, other, mountpoint, _offline_root(other))
+        db.execute("UPDATE drives SET mountpoint = NULL WHERE uuid = ?", (other,))
+        changed = True
+
+    # 2. Same drive, new mountpoint. Untagged rows under the new mountpoint
+    # belong to whatever was mounted there before drives were tracked.
+    low, high = subtree_bounds(mountpoint)
+    if row is not None:
+        old_root = row[0] or _offline_root(uuid)
+        if old_root != mountpoint:
+            db.execute(
+                "DELETE FROM file_index WHERE drive_uuid IS NULL AND (path = ? OR (path > ? AND path < ?))",
+                (mountpoint, low, high)
+            )
+            _rebase(db, uuid, old_root, mountpoint)
+            changed = True
+
+    # 3. Legacy rows under this mountpoint without an owner
+    cur = db.execute(
+        """
+        UPDATE file_index SET
+            drive_uuid = :uuid,
+            rel_path = CASE WHEN path = :root THEN '' ELSE substr(path, :cut) END
+        WHERE drive_uuid IS NULL AND (path = :root OR (path > :low AND path < :high))
+        """,
+        {"uuid": uuid, "root": mountpoint, "cut": len(_prefix(mountpoint)) + 1, "low": low, "high": high}
+    )
+    changed = changed or cur.rowcount > 0
+
+    db.execute(
+        """
+        INSERT INTO drives (uuid, label, mountpoint, last_seen) VALUES (?, ?, ?, ?)
+        ON CONFLICT(uuid) DO UPDATE SET
+            label = COALESCE(excluded.label, drives.label),
+            mountpoint = excluded.mountpoint,
+            last_seen = excluded.last_seen
+        """,
+        (uuid, label, mountpoint, time.time())
+    )
+    db.commit()
+    return changed
+
+
+# ---------------------------------------------------------
+# Lookups
+# ---------------------------------------------------------
+def register_drive(db, path):
+    """
+    Identifies the drive holding `path` (by filesystem UUID), attaches it at
+    its current mountpoint and returns a DriveRef, or None when the
+    filesystem has no stable identity (rows are then stored without one).
+    """
+    part = find_mountpoint(path)
+    if part is None:
+        return None
+    uuid = get_volume_uuid(part.mountpoint, part.device)
+    if not uuid:
+        return None
+    attach_drive(db, uuid, part.mountpoint)
+    return DriveRef(uuid, part.mountpoint)
+
+
+def remounted_drives(db, drives):
+    """
+    (drive, recorded mountpoint) for each of `drives` (as returned by
+    get_flash_drives) that is known under another mountpoint. Read-only: the
+    rebase itself (attach_drive) runs in the rebase_remounted_drives task.
+    """
+    known = dict(db.execute("SELECT uuid, mountpoint FROM drives").fetchall())
+    return [
+        (drive, known[drive["uuid"]]) for drive in drives
+        if drive.get("uuid") in known and known[drive["uuid"]] != drive["path"]
+    ]
+
+
+def online_drives(db):
+    """
+    Registered drives plugged in right now, as (uuid, label, mountpoint) rows.
+    An unplugged drive keeps its mountpoint until another drive takes it, so
+    the mountpoint must also still hold the drive's filesystem.
+    """
+    return [
+        row for row in db.execute(
+            "SELECT uuid, label, mountpoint FROM drives WHERE mountpoint IS NOT NULL ORDER BY label, mountpoint"
+        )
+        if os.path.isdir(row[2]) and get_volume_uuid(row[2]) == row[0]
+    ]
+
+
+def drive_for_path(db, path):
+    """DriveRef of the registered drive whose current mountpoint contains `path`."""
+    best = None
+    for uuid, mountpoint in db.execute(
+        "SELECT uuid, mountpoint FROM drives WHERE mountpoint IS NOT NULL"
+    ):
+        if path == mountpoint or path.startswith(_prefix(mountpoint)):
+            if best is None or len(mountpoint) > len(best.root):
+                best = DriveRef(uuid, mountpoint)
+    return best
@@ -0,0 +1,327 @@
+# enrichment.py
+#
+# Background passes that add derived data to file_index rows of photos and
+# videos. Each value is valid while its *_mtime column matches the indexed
+# modified_time, so changed files are simply picked up by the next pass.
+#   metadata    – date taken, dimensions, orientation, duration, codec, read
+#                 from file headers only (EXIF / ffprobe, never a full decode)
+#   placeholder – BlurHash + average color, painted by the gallery before
+#                 the thumbnail arrives
+# Metadata runs first: it decides gallery order (sort_time) and layout.
+
+import io
+import json
+import math
+import time
+import logging
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from disk_cache import thumb_cache
+from hashing import ONLINE_ROWS
+from media_render import (
+    load_for_size, is_video, _gallery_keys, _gallery_types_clause, _init_worker, _render_context, EXIF_ORIENTATION,
+)
+from config import THUMB_WORKERS, FFPROBE_BIN
+
+logger = logging.getLogger(__name__)
+
+ENRICH_LOCK_KEY = "enrich_lock"
+ENRICH_RERUN_KEY = "enrich_rerun"
+ENRICH_LOCK_SECONDS = 6 * 3600
+
+ENRICH_BATCH_SIZE = 200  # results written per commit
+
+EXIF_IFD = 0x8769
+EXIF_DATETIME = 0x0132           # DateTime (IFD0): last edit, used if nothing better
+EXIF_DATETIME_ORIGINAL = 0x9003  # DateTimeOriginal (Exif IFD): when the photo was taken
+EXIF_OFFSET_ORIGINAL = 0x9011    # OffsetTimeOriginal, e.g. "+02:00"
+FFPROBE_TIMEOUT = 30
+
+PLACEHOLDER_SIZE = 32        # pixels the BlurHash is computed from
+PLACEHOLDER_COMPONENTS = (4, 3)
+
+
+# ---------------------------------------------------------
+# BlurHash (https://blurha.sh)
+# ---------------------------------------------------------
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+
+def _base83(value, length):
+    return "".join(BASE83[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+
+def _to_linear(value):
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def _to_srgb(value):
+    v = max(0.0, min(1.0, value))
+    return int(v * 12.92 * 255 + 0.5) if v <= 0.0031308 else int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value, exp):
+    return math.copysign(abs(value) ** exp, value)
+
+
+def blurhash(img, components=PLACEHOLDER_COMPONENTS):
+    """BlurHash string of a (small) RGB image."""
+    cx, cy = components
+    width, height = img.size
+    linear = [tuple(_to_linear(c) for c in px) for px in img.getdata()]
+    cos_x = [[math.cos(math.pi * i * x / width) for x in range(width)] for i in range(cx)]
+    cos_y = [[math.cos(math.pi * j * y / height) for y in range(height)] for j in range(cy)]
+
+    factors = []
+    for j in range(cy):
+        for i in range(cx):
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                basis_y = cos_y[j][y]
+                for x in range(width):
+                    basis = cos_x[i][x] * basis_y
+                    pr, pg, pb = linear[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = (1 if i == j == 0 else 2) / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83((cx - 1) + (cy - 1) * 9, 1)
+    if ac:
+        actual_max = max(abs(c) for factor in ac for c in factor)
+        quantised_max = max(0, min(82, int(actual_max * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        max_value = 1
+        result += _base83(0, 1)
+
+    result += _base83((_to_srgb(dc[0]) << 16) + (_to_srgb(dc[1]) << 8) + _to_srgb(dc[2]), 4)
+    for factor in ac:
+        q = [max(0, min(18, int(_sign_pow(c / max_value, 0.5) * 9 + 9.5))) for c in factor]
+        result += _base83(q[0] * 19 * 19 + q[1] * 19 + q[2], 2)
+    return result
+
+
+def average_color(img):
+    r, g, b = img.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))[:3]
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+# ---------------------------------------------------------
+# Header Metadata
+# ---------------------------------------------------------
+def _exif_time(value, offset=None):
+    """EXIF "YYYY:MM:DD HH:MM:SS" (local time, unless an offset is given) -> epoch seconds."""
+    try:
+        taken = datetime.strptime(str(value).strip("\x00 ")[:19], "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+    if offset:
+        try:
+            return datetime.strptime(f"{taken.isoformat()}{offset.strip()}", "%Y-%m-%dT%H:%M:%S%z").timestamp()
+        except ValueError:
+            pass
+    return time.mktime(taken.timetuple())
+
+
+def _image_metadata(path):
+    # Image.open only parses headers; pixel data is never decoded here
+    with Image.open(path) as img:
+        width, height = img.size
+        exif = img.getexif()
+        orientation = exif.get(EXIF_ORIENTATION)
+        details = exif.get_ifd(EXIF_IFD)
+        taken = _exif_time(details[EXIF_DATETIME_ORIGINAL], details.get(EXIF_OFFSET_ORIGINAL)) \
+            if EXIF_DATETIME_ORIGINAL in details else None
+        if taken is None and EXIF_DATETIME in exif:
+            taken = _exif_time(exif[EXIF_DATETIME])
+        codec = (img.format or "").lower() or None
+
+    if orientation in (5, 6, 7, 8):
+        # Stored sideways: the gallery lays out the displayed size
+        width, height = height, width
+    return {"taken_time": taken, "width": width, "height": height, "orientation": orientation,
+            "duration": None, "codec": codec}
+
+
+def _video_metadata(path):
+    if not FFPROBE_BIN:
+        return None
+    result = subprocess.run(
+        [FFPROBE_BIN, "-v", "error", "-of", "json",
+         "-show_entries", "format=duration:format_tags=creation_time"
+                          ":stream=codec_type,codec_name,width,height:stream_tags=rotate"
+                          ":stream_side_data=rotation",
+         path],
+        capture_output=True, text=True, timeout=FFPROBE_TIMEOUT
+    )
+    probe = json.loads(result.stdout)
+    fmt = probe.get("format", {})
+    video = next((st for st in probe.get("streams", []) if st.get("codec_type") == "video"), {})
+
+    width, height = video.get("width"), video.get("height")
+    rotation = video.get("tags", {}).get("rotate")
+    for side_data in video.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    if width and height and rotation is not None and abs(int(float(rotation))) % 180 == 90:
+        width, height = height, width
+
+    taken = None
+    created = fmt.get("tags", {}).get("creation_time")
+    if created:
+        try:
+            taken = datetime.fromisoformat(created.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            pass
+    duration = fmt.get("duration")
+    return {"taken_time": taken, "width": width, "height": height, "orientation": None,
+            "duration": float(duration) if duration else None, "codec": video.get("codec_name")}
+
+
+def _metadata_job(job):
+    """(path, mtime) -> (path, mtime, metadata dict or None)."""
+    path, modified_time = job
+    try:
+        metadata = _video_metadata(path) if is_video(path) else _image_metadata(path)
+        return path, modified_time, metadata
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"[ENRICH] No metadata for {path}: {e}")
+        return path, modified_time, None
+
+
+# ---------------------------------------------------------
+# Placeholders
+# ---------------------------------------------------------
+def _placeholder_source(path, thumb_path):
+    """
+    Small image of a photo / video: from its cached gallery thumbnail
+    (`thumb_path`, looked up by the parent process) if any, else the original.
+    """
+    if thumb_path:
+        try:
+            with open(thumb_path, "rb") as f:
+                img = Image.open(io.BytesIO(f.read()))
+        except OSError:
+            # Evicted since the lookup
+            img = None
+        if img is not None:
+            img.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+            return img
+    return load_for_size(path, PLACEHOLDER_SIZE, PLACEHOLDER_SIZE)
+
+
+def _placeholder_job(job):
+    """(path, mtime, thumb path) -> (path, mtime, blurhash, color) or (path, mtime, None, None) on error."""
+    path, modified_time, thumb_path = job
+    try:
+        img = _placeholder_source(path, thumb_path).convert("RGB")
+        return path, modified_time, blurhash(img), average_color(img)
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"[ENRICH] No placeholder for {path}: {e}")
+        return path, modified_time, None, None
+
+
+def _placeholder_jobs(rows):
+    """
+    (path, mtime, cached JPEG thumbnail path or None) per (path, mtime, size)
+    row. The thumbnail cache is only read here, in the parent: workers never
+    touch its SQLite index.
+    """
+    keys = [_gallery_keys(path, modified_time, size)["jpeg"] for path, modified_time, size in rows]
+    cached = thumb_cache.existing(keys)
+    return [
+        (path, modified_time, thumb_cache.entry_path(key) if key in cached else None)
+        for (path, modified_time, _), key in zip(rows, keys)
+    ]
+
+
+# ---------------------------------------------------------
+# Pipeline
+# ---------------------------------------------------------
+def _candidates(db, columns, stamp):
+    """Gallery media of online drives whose `stamp` column doesn't match modified_time."""
+    types_clause, types = _gallery_types_clause()
+    return db.execute(
+        f"""
+        SELECT {columns} FROM file_index
+        WHERE is_folder = 0 AND is_media = 1 AND {types_clause}
+          AND ({stamp} IS NULL OR {stamp} != modified_time)
+          AND {ONLINE_ROWS}
+        ORDER BY parent_path, sort_time DESC
+        """,
+        types
+    ).fetchall()
+
+
+def _write_batches(db, results, sql, to_params):
+    """Writes pool results in ENRICH_BATCH_SIZE commits. Returns rows written."""
+    written = 0
+    batch = []
+    for result in results:
+        batch.append(to_params(result))
+        if len(batch) >= ENRICH_BATCH_SIZE:
+            written += len(batch)
+            db.executemany(sql, batch)
+            db.commit()
+            batch.clear()
+    if batch:
+        written += len(batch)
+        db.executemany(sql, batch)
+        db.commit()
+    return written
+
+
+def _metadata_params(result):
+    path, modified_time, meta = result
+    meta = meta or {}
+    return (meta.get("taken_time"), meta.get("width"), meta.get("height"), meta.get("orientation"),
+            meta.get("duration"), meta.get("codec"), meta.get("taken_time"), path, modified_time)
+
+
+def enrich_pending(db, workers=THUMB_WORKERS):
+    """
+    Runs every pass for files that are new or changed since their last pass,
+    on a pool of `workers` low-priority processes. Results are committed in
+    batches, so an interrupted run resumes where it stopped. A file that
+    fails still gets its *_mtime set (with NULL values) and is not retried
+    until it changes. Returns counts per pass.
+    """
+    counts = {"metadata": 0, "placeholders": 0}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, mp_context=_render_context()) as pool:
+        # --- Header metadata ---
+        jobs = [tuple(r) for r in _candidates(db, "path, modified_time", "meta_mtime")]
+        if jobs:
+            logger.info(f"[ENRICH] Reading metadata of {len(jobs)} files...")
+            counts["metadata"] = _write_batches(
+                db,
+                pool.map(_metadata_job, jobs, chunksize=16),
+                """
+                UPDATE file_index SET
+                    taken_time = ?, width = ?, height = ?, orientation = ?, duration = ?, codec = ?,
+                    sort_time = COALESCE(?, created_time, modified_time), meta_mtime = modified_time
+                WHERE path = ? AND modified_time = ?
+                """,
+                _metadata_params,
+            )
+
+        # --- Placeholders ---
+        jobs = _placeholder_jobs(_candidates(db, "path, modified_time, size", "placeholder_mtime"))
+        if jobs:
+            logger.info(f"[ENRICH] Computing placeholders for {len(jobs)} files...")
+            counts["placeholders"] = _write_batches(
+                db,
+                pool.map(_placeholder_job, jobs, chunksize=8),
+                """
+                UPDATE file_index SET placeholder = ?, avg_color = ?, placeholder_mtime = modified_time
+                WHERE path = ? AND modified_time = ?
+                """,
+                lambda r: (r[2], r[3], r[0], r[1]),
+            )
+    return counts
@@ -0,0 +1,270 @@
+# hashing.py
+#
+# Content identity for duplicate detection. Hashing every byte of every drive
+# is far too slow for USB disks, so candidates are narrowed in tiers:
+#   1. size      – a file with a unique size cannot have a duplicate
+#   2. partial   – same-size files hash HASH_PARTIAL_BYTES from each end
+#   3. full      – only files whose (size, partial hash) collide are read fully
+# Files that fit in the partial window get their content hash in tier 2.
+
+import os
+import time
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from media_render import _render_context
+from config import HASH_WORKERS, HASH_MAX_MBPS, HASH_PARTIAL_BYTES
+
+logger = logging.getLogger(__name__)
+
+HASH_LOCK_KEY = "hash_lock"
+HASH_RERUN_KEY = "hash_rerun"
+HASH_LOCK_SECONDS = 6 * 3600
+
+HASH_BATCH_SIZE = 500     # results written per commit
+READ_BLOCK = 1024 * 1024  # full-hash read size
+
+# Hashes are valid while hash_mtime matches the indexed modified_time
+VALID_HASH = "hash_mtime = modified_time"
+
+# Rows of drives that are currently unplugged cannot be read
+ONLINE_ROWS = "(drive_uuid IS NULL OR drive_uuid IN (SELECT uuid FROM drives WHERE mountpoint IS NOT NULL))"
+
+
+# ---------------------------------------------------------
+# Worker Processes
+# ---------------------------------------------------------
+class Throttle:
+    """Caps the read rate of one process at `bytes_per_second` (0 = unlimited)."""
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.start = time.monotonic()
+        self.consumed = 0
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        self.consumed += nbytes
+        ahead = self.consumed / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+_throttle = None
+
+
+def _init_worker(bytes_per_second):
+    """Runs once per pool process: low CPU/IO priority and its share of the read budget."""
+    global _throttle
+    if hasattr(os, "nice"):
+        try:
+            os.nice(10)
+        except OSError:
+            pass
+    _throttle = Throttle(bytes_per_second)
+
+
+def _new_digest(size):
+    # The size is part of the digest, so small files hashed in one read match
+    # their full hash and differently sized files never compare equal
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(size.to_bytes(8, "little"))
+    return digest
+
+
+def _partial_job(job):
+    """(path, size) -> (path, mtime, digest, complete) or (path, None, None, False) on error."""
+    path, size = job
+    try:
+        stat = os.stat(path)
+        if stat.st_size != size:
+            return path, None, None, False
+        digest = _new_digest(size)
+        with open(path, "rb") as f:
+            if size <= 2 * HASH_PARTIAL_BYTES:
+                data = f.read()
+                digest.update(data)
+                _throttle.consume(len(data))
+                return path, stat.st_mtime, digest.hexdigest(), True
+
+            head = f.read(HASH_PARTIAL_BYTES)
+            f.seek(-HASH_PARTIAL_BYTES, os.SEEK_END)
+            tail = f.read(HASH_PARTIAL_BYTES)
+            digest.update(head)
+            digest.update(tail)
+            _throttle.consume(len(head) + len(tail))
+        return path, stat.st_mtime, digest.hexdigest(), False
+    except OSError:
+        return path, None, None, False
+
+
+def _full_job(job):
+    """(path, size) -> (path, mtime, digest) or (path, None, None) on error."""
+    path, size = job
+    try:
+        stat = os.stat(path)
+        if stat.st_size != size:
+            return path, None, None
+        digest = _new_digest(size)
+        with open(path, "rb") as f:
+            while True:
+                block = f.read(READ_BLOCK)
+                if not block:
+                    break
+                digest.update(block)
+                _throttle.consume(len(block))
+        return path, stat.st_mtime, digest.hexdigest()
+    except OSError:
+        return path, None, None
+
+
+# ---------------------------------------------------------
+# Pipeline
+# ---------------------------------------------------------
+def _partial_candidates(db):
+    """Tier 1: files sharing their size with another file and lacking a valid partial hash."""
+    return db.execute(
+        f"""
+        SELECT path, size FROM file_index
+        WHERE is_folder = 0 AND size > 0
+          AND (hash_mtime IS NULL OR hash_mtime != modified_time)
+          AND {ONLINE_ROWS}
+          AND size IN (
+              SELECT size FROM file_index WHERE is_folder = 0 AND size > 0
+              GROUP BY size HAVING COUNT(*) > 1
+          )
+        ORDER BY path
+        """
+    ).fetchall()
+
+
+def _full_candidates(db):
+    """Tier 3: files whose (size, partial hash) collides with another file."""
+    return db.execute(
+        f"""
+        SELECT f.path, f.size FROM file_index AS f
+        WHERE f.is_folder = 0 AND f.content_hash IS NULL AND f.partial_hash IS NOT NULL
+          AND f.{VALID_HASH}
+          AND {ONLINE_ROWS}
+          AND EXISTS (
+              SELECT 1 FROM file_index AS g
+              WHERE g.size = f.size AND g.partial_hash = f.partial_hash
+                AND g.path != f.path AND g.{VALID_HASH}
+          )
+        ORDER BY f.path
+        """
+    ).fetchall()
+
+
+def _write_batches(db, results, sql, to_params):
+    """Writes pool results in HASH_BATCH_SIZE commits. Returns rows written."""
+    written = 0
+    batch = []
+    for result in results:
+        params = to_params(result)
+        if params is not None:
+            batch.append(params)
+        if len(batch) >= HASH_BATCH_SIZE:
+            written += len(batch)
+            db.executemany(sql, batch)
+            db.commit()
+            batch.clear()
+    if batch:
+        written += len(batch)
+        db.executemany(sql, batch)
+        db.commit()
+    return written
+
+
+def hash_pending(db, workers=HASH_WORKERS, max_mbps=HASH_MAX_MBPS):
+    """
+    Brings content hashes up to date for every online drive. Work happens on
+    a pool of `workers` low-priority processes sharing `max_mbps` of reads.
+    Results are only stored if the file's mtime still matches the index, so
+    a file that changed meanwhile is simply picked up by the next run.
+    Returns counts per tier.
+    """
+    counts = {"partial": 0, "full": 0}
+    budget = max_mbps * 1024 * 1024 / max(workers, 1)
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(budget,), mp_context=_render_context()
+    ) as pool:
+        # --- Tier 2: head/tail hashes ---
+        jobs = [tuple(r) for r in _partial_candidates(db)]
+        if jobs:
+            logger.info(f"[HASH] Partial-hashing {len(jobs)} same-size files...")
+            counts["partial"] = _write_batches(
+                db,
+                pool.map(_partial_job, jobs, chunksize=16),
+                """
+                UPDATE file_index SET partial_hash = ?, content_hash = ?, hash_mtime = modified_time
+                WHERE path = ? AND modified_time = ?
+                """,
+                lambda r: (r[2], r[2] if r[3] else None, r[0], r[1]) if r[2] else None,
+            )
+
+        # --- Tier 3: full hashes for partial collisions ---
+        jobs = [tuple(r) for r in _full_candidates(db)]
+        if jobs:
+            logger.info(f"[HASH] Full-hashing {len(jobs)} files with colliding partial hashes...")
+            counts["full"] = _write_batches(
+                db,
+                pool.map(_full_job, jobs, chunksize=1),
+                f"UPDATE file_index SET content_hash = ? WHERE path = ? AND modified_time = ? AND {VALID_HASH}",
+                lambda r: (r[2], r[0], r[1]) if r[2] else None,
+            )
+    return counts
+
+
+# ---------------------------------------------------------
+# Queries
+# ---------------------------------------------------------
+def find_duplicates(db, limit=50, offset=0, min_size=0):
+    """
+    Groups of files with identical content, largest wasted space first.
+    Returns (groups, total_groups); each group lists its files.
+    """
+    groups = db.execute(
+        f"""
+        SELECT content_hash, size, COUNT(*) AS copies
+        FROM file_index
+        WHERE content_hash IS NOT NULL AND {VALID_HASH} AND size >= ?
+        GROUP BY content_hash, size
+        HAVING copies > 1
+        ORDER BY size * (copies - 1) DESC, content_hash
+        LIMIT ? OFFSET ?
+        """,
+        (min_size, limit, offset)
+    ).fetchall()
+
+    total = db.execute(
+        f"""
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM file_index
+            WHERE content_hash IS NOT NULL AND {VALID_HASH} AND size >= ?
+            GROUP BY content_hash, size HAVING COUNT(*) > 1
+        )
+        """,
+        (min_size,)
+    ).fetchone()[0]
+
+    result = []
+    for content_hash, size, copies in groups:
+        files = db.execute(
+            f"""
+            SELECT name, path, parent_path, modified_time, drive_uuid
+            FROM file_index WHERE content_hash = ? AND size = ? AND {VALID_HASH}
+            ORDER BY path
+            """,
+            (content_hash, size)
+        ).fetchall()
+        result.append({
+            "hash": content_hash,
+            "size": size,
+            "copies": copies,
+            "wasted_bytes": size * (copies - 1),
+            "files": [dict(f) for f in files],
+        })
+    return result, total
@@ -55,12 +55,31 @@ def get_db():
         g.db.row_factory = sqlite3.Row
     return g.db
 
+# Per-connection tuning for file_index.db. WAL itself is persistent and is
+# switched on once in init_all_dbs(); with it, browse requests read a stable
+# snapshot while the indexer writes.
+FILE_INDEX_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",   # safe with WAL, avoids an fsync per commit
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",    # 64 MB page cache
+    "PRAGMA mmap_size = 268435456",  # 256 MB memory-mapped reads
+    "PRAGMA busy_timeout = 5000",    # wait for the writer instead of failing
+    "PRAGMA recursive_triggers = ON",  # INSERT OR REPLACE fires delete triggers (file_search)
+)
+
+def connect_file_index_db():
+    """Open a tuned connection to file_index.db (usable outside a Flask app context)."""
+    _ensure_instance_folder() # Create instance folder if missing
+    conn = sqlite3.connect(FILES_DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.row_factory = sqlite3.Row
+    for pragma in FILE_INDEX_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
 def get_file_index_db():
     """Get a database connection for the file index (file_index.db)."""
     if "file_index_db" not in g:
-        _ensure_instance_folder() # Create instance folder if missing
-        g.file_index_db = sqlite3.connect(FILES_DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
-        g.file_index_db.row_factory = sqlite3.Row
+        g.file_index_db = connect_file_index_db()
     return g.file_index_db
 
 def close_db(e=None):
@@ -76,6 +95,49 @@ def close_db(e=None):
         file_db.close()
 
 
+def _ensure_column(db, table, column, decl):
+    """Add a column to an existing table if it is missing (lightweight migration). Returns True if added."""
+    columns = {row[1] for row in db.execute(f"PRAGMA table_info({table})")}
+    if column in columns:
+        return False
+    db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+
+def _init_search(db):
+    """
+    Filename search (search.py): trigram FTS over name and path, kept in sync
+    with file_index by triggers. The trigram tokenizer needs SQLite 3.34+
+    built with FTS5; without it only search is unavailable.
+    """
+    try:
+        db.execute("CREATE VIRTUAL TABLE temp.file_search_probe USING fts5(name, tokenize = 'trigram')")
+        db.execute("DROP TABLE temp.file_search_probe")
+    except sqlite3.OperationalError as e:
+        print(f"[DB] Filename search disabled (SQLite {sqlite3.sqlite_version}, no FTS5 trigram): {e}")
+        return
+    has_search = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'file_search'"
+    ).fetchone()
+    db.executescript("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS file_search USING fts5(
+            name, path, content = 'file_index', content_rowid = 'id', tokenize = 'trigram'
+        );
+        CREATE TRIGGER IF NOT EXISTS file_search_ai AFTER INSERT ON file_index BEGIN
+            INSERT INTO file_search (rowid, name, path) VALUES (new.id, new.name, new.path);
+        END;
+        CREATE TRIGGER IF NOT EXISTS file_search_ad AFTER DELETE ON file_index BEGIN
+            INSERT INTO file_search (file_search, rowid, name, path) VALUES ('delete', old.id, old.name, old.path);
+        END;
+        CREATE TRIGGER IF NOT EXISTS file_search_au AFTER UPDATE OF name, path ON file_index BEGIN
+            INSERT INTO file_search (file_search, rowid, name, path) VALUES ('delete', old.id, old.name, old.path);
+            INSERT INTO file_search (rowid, name, path) VALUES (new.id, new.name, new.path);
+        END;
+    """)
+    if not has_search:
+        db.execute("INSERT INTO file_search (file_search) VALUES ('rebuild')")
+
+
 def init_all_dbs():
     """
     Checks and creates both databases and their tables.
@@ -102,6 +164,7 @@ def init_all_dbs():
     try:
         # Init file_index.db
         db = sqlite3.connect(FILES_DB_PATH)
+        db.execute("PRAGMA journal_mode = WAL")
         db.execute("""
             CREATE TABLE IF NOT EXISTS file_index (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -116,13 +179,134 @@ def init_all_dbs():
                 type TEXT
             );
         """)
+        # Drive identity: rows belong to a filesystem UUID and keep their path
+        # relative to the drive root, so a remount only rebases the prefix
+        _ensure_column(db, "file_index", "drive_uuid", "TEXT")
+        _ensure_column(db, "file_index", "rel_path", "TEXT")
+        # Content identity (hashing.py); valid while hash_mtime = modified_time
+        _ensure_column(db, "file_index", "partial_hash", "TEXT")
+        _ensure_column(db, "file_index", "content_hash", "TEXT")
+        _ensure_column(db, "file_index", "hash_mtime", "REAL")
+        # Gallery placeholders (enrichment.py); valid while placeholder_mtime = modified_time
+        _ensure_column(db, "file_index", "placeholder", "TEXT")
+        _ensure_column(db, "file_index", "avg_color", "TEXT")
+        _ensure_column(db, "file_index", "placeholder_mtime", "REAL")
+        # Header metadata (enrichment.py); valid while meta_mtime = modified_time.
+        # sort_time = date taken, else created_time: what galleries order by
+        _ensure_column(db, "file_index", "taken_time", "REAL")
+        _ensure_column(db, "file_index", "width", "INTEGER")
+        _ensure_column(db, "file_index", "height", "INTEGER")
+        _ensure_column(db, "file_index", "orientation", "INTEGER")
+        _ensure_column(db, "file_index", "duration", "REAL")
+        _ensure_column(db, "file_index", "codec", "TEXT")
+        _ensure_column(db, "file_index", "meta_mtime", "REAL")
+        if _ensure_column(db, "file_index", "sort_time", "REAL"):
+            # Rows indexed before sort_time existed; every writer sets it since
+            db.execute("UPDATE file_index SET sort_time = created_time WHERE created_time IS NOT NULL")
         db.execute("CREATE INDEX IF NOT EXISTS idx_parent_path ON file_index (parent_path);")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_drive_uuid ON file_index (drive_uuid);")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_size_partial ON file_index (size, partial_hash);")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_content_hash ON file_index (content_hash);")
         db.execute("CREATE INDEX IF NOT EXISTS idx_is_folder ON file_index (is_folder);")
         db.execute("CREATE INDEX IF NOT EXISTS idx_is_media ON file_index (is_media);")
+        # Keyset pagination (storage_utils.SORT_KEYS); the rowid (id) is implicitly the last index column
+        db.execute("CREATE INDEX IF NOT EXISTS idx_gallery_sort ON file_index (parent_path, is_media, sort_time);")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_browse_name ON file_index (parent_path, is_folder, name);")
+        # Drive-wide timeline (storage_utils.timeline_page): keyset seek on (sort_time, id) per drive
+        db.execute("CREATE INDEX IF NOT EXISTS idx_timeline ON file_index (drive_uuid, is_media, sort_time);")
         db.execute("""
             CREATE INDEX IF NOT EXISTS idx_browse_filter 
             ON file_index (parent_path, is_folder, is_media, name);
         """)
+        # Full rebuilds are bulk-loaded here, then swapped into file_index in one transaction
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS file_index_staging (
+                name TEXT NOT NULL,
+                path TEXT PRIMARY KEY,
+                parent_path TEXT NOT NULL,
+                is_folder INTEGER NOT NULL,
+                is_media INTEGER NOT NULL,
+                size INTEGER,
+                modified_time REAL,
+                created_time REAL,
+                type TEXT
+            );
+        """)
+        _ensure_column(db, "file_index_staging", "drive_uuid", "TEXT")
+        _ensure_column(db, "file_index_staging", "rel_path", "TEXT")
+        _ensure_column(db, "file_index_staging", "partial_hash", "TEXT")
+        _ensure_column(db, "file_index_staging", "content_hash", "TEXT")
+        _ensure_column(db, "file_index_staging", "hash_mtime", "REAL")
+        _ensure_column(db, "file_index_staging", "placeholder", "TEXT")
+        _ensure_column(db, "file_index_staging", "avg_color", "TEXT")
+        _ensure_column(db, "file_index_staging", "placeholder_mtime", "REAL")
+        _ensure_column(db, "file_index_staging", "taken_time", "REAL")
+        _ensure_column(db, "file_index_staging", "width", "INTEGER")
+        _ensure_column(db, "file_index_staging", "height", "INTEGER")
+        _ensure_column(db, "file_index_staging", "orientation", "INTEGER")
+        _ensure_column(db, "file_index_staging", "duration", "REAL")
+        _ensure_column(db, "file_index_staging", "codec", "TEXT")
+        _ensure_column(db, "file_index_staging", "meta_mtime", "REAL")
+        _ensure_column(db, "file_index_staging", "sort_time", "REAL")
+        # Known drives and where they are currently mounted
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS drives (
+                uuid TEXT PRIMARY KEY, -- filesystem UUID / volume serial
+                label TEXT,
+                mountpoint TEXT, -- NULL while another drive occupies its last mountpoint
+                last_seen REAL
+            );
+        """)
+        # Resumable scan cursors: one row per scanned root + the folders already finished
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS scan_checkpoints (
+                root_path TEXT PRIMARY KEY,
+                mode TEXT NOT NULL,
+                status TEXT NOT NULL, -- running / complete
+                started_at REAL,
+                updated_at REAL,
+                dirs_done INTEGER NOT NULL DEFAULT 0,
+                files_done INTEGER NOT NULL DEFAULT 0,
+                last_total INTEGER, -- files seen by the last complete scan (for ETA)
+                fence INTEGER -- fencing token of the scan allowed to write (see locks.py)
+            );
+        """)
+        _ensure_column(db, "scan_checkpoints", "fence", "INTEGER")
+        # Drive the root is on (locks.drive_identity): fences are compared across its roots
+        _ensure_column(db, "scan_checkpoints", "drive_id", "TEXT")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_scan_checkpoints_drive ON scan_checkpoints (drive_id, fence);")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS scan_finished_dirs (
+                root_path TEXT NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (root_path, path)
+            ) WITHOUT ROWID;
+        """)
+        # Per-folder counts / bytes, direct and over the subtree (indexer.refresh_folder_stats)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS folder_stats (
+                path TEXT PRIMARY KEY,
+                parent_path TEXT NOT NULL,
+                folders INTEGER NOT NULL DEFAULT 0,
+                files INTEGER NOT NULL DEFAULT 0, -- non-media files
+                media INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                latest_mtime REAL,
+                total_folders INTEGER NOT NULL DEFAULT 0,
+                total_files INTEGER NOT NULL DEFAULT 0,
+                total_media INTEGER NOT NULL DEFAULT 0,
+                total_bytes INTEGER NOT NULL DEFAULT 0,
+                total_latest_mtime REAL
+            ) WITHOUT ROWID;
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_folder_stats_parent ON folder_stats (parent_path);")
+        if db.execute("SELECT 1 FROM folder_stats LIMIT 1").fetchone() is None:
+            # Indexes built before folder_stats existed: count every scan root once
+            from indexer import rebuild_folder_stats
+            roots = db.execute("SELECT path FROM file_index WHERE path = parent_path").fetchall()
+            for (root,) in roots:
+                rebuild_folder_stats(db, root)
+        _init_search(db)
         db.commit()
         db.close()
         print("[DB] File index table checked/created successfully.")
@@ -0,0 +1,718 @@
+# indexer.py
+
+import os
+import logging
+from storage_utils import PHOTO_EXTENSIONS, VIDEO_EXTENSIONS
+from config import INDEX_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# Path Helpers
+# ---------------------------------------------------------
+def normalize_root(root_path):
+    """Normalize a drive/folder path and fix bare drive letters ("D:" → "D:\\")."""
+    root_path = os.path.normpath(root_path)
+    drive, tail = os.path.splitdrive(root_path)
+    if drive and not tail:
+        root_path = drive + os.path.sep
+    return root_path
+
+
+def subtree_bounds(path):
+    """
+    Returns (low, high) so that `path > low AND path < high` matches every
+    row strictly below `path`. A range scan uses the UNIQUE index on path,
+    is case-sensitive and needs no LIKE escaping (unlike `LIKE path || '%'`,
+    which also matches sibling folders such as '/media/ab' for '/media/a').
+    """
+    prefix = path if path.endswith(os.path.sep) else path + os.path.sep
+    return prefix, prefix[:-1] + chr(ord(os.path.sep) + 1)
+
+
+def folder_parent(path):
+    """Parent folder of `path` as stored in parent_path (drive roots point to themselves)."""
+    parent_path = os.path.dirname(path)
+    drive = os.path.splitdrive(path)[0]
+    if parent_path == drive:
+        parent_path = drive + os.path.sep
+    return parent_path or path
+
+
+def relative_path(root_path, path):
+    """`path` relative to the drive root, as stored in rel_path ('' for the root itself)."""
+    if path == root_path:
+        return ""
+    prefix = root_path if root_path.endswith(os.path.sep) else root_path + os.path.sep
+    return path[len(prefix):]
+
+
+# ---------------------------------------------------------
+# Row Helpers
+# ---------------------------------------------------------
+def is_media_ext(ext):
+    return 1 if ext in PHOTO_EXTENSIONS or ext in VIDEO_EXTENSIONS else 0
+
+
+def created_time_from_stat(stat):
+    """st_birthtime only exists on macOS/Windows/BSD; fall back to st_ctime elsewhere."""
+    return getattr(stat, "st_birthtime", stat.st_ctime)
+
+
+# ---------------------------------------------------------
+# Folder Stats
+# ---------------------------------------------------------
+# folder_stats holds per-folder aggregates of file_index so counts and disk
+# usage are one-row lookups: folders / files / media / bytes / latest_mtime
+# over the folder's own entries and total_* over its whole subtree ("files"
+# never includes media; latest_* are file mtimes). Write batches apply their
+# changes as increments (FolderStatsDelta) in their own transaction; bulk
+# rewrites recompute the subtree (rebuild_folder_stats).
+STATS_COLUMNS = (
+    "folders", "files", "media", "bytes", "latest_mtime",
+    "total_folders", "total_files", "total_media", "total_bytes", "total_latest_mtime",
+)
+
+DIRECT_STATS_SQL = """
+    SELECT parent_path,
+           COALESCE(SUM(is_folder), 0),
+           COALESCE(SUM(is_folder = 0 AND is_media = 0), 0),
+           COALESCE(SUM(is_folder = 0 AND is_media = 1), 0),
+           COALESCE(SUM(CASE WHEN is_folder = 0 THEN size END), 0),
+           MAX(CASE WHEN is_folder = 0 THEN modified_time END)
+    FROM file_index
+    WHERE {where} AND path != parent_path
+    GROUP BY parent_path
+"""
+
+
+def _max_time(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def _refresh_totals(db, paths):
+    """Re-sums total_* of `paths` from their own stats and their subfolders' totals."""
+    # A folder's path is always longer than its parent's: longest first is bottom-up
+    for path in sorted(paths, key=len, reverse=True):
+        db.execute(
+            """
+            UPDATE folder_stats SET
+                total_folders = folders + COALESCE(c.folders, 0),
+                total_files = files + COALESCE(c.files, 0),
+                total_media = media + COALESCE(c.media, 0),
+                total_bytes = bytes + COALESCE(c.bytes, 0),
+                total_latest_mtime = MAX(COALESCE(latest_mtime, c.latest), COALESCE(c.latest, latest_mtime))
+            FROM (
+                SELECT SUM(total_folders) AS folders, SUM(total_files) AS files, SUM(total_media) AS media,
+                       SUM(total_bytes) AS bytes, MAX(total_latest_mtime) AS latest
+                FROM folder_stats WHERE parent_path = :path AND path != :path
+            ) AS c
+            WHERE path = :path
+            """,
+            {"path": path}
+        )
+
+
+def _ancestors(db, path):
+    """Folders above `path` that have stats, nearest first (stops at a scan root)."""
+    ancestors = []
+    while True:
+        row = db.execute("SELECT parent_path FROM folder_stats WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] == path:
+            return ancestors
+        path = row[0]
+        ancestors.append(path)
+
+
+def refresh_folder_stats(db, folders):
+    """
+    Recomputes the stats of `folders` (rows of folders that no longer exist
+    are dropped) and the totals of every folder above them. Does not commit.
+    """
+    folders = set(folders)
+    if not folders:
+        return
+    for path in folders:
+        row = db.execute("SELECT parent_path FROM file_index WHERE path = ? AND is_folder = 1", (path,)).fetchone()
+        if row is None:
+            db.execute("DELETE FROM folder_stats WHERE path = ?", (path,))
+            continue
+        direct = db.execute(DIRECT_STATS_SQL.format(where="parent_path = ?"), (path,)).fetchone()
+        db.execute(
+            """
+            INSERT INTO folder_stats (path, parent_path, folders, files, media, bytes, latest_mtime)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                parent_path = excluded.parent_path, folders = excluded.folders, files = excluded.files,
+                media = excluded.media, bytes = excluded.bytes, latest_mtime = excluded.latest_mtime
+            """,
+            (path, row[0], *(direct[1:] if direct else (0, 0, 0, 0, None)))
+        )
+
+    affected = set()
+    for path in folders:
+        affected.add(path)
+        affected.update(_ancestors(db, path))
+    _refresh_totals(db, affected)
+
+
+def rebuild_folder_stats(db, root_path):
+    """
+    Recomputes the stats of every folder in the subtree of `root_path` with
+    one grouped scan (after bulk rewrites: full rebuilds, drive remounts), then
+    the totals above it. Does not commit.
+    """
+    clause, params = _subtree_clause(root_path)
+    stats = {
+        path: [parent_path, 0, 0, 0, 0, None]
+        for path, parent_path in db.execute(
+            f"SELECT path, parent_path FROM file_index WHERE is_folder = 1 AND {clause}", params
+        )
+    }
+    for parent_path, *direct in db.execute(
+        DIRECT_STATS_SQL.format(where=_subtree_clause(root_path, column="parent_path")[0]), params
+    ):
+        if parent_path in stats:
+            stats[parent_path][1:] = direct
+
+    totals = {path: list(values[1:]) for path, values in stats.items()}
+    for path in sorted(stats, key=len, reverse=True):
+        parent_path = stats[path][0]
+        if parent_path != path and parent_path in totals:
+            parent, child = totals[parent_path], totals[path]
+            for i in range(4):
+                parent[i] += child[i]
+            parent[4] = _max_time(parent[4], child[4])
+
+    db.execute(f"DELETE FROM folder_stats WHERE {clause}", params)
+    db.executemany(
+        f"INSERT INTO folder_stats (path, parent_path, {', '.join(STATS_COLUMNS)}) "
+        f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(path, values[0], *values[1:], *totals[path]) for path, values in stats.items()]
+    )
+    _refresh_totals(db, _ancestors(db, root_path))
+
+
+class FolderStatsDelta:
+    """
+    Folder stats changes of one write batch, applied as increments instead of
+    re-aggregating the touched folders: every entry added or removed adjusts
+    its folder's direct counts and the totals of that folder and each one
+    above it. Only removing (or backdating) a folder's newest file forces an
+    exact recompute, since latest_mtime can't be decremented.
+
+    snapshot() the rows about to be written before writing them, record the
+    writes with add_*/remove, then apply() in the same transaction.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._old = {}
+        self.removed = set()
+        self._direct = {}         # folder -> [folders, files, media, bytes] of its own entries
+        self._totals = {}         # folder -> the same, over its subtree
+        self._added_latest = {}   # folder -> newest mtime of a file added to it
+        self._removed_latest = {} # folder -> newest mtime of a file removed from it
+        self._removed_subtree_latest = {}  # folder -> newest total_latest_mtime of a removed subfolder
+        self._new_folders = {}    # path -> parent_path
+
+    def snapshot(self, paths):
+        """Reads the current file_index rows of `paths` (call before writing them)."""
+        paths = [p for p in dict.fromkeys(paths) if p not in self._old]
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            for path, *row in self.db.execute(
+                f"""
+                SELECT path, parent_path, is_folder, is_media, size, modified_time
+                FROM file_index WHERE path IN ({", ".join("?" * len(chunk))})
+                """,
+                chunk
+            ):
+                self._old[path] = row
+        return self._old
+
+    def _count(self, folder, direct, totals=None):
+        for target, values in ((self._direct, direct), (self._totals, totals or direct)):
+            acc = target.setdefault(folder, [0, 0, 0, 0])
+            for i, value in enumerate(values):
+                acc[i] += value
+
+    def add_file(self, parent_path, is_media, size, modified_time):
+        self._count(parent_path, (0, int(not is_media), int(bool(is_media)), size or 0))
+        self._added_latest[parent_path] = _max_time(self._added_latest.get(parent_path), modified_time)
+
+    def add_folder(self, path, parent_path):
+        self._new_folders[path] = parent_path
+        if parent_path != path:
+            self._count(parent_path, (1, 0, 0, 0))
+
+    def remove(self, path):
+        """
+        Removes the snapshotted row of `path` (once). Removing a folder drops
+        its stats rows and those below it right away; its totals come off
+        every folder above it.
+        """
+        row = self._old.get(path)
+        if row is None or path in self.removed:
+            return
+        self.removed.add(path)
+        parent_path, is_folder, is_media, size, modified_time = row
+        if not is_folder:
+            self._count(parent_path, (0, -int(not is_media), -int(bool(is_media)), -(size or 0)))
+            self._removed_latest[parent_path] = _max_time(self._removed_latest.get(parent_path), modified_time)
+            return
+        below = self.db.execute(
+            "SELECT total_folders, total_files, total_media, total_bytes, total_latest_mtime "
+            "FROM folder_stats WHERE path = ?", (path,)
+        ).fetchone() or (0, 0, 0, 0, None)
+        low, high = subtree_bounds(path)
+        self.db.execute("DELETE FROM folder_stats WHERE path = ? OR (path > ? AND path < ?)", (path, low, high))
+        if parent_path != path:
+            self._count(parent_path, (-1, 0, 0, 0), (-1 - below[0], -below[1], -below[2], -below[3]))
+            self._removed_subtree_latest[parent_path] = _max_time(
+                self._removed_subtree_latest.get(parent_path), below[4]
+            )
+
+    def _chain(self, path, parents):
+        """`path` and every folder above it that has stats, nearest first."""
+        chain = []
+        while path not in chain:
+            if path not in parents:
+                row = self.db.execute("SELECT parent_path FROM folder_stats WHERE path = ?", (path,)).fetchone()
+                parents[path] = row[0] if row else None
+            if parents[path] is None:
+                break
+            chain.append(path)
+            path = parents[path]
+        return chain
+
+    def apply(self):
+        """Writes the increments (after the batch's file_index writes). Does not commit."""
+        db = self.db
+        if self._new_folders:
+            db.executemany(
+                "INSERT OR IGNORE INTO folder_stats (path, parent_path) VALUES (?, ?)",
+                self._new_folders.items()
+            )
+        folders = set(self._direct) | set(self._removed_subtree_latest)
+        if not folders:
+            return
+        current = {}
+        folder_list = list(folders)
+        for i in range(0, len(folder_list), 500):
+            chunk = folder_list[i:i + 500]
+            for path, parent_path, latest, total_latest in db.execute(
+                f"""
+                SELECT path, parent_path, latest_mtime, total_latest_mtime
+                FROM folder_stats WHERE path IN ({", ".join("?" * len(chunk))})
+                """,
+                chunk
+            ):
+                current[path] = (parent_path, latest, total_latest)
+
+        # Direct counts
+        db.executemany(
+            """
+            UPDATE folder_stats SET
+                folders = folders + :folders, files = files + :files, media = media + :media,
+                bytes = bytes + :bytes,
+                latest_mtime = MAX(COALESCE(latest_mtime, :latest), COALESCE(:latest, latest_mtime))
+            WHERE path = :path
+            """,
+            [
+                {"path": path, "folders": d[0], "files": d[1], "media": d[2], "bytes": d[3],
+                 "latest": self._added_latest.get(path)}
+                for path, d in self._direct.items() if path in current
+            ]
+        )
+
+        # Totals, summed per folder over the chains above every changed folder
+        parents = {path: row[0] for path, row in current.items()}
+        chains = {path: self._chain(path, parents) for path in current}
+        totals, latest = {}, {}
+        for folder, values in self._totals.items():
+            for path in chains.get(folder, ()):
+                acc = totals.setdefault(path, [0, 0, 0, 0])
+                for i in range(4):
+                    acc[i] += values[i]
+        for folder, mtime in self._added_latest.items():
+            for path in chains.get(folder, ()):
+                latest[path] = _max_time(latest.get(path), mtime)
+        db.executemany(
+            """
+            UPDATE folder_stats SET
+                total_folders = total_folders + :folders, total_files = total_files + :files,
+                total_media = total_media + :media, total_bytes = total_bytes + :bytes,
+                total_latest_mtime = MAX(COALESCE(total_latest_mtime, :latest), COALESCE(:latest, total_latest_mtime))
+            WHERE path = :path
+            """,
+            [
+                {"path": path, "folders": t[0], "files": t[1], "media": t[2], "bytes": t[3],
+                 "latest": latest.get(path)}
+                for path, t in ((p, totals.get(p, (0, 0, 0, 0))) for p in set(totals) | set(latest))
+            ]
+        )
+
+        # A removed newest entry that nothing newer replaced: recompute exactly
+        stale, stale_totals = set(), set()
+        for path, (_, old_latest, old_total_latest) in current.items():
+            added = self._added_latest.get(path)
+            removed = self._removed_latest.get(path)
+            if removed is not None and old_latest is not None and removed >= old_latest \
+                    and (added is None or added < removed):
+                stale.add(path)
+            removed = _max_time(removed, self._removed_subtree_latest.get(path))
+            if removed is not None and old_total_latest is not None and removed >= old_total_latest \
+                    and (added is None or added < removed):
+                stale_totals.update(chains[path])
+        for path in stale:
+            db.execute(
+                """
+                UPDATE folder_stats SET latest_mtime = (
+                    SELECT MAX(modified_time) FROM file_index
+                    WHERE parent_path = :path AND is_folder = 0 AND path != :path
+                ) WHERE path = :path
+                """,
+                {"path": path}
+            )
+        if stale_totals:
+            _refresh_totals(db, stale_totals)
+
+        # Folders indexed before they had stats are refreshed in full
+        refresh_folder_stats(db, folders - set(current))
+
+
+# ---------------------------------------------------------
+# Batched Writer
+# ---------------------------------------------------------
+FILE_COLUMNS = (
+    "name, path, parent_path, is_folder, is_media, size, modified_time, created_time, type, "
+    "drive_uuid, rel_path, sort_time"
+)
+
+# Columns derived from file content (not from the directory listing). A full
+# rebuild carries them over for files whose size and mtime did not change.
+CARRY_COLUMNS = (
+    "partial_hash", "content_hash", "hash_mtime",
+    "placeholder", "avg_color", "placeholder_mtime",
+    "taken_time", "width", "height", "orientation", "duration", "codec", "meta_mtime", "sort_time",
+)
+
+
+class BatchWriter:
+    """
+    Buffers index writes and applies them with executemany() in batches of
+    `batch_size` rows, committing once per batch. Deletes are flushed before
+    inserts so a path whose type changed (file <-> folder) never collides.
+    With a `checkpoint`, finished folders are recorded in the same commit.
+    With a `drive` (drive_registry.DriveRef), new rows are tagged with the
+    drive's UUID and their path relative to its mountpoint.
+    """
+
+    def __init__(self, db, batch_size=INDEX_BATCH_SIZE, table="file_index", checkpoint=None, drive=None):
+        self.db = db
+        self.batch_size = batch_size
+        self.table = table
+        self.checkpoint = checkpoint
+        self.drive = drive
+        self.counts = {"inserted": 0, "updated": 0, "deleted": 0}
+        self._deletes = []
+        self._subtree_deletes = []
+        self._inserts = []
+        self._folder_updates = []
+        self._file_updates = []
+
+    @property
+    def pending(self):
+        pending = (len(self._deletes) + len(self._subtree_deletes) + len(self._inserts)
+                   + len(self._folder_updates) + len(self._file_updates))
+        if self.checkpoint:
+            pending += self.checkpoint.pending
+        return pending
+
+    def _identity(self, path):
+        if self.drive is None:
+            return None, None
+        return self.drive.uuid, relative_path(self.drive.root, path)
+
+    # --- Buffering ---
+    def insert_folder(self, name, path, parent_path, modified_time):
+        self._inserts.append(
+            (name, path, parent_path, 1, 0, 0, modified_time, None, 'folder', *self._identity(path), None)
+        )
+        self._maybe_flush()
+
+    def insert_file(self, name, path, parent_path, size, modified_time, created_time):
+        ext = os.path.splitext(name)[1].lower()
+        self._inserts.append(
+            (name, path, parent_path, 0, is_media_ext(ext), size, modified_time, created_time, ext,
+             *self._identity(path), created_time)
+        )
+        self._maybe_flush()
+
+    def update_folder(self, path, modified_time):
+        self._folder_updates.append((modified_time, path))
+        self._maybe_flush()
+
+    def update_file(self, path, size, modified_time, created_time):
+        self._file_updates.append((size, modified_time, created_time, path))
+        self._maybe_flush()
+
+    def delete(self, path):
+        self._deletes.append((path,))
+        self._maybe_flush()
+
+    def delete_subtree(self, path):
+        self._subtree_deletes.append((path, *subtree_bounds(path)))
+        self._maybe_flush()
+
+    def mark_done(self, dir_path, file_count):
+        """Records a fully applied folder listing on the checkpoint."""
+        self.checkpoint.mark_done(dir_path, file_count)
+        self._maybe_flush()
+
+    # --- Flushing ---
+    def _stats_delta(self):
+        """Folder stats changes of the buffered writes, read before they are applied."""
+        delta = FolderStatsDelta(self.db)
+        old = delta.snapshot(
+            [path for path, *_ in self._subtree_deletes] + [path for (path,) in self._deletes]
+            + [row[1] for row in self._inserts] + [path for *_, path in self._file_updates]
+        )
+        for path, *_ in self._subtree_deletes:
+            delta.remove(path)
+        for (path,) in self._deletes:
+            delta.remove(path)
+        for row in self._inserts:
+            name, path, parent_path, is_folder, is_media, size, modified_time = row[:7]
+            before = old.get(path)
+            if is_folder and before is not None and before[1]:
+                continue  # folder stays a folder, its stats stay valid
+            delta.remove(path)  # INSERT OR REPLACE
+            if is_folder:
+                delta.add_folder(path, parent_path)
+            else:
+                delta.add_file(parent_path, is_media, size, modified_time)
+        for size, modified_time, _, path in self._file_updates:
+            before = old.get(path)
+            if before is not None and not before[1] and path not in delta.removed:
+                parent_path, _, is_media, *_ = before
+                delta.remove(path)
+                delta.add_file(parent_path, is_media, size, modified_time)
+        return delta
+
+    def _maybe_flush(self):
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes everything buffered in one transaction."""
+        if not self.pending:
+            return
+        db = self.db
+        table = self.table
+        stats = self._stats_delta() if table == "file_index" else None
+
+        if self._subtree_deletes:
+            cur = db.executemany(
+                f"DELETE FROM {table} WHERE path = ? OR (path > ? AND path < ?)",
+                self._subtree_deletes
+            )
+            self.counts["deleted"] += cur.rowcount
+        if self._deletes:
+            cur = db.executemany(f"DELETE FROM {table} WHERE path = ?", self._deletes)
+            self.counts["deleted"] += cur.rowcount
+        if self._inserts:
+            db.executemany(
+                f"INSERT OR REPLACE INTO {table} ({FILE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self._inserts
+            )
+            self.counts["inserted"] += len(self._inserts)
+        if self._folder_updates:
+            db.executemany(f"UPDATE {table} SET modified_time = ? WHERE path = ?", self._folder_updates)
+            self.counts["updated"] += len(self._folder_updates)
+        if self._file_updates:
+            db.executemany(
+                f"""
+                UPDATE {table} SET size = ?, modified_time = ?, created_time = ?, sort_time = COALESCE(taken_time, ?)
+                WHERE path = ?
+                """,
+                [(size, mtime, created, created, path) for size, mtime, created, path in self._file_updates]
+            )
+            self.counts["updated"] += len(self._file_updates)
+        if stats is not None:
+            stats.apply()
+        if self.checkpoint:
+            try:
+                self.checkpoint.persist()
+            except Exception:
+                db.rollback()
+                raise
+        db.commit()
+
+        self._deletes.clear()
+        self._subtree_deletes.clear()
+        self._inserts.clear()
+        self._folder_updates.clear()
+        self._file_updates.clear()
+
+
+# ---------------------------------------------------------
+# Incremental Sync
+# ---------------------------------------------------------
+def sync_directory(writer, dir_path, subdirs, files):
+    """
+    Brings the direct children of `dir_path` in file_index in line with what
+    is on disk, queueing only rows that changed on `writer`.
+
+    `subdirs` is a list of (name, modified_time) and `files` a list of
+    (name, size, modified_time, created_time). Folders are compared by mtime,
+    files by (size, mtime). Vanished folders are removed with their subtree.
+
+    Returns the paths of folders that were not indexed before (their own
+    contents still need to be synced by callers that are not walking the
+    whole tree anyway).
+    """
+    new_folders = []
+    existing = {
+        row[0]: row
+        for row in writer.db.execute(
+            """
+            SELECT name, path, is_folder, size, modified_time
+            FROM file_index
+            WHERE parent_path = ? AND path != ?
+            """,
+            (dir_path, dir_path)
+        )
+    }
+
+    # --- Folders ---
+    for name, modified_time in subdirs:
+        path = os.path.join(dir_path, name)
+        row = existing.pop(name, None)
+
+        if row is not None and not row[2]:
+            # A file was replaced by a folder of the same name
+            writer.delete(path)
+            row = None
+
+        if row is None:
+            writer.insert_folder(name, path, dir_path, modified_time)
+            new_folders.append(path)
+        elif row[4] != modified_time:
+            writer.update_folder(path, modified_time)
+
+    # --- Files ---
+    for name, size, modified_time, created_time in files:
+        path = os.path.join(dir_path, name)
+        row = existing.pop(name, None)
+
+        if row is not None and row[2]:
+            # A folder was replaced by a file of the same name
+            writer.delete_subtree(path)
+            row = None
+
+        if row is None:
+            writer.insert_file(name, path, dir_path, size, modified_time, created_time)
+        elif row[3] != size or row[4] != modified_time:
+            writer.update_file(path, size, modified_time, created_time)
+
+    # --- Anything left no longer exists on disk ---
+    for name, path, is_folder, _, _ in existing.values():
+        if is_folder:
+            writer.delete_subtree(path)
+        else:
+            writer.delete(path)
+
+    return new_folders
+
+
+# ---------------------------------------------------------
+# Full Rebuild (Staging Table + Swap)
+# ---------------------------------------------------------
+def stage_directory(writer, dir_path, subdirs, files):
+    """Queues every child of `dir_path` for insertion into the staging table."""
+    for name, modified_time in subdirs:
+        writer.insert_folder(name, os.path.join(dir_path, name), dir_path, modified_time)
+    for name, size, modified_time, created_time in files:
+        writer.insert_file(name, os.path.join(dir_path, name), dir_path, size, modified_time, created_time)
+
+
+def _subtree_clause(root_path, column="path"):
+    low, high = subtree_bounds(root_path)
+    return f"({column} = ? OR ({column} > ? AND {column} < ?))", (root_path, low, high)
+
+
+def reset_staging(db, root_path):
+    """Clears staged rows of an earlier, interrupted rebuild of `root_path`."""
+    clause, params = _subtree_clause(root_path)
+    db.execute(f"DELETE FROM file_index_staging WHERE {clause}", params)
+    db.commit()
+
+
+def swap_in_staging(db, root_path, checkpoint=None):
+    """
+    Atomically replaces every file_index row of `root_path` with the staged
+    rows (keeping CARRY_COLUMNS of unchanged files). Runs as a single transaction, so with WAL readers keep seeing the
+    previous complete index until the commit and the new one right after.
+    With a `checkpoint`, the swap is fenced like every batch commit.
+    Returns the number of rows swapped in.
+    """
+    clause, params = _subtree_clause(root_path)
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        if checkpoint:
+            checkpoint.verify_fence()
+        staged_clause, _ = _subtree_clause(root_path, column="s.path")
+        db.execute(
+            f"""
+            UPDATE file_index_staging AS s SET {", ".join(f"{c} = f.{c}" for c in CARRY_COLUMNS)}
+            FROM file_index AS f
+            WHERE f.path = s.path AND f.size IS s.size AND f.modified_time IS s.modified_time
+              AND {staged_clause}
+            """,
+            params
+        )
+        db.execute(f"DELETE FROM file_index WHERE {clause}", params)
+        columns = ", ".join(dict.fromkeys([*FILE_COLUMNS.split(", "), *CARRY_COLUMNS]))
+        cur = db.execute(
+            f"INSERT INTO file_index ({columns}) SELECT {columns} FROM file_index_staging WHERE {clause}",
+            params
+        )
+        swapped = cur.rowcount
+        db.execute(f"DELETE FROM file_index_staging WHERE {clause}", params)
+        rebuild_folder_stats(db, root_path)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return swapped
+
+
+def sync_root_folder(db, root_path, drive=None):
+    """Inserts or refreshes the row for the scan root itself (parent = itself for drive roots)."""
+    modified_time = os.path.getmtime(root_path)
+    row = db.execute(
+        "SELECT modified_time FROM file_index WHERE path = ?", (root_path,)
+    ).fetchone()
+
+    if row is None:
+        db.execute(
+            """
+            INSERT INTO file_index
+            (name, path, parent_path, is_folder, is_media, size, modified_time, type, drive_uuid, rel_path)
+            VALUES (?, ?, ?, 1, 0, 0, ?, 'folder', ?, ?)
+            """,
+            (os.path.basename(root_path) or root_path, root_path, root_path, modified_time,
+             drive.uuid if drive else None, relative_path(drive.root, root_path) if drive else None)
+        )
+        refresh_folder_stats(db, [root_path])
+        return "inserted"
+    if row[0] != modified_time:
+        db.execute(
+            "UPDATE file_index SET modified_time = ? WHERE path = ?",
+            (modified_time, root_path)
+        )
+        return "updated"
+    return None
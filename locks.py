@@ -0,0 +1,134 @@
+# locks.py
+
+import hashlib
+import logging
+import threading
+from storage_utils import find_mountpoint, get_volume_uuid
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY_PREFIX = "index_lock:"
+FENCE_KEY_PREFIX = "index_fence:"
+
+LEASE_SECONDS = 60          # a running scan renews its lease every LEASE_SECONDS / 3
+QUEUED_LEASE_SECONDS = 600  # lease taken by the web request, until a worker picks the task up
+
+# Only the holder (same token) may extend or release a lease
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LockLostError(RuntimeError):
+    """Raised when a scan no longer holds its drive lease (or was fenced off)."""
+
+
+def drive_identity(path):
+    """
+    What a lease covers: the filesystem `path` lives on, by volume UUID (its
+    mountpoint if it has none). Scans of nested roots on one drive share a
+    lease and a fence counter.
+    """
+    part = find_mountpoint(path)
+    if part is None:
+        return path
+    return get_volume_uuid(part.mountpoint, part.device) or part.mountpoint
+
+
+def _drive_key(drive_id):
+    # Identities can be long and contain anything; hash them into a stable key
+    return hashlib.sha1(drive_id.encode("utf-8")).hexdigest()
+
+
+class DriveLock:
+    """
+    Per-drive index lease in Redis with a fencing token, keyed by the drive
+    `root_path` is on (drive_identity), not by the path itself.
+
+    Each acquisition takes a new, strictly increasing token (INCR). The token
+    is stored as the lock value, renewed while the scan runs and written to
+    scan_checkpoints, where every batch commit checks it, so a scan whose
+    lease expired can no longer write once a newer scan has started.
+    """
+
+    def __init__(self, redis_client, root_path, token=None):
+        self.redis = redis_client
+        self.root_path = root_path
+        self.drive_id = drive_identity(root_path)
+        self.key = LOCK_KEY_PREFIX + _drive_key(self.drive_id)
+        self.fence_key = FENCE_KEY_PREFIX + _drive_key(self.drive_id)
+        self.token = token
+        self.lost = threading.Event()
+        self._renewer = None
+
+    def acquire(self, lease=LEASE_SECONDS):
+        """Takes the lease if nobody holds it. Returns the fencing token or None."""
+        token = self.redis.incr(self.fence_key)
+        if not self.redis.set(self.key, token, nx=True, ex=lease):
+            return None
+        self.token = token
+        return token
+
+    def adopt(self, lease=LEASE_SECONDS):
+        """
+        Continues a lease handed over by the web request (or a re-delivered
+        task). Re-acquires with a new token if the old lease already expired.
+        Returns the token in use or None if another scan holds the drive.
+        """
+        if self.token is not None and self.renew(lease):
+            return self.token
+        return self.acquire(lease)
+
+    def renew(self, lease=LEASE_SECONDS):
+        script = self.redis.register_script(_RENEW_SCRIPT)
+        return bool(script(keys=[self.key], args=[self.token, lease]))
+
+    def release(self):
+        self.stop_renewing()
+        if self.token is None:
+            return False
+        script = self.redis.register_script(_RELEASE_SCRIPT)
+        return bool(script(keys=[self.key], args=[self.token]))
+
+    def is_locked(self):
+        return bool(self.redis.exists(self.key))
+
+    def check(self):
+        """Raises LockLostError if lease renewal failed."""
+        if self.lost.is_set():
+            raise LockLostError(f"Lost index lease for {self.root_path}")
+
+    # --- Lease Renewal ---
+    def start_renewing(self, lease=LEASE_SECONDS):
+        """Renews the lease from a daemon thread until release()."""
+        stop = threading.Event()
+
+        def _renew_loop():
+            while not stop.wait(lease / 3):
+                try:
+                    if not self.renew(lease):
+                        logger.error(f"[LOCK] Lease for {self.root_path} was lost (token {self.token}).")
+                        self.lost.set()
+                        return
+                except Exception as e:  # noqa: BLE001
+                    # Transient Redis error: retry on the next tick, the lease is still valid for a while
+                    logger.warning(f"[LOCK] Could not renew lease for {self.root_path}: {e}")
+
+        self._renewer = (stop, threading.Thread(target=_renew_loop, name="lease-renewer", daemon=True))
+        self._renewer[1].start()
+
+    def stop_renewing(self):
+        if self._renewer:
+            stop, thread = self._renewer
+            stop.set()
+            thread.join(timeout=1)
+            self._renewer = None
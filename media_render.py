@@ -0,0 +1,518 @@
+# media_render.py
+
+import io
+import os
+import logging
+import threading
+import multiprocessing
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ExifTags
+from pillow_heif import register_heif_opener
+from disk_cache import thumb_cache, thumbnail_key, cache_key
+from indexer import subtree_bounds
+from storage_utils import PHOTO_EXTENSIONS, VIDEO_EXTENSIONS, decode_cursor
+from config import (
+    THUMB_WORKERS, FFMPEG_BIN, FFPROBE_BIN, VIDEO_SPRITES, DISPLAY_PREGENERATE,
+    RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_TIMEOUT,
+)
+
+# Add HEIC support
+register_heif_opener()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUALITY = 95
+
+# What templates/browse/_gallery_grid.html requests for every tile:
+# (226 * 1.5) px, one <source> per format
+GALLERY_THUMB_SIZE = int(226 * 1.5)
+GALLERY_FORMATS = ("avif", "webp", "jpeg")
+
+# Full-screen previews (?rendition=display): browsers can't show HEIC/TIFF
+# originals and multi-MB JPEGs are slow to open on a phone
+DISPLAY_SIZE = 2048
+DISPLAY_QUALITY = 85
+DISPLAY_FORMAT = "webp"
+
+# Videos get a poster frame in the same sizes/formats when ffmpeg is available
+GALLERY_EXTENSIONS = PHOTO_EXTENSIONS | (VIDEO_EXTENSIONS if FFMPEG_BIN else set())
+
+
+# ---------------------------------------------------------
+# Decode Strategies
+# ---------------------------------------------------------
+EXIF_ORIENTATION = 0x0112
+EXIF_THUMB_OFFSET = 0x0201  # JPEGInterchangeFormat (IFD1)
+EXIF_THUMB_LENGTH = 0x0202  # JPEGInterchangeFormatLength (IFD1)
+
+# EXIF orientation -> transpose that makes the image upright (as ImageOps.exif_transpose)
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def _fit(width, height, box_w, box_h):
+    """Size of a width x height image fitted into box_w x box_h (never upscaled), like Image.thumbnail."""
+    scale = min(box_w / width if box_w else 1.0, box_h / height if box_h else 1.0, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _exif_preview(img, size):
+    """
+    The JPEG preview embedded in the EXIF data (IFD1), if it is at least
+    `size` and has the image's aspect ratio (many cameras letterbox it).
+    """
+    raw = img.info.get("exif")
+    if not raw or not raw.startswith(b"Exif\0\0"):
+        return None
+    try:
+        ifd1 = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = ifd1.get(EXIF_THUMB_OFFSET), ifd1.get(EXIF_THUMB_LENGTH)
+        if not offset or not length:
+            return None
+        # Offsets are relative to the TIFF header right after "Exif\0\0"
+        preview = Image.open(io.BytesIO(raw[6 + offset: 6 + offset + length]))
+        preview.load()
+    except Exception:  # noqa: BLE001
+        return None
+
+    if preview.width < size[0] or preview.height < size[1]:
+        return None
+    if abs(preview.width / preview.height - img.width / img.height) > 0.01:
+        return None
+    return preview
+
+
+def load_for_size(path, w, h):
+    """
+    Returns `path` decoded at (about) the size it is displayed at, fitted into
+    w x h and upright. Instead of decoding every pixel and resizing:
+      - an EXIF-embedded preview is used when it is large enough,
+      - JPEGs are decoded with DCT scaling (draft: 1/2, 1/4 or 1/8 size,
+        never below twice the target so resampling keeps its quality margin),
+      - HEIF/HEIC decodes its embedded thumbnail when one is large enough
+        (pillow_heif implements draft() that way),
+      - everything else is reduced by an integer factor before resampling
+        (thumbnail's reducing_gap).
+    Orientation is applied last, on the small image. Videos yield their
+    poster frame.
+    """
+    if is_video(path):
+        return video_frame(path, w, h)
+
+    with Image.open(path) as img:
+        orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+        # The box is given upright; the stored pixels are rotated for 5-8
+        if orientation in (5, 6, 7, 8):
+            w, h = h, w
+        size = _fit(img.width, img.height, w, h)
+
+        source = img
+        if size != img.size:
+            preview = _exif_preview(img, size)
+            if preview is not None:
+                source = preview
+            # thumbnail() drafts to size * reducing_gap before resampling
+            source.thumbnail(size, reducing_gap=2.0)
+        else:
+            source.load()
+
+        transpose = ORIENTATION_TRANSPOSE.get(orientation)
+        # Copy (or transpose) before the file is closed
+        return source.transpose(transpose) if transpose is not None else source.copy()
+
+
+# ---------------------------------------------------------
+# Video Frames (ffmpeg)
+# ---------------------------------------------------------
+POSTER_SEEK_SECONDS = 1.0
+FFMPEG_TIMEOUT = 120
+
+# Scrub sprites: SPRITE_COLUMNS x SPRITE_ROWS evenly spaced frames; tile i
+# shows the video at duration * i / (SPRITE_COLUMNS * SPRITE_ROWS)
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+SPRITE_TILE_WIDTH = 160
+SPRITE_TIMEOUT = 600
+
+
+def is_video(path):
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+
+def _run_ffmpeg(args, timeout=FFMPEG_TIMEOUT):
+    """Runs ffmpeg writing to stdout; returns the output or None if nothing was produced."""
+    if not FFMPEG_BIN:
+        raise RuntimeError("ffmpeg is not installed")
+    result = subprocess.run(
+        [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-nostdin", *args],
+        capture_output=True, timeout=timeout
+    )
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return result.stdout
+
+
+def video_frame(path, w, h):
+    """
+    One frame near POSTER_SEEK_SECONDS, fitted into w x h. Input seeking
+    jumps to the nearest keyframe, so only a few packets are read from the
+    drive; ffmpeg applies rotation metadata itself.
+    """
+    fit = (
+        f"scale=w='min(iw,{w or 'iw'})':h='min(ih,{h or 'ih'})'"
+        ":force_original_aspect_ratio=decrease"
+    )
+    # Clips shorter than the seek offset only have a frame at 0
+    for seek in (POSTER_SEEK_SECONDS, 0):
+        data = _run_ffmpeg([
+            "-ss", str(seek), "-i", path,
+            "-an", "-frames:v", "1", "-vf", fit,
+            "-f", "image2pipe", "-c:v", "ppm", "-",
+        ])
+        if data:
+            return Image.open(io.BytesIO(data))
+    raise ValueError(f"No frame could be decoded from {path}")
+
+
+def _video_duration(path):
+    if not FFPROBE_BIN:
+        return None
+    result = subprocess.run(
+        [FFPROBE_BIN, "-v", "error", "-show_entries", "format=duration", "-of", "default=nw=1:nk=1", path],
+        capture_output=True, text=True, timeout=30
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+
+def sprite_key(path, modified_time, size):
+    return cache_key(os.path.normpath(path), modified_time, size, "sprite", SPRITE_COLUMNS, SPRITE_ROWS, SPRITE_TILE_WIDTH)
+
+
+def render_video_sprite(path):
+    """
+    Scrub sprite sheet of `path` as JPEG. Only keyframes are decoded
+    (-skip_frame nokey), which is much cheaper than decoding every frame
+    but still reads the whole file. Returns (bytes, mimetype).
+    """
+    duration = _video_duration(path)
+    if not duration:
+        raise ValueError(f"Unknown duration for {path}")
+    tiles = SPRITE_COLUMNS * SPRITE_ROWS
+    data = _run_ffmpeg([
+        "-skip_frame", "nokey", "-i", path, "-an",
+        "-vf", f"fps={tiles}/{duration:.3f},scale={SPRITE_TILE_WIDTH}:-2,tile={SPRITE_COLUMNS}x{SPRITE_ROWS}",
+        "-frames:v", "1", "-f", "image2pipe", "-c:v", "mjpeg", "-q:v", "5", "-",
+    ], timeout=SPRITE_TIMEOUT)
+    if not data:
+        raise ValueError(f"Could not build a sprite sheet for {path}")
+    return data, "image/jpeg"
+
+
+# ---------------------------------------------------------
+# Rendering
+# ---------------------------------------------------------
+def _encode(img, fmt, quality):
+    if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+        # JPEG has no alpha / palette
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+def render_thumbnail(path, w, h, q=DEFAULT_QUALITY, fmt="jpeg"):
+    """Decodes `path` fitted into w x h and encodes it. Returns (bytes, mimetype)."""
+    img = load_for_size(path, w, h)
+    return _encode(img, fmt, q), f"image/{fmt}"
+
+
+def render_gallery_thumbnails(path, formats=GALLERY_FORMATS):
+    """Every gallery format of `path` from one decode. Returns {fmt: bytes}."""
+    img = load_for_size(path, GALLERY_THUMB_SIZE, GALLERY_THUMB_SIZE)
+    return {fmt: _encode(img, fmt, DEFAULT_QUALITY) for fmt in formats}
+
+
+def display_key(path, modified_time, size):
+    return thumbnail_key(path, modified_time, size, DISPLAY_SIZE, DISPLAY_SIZE, DISPLAY_QUALITY, DISPLAY_FORMAT)
+
+
+def _gallery_keys(path, modified_time, size):
+    return {
+        fmt: thumbnail_key(path, modified_time, size, GALLERY_THUMB_SIZE, GALLERY_THUMB_SIZE, DEFAULT_QUALITY, fmt)
+        for fmt in GALLERY_FORMATS
+    }
+
+
+# ---------------------------------------------------------
+# On-Demand Rendering (bounded process pool)
+# ---------------------------------------------------------
+def _render_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class RenderBusy(Exception):
+    """Every render slot (running + queued) is taken."""
+
+
+class RenderPool:
+    """
+    Runs renders for the web server on `workers` processes, so decodes are
+    bounded in memory and CPU and don't hold the GIL of the request threads.
+    At most `queue_size` renders wait behind the running ones; further
+    submissions fail fast with RenderBusy instead of piling up. Workers are
+    started from a clean process (forkserver, or spawn where that's missing),
+    never forked from the multithreaded web server.
+    """
+
+    def __init__(self, workers, queue_size, timeout):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._in_use = 0
+        self.rejected = 0
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_render_context())
+            return self._pool
+
+    def _reset(self, pool):
+        # A worker died (e.g. killed for memory): later renders get a fresh pool
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+
+    def run(self, fn, *args):
+        """fn(*args) in a render process; raises RenderBusy when the queue is full."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise RenderBusy()
+        with self._lock:
+            self._in_use += 1
+
+        pool = self._executor()
+        try:
+            future = pool.submit(fn, *args)
+        except (BrokenProcessPool, RuntimeError):
+            self._release()
+            self._reset(pool)
+            raise
+        # The slot stays taken until the process is done, even if we stop waiting
+        future.add_done_callback(self._release)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except BrokenProcessPool:
+            self._reset(pool)
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "capacity": self.capacity,
+                "in_use": self._in_use,
+                "rejected": self.rejected,
+            }
+
+
+render_pool = RenderPool(RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_TIMEOUT)
+
+
+# ---------------------------------------------------------
+# Pre-generation (process pool)
+# ---------------------------------------------------------
+def _init_worker():
+    """Render processes run below the web server and merges."""
+    if hasattr(os, "nice"):
+        try:
+            os.nice(10)
+        except OSError:
+            pass
+
+
+def _render_gallery_job(job):
+    """
+    Decodes once, encodes every missing gallery format (plus the scrub sprite
+    of a video, listed as "sprite", and the display rendition of a photo,
+    listed as "display"). Returns (path, {fmt: bytes}) or (path, None).
+    """
+    path, formats = job
+    try:
+        renders = {}
+        if "sprite" in formats:
+            formats = tuple(fmt for fmt in formats if fmt != "sprite")
+            try:
+                renders["sprite"] = render_video_sprite(path)[0]
+            except Exception as e:  # noqa: BLE001
+                # Sprites are optional; the poster still counts
+                logger.warning(f"[THUMBS] No sprite sheet for {path}: {e}")
+        if "display" in formats:
+            formats = tuple(fmt for fmt in formats if fmt != "display")
+            img = load_for_size(path, DISPLAY_SIZE, DISPLAY_SIZE)
+            renders["display"] = _encode(img, DISPLAY_FORMAT, DISPLAY_QUALITY)
+            if formats:
+                # Thumbnails come from the display rendition: one decode of the original
+                img.thumbnail((GALLERY_THUMB_SIZE, GALLERY_THUMB_SIZE))
+                renders.update((fmt, _encode(img, fmt, DEFAULT_QUALITY)) for fmt in formats)
+        elif formats:
+            renders.update(render_gallery_thumbnails(path, formats))
+        return path, renders
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"[THUMBS] Could not render {path}: {e}")
+        return path, None
+
+
+def _missing_jobs(paths):
+    """
+    (path, missing formats, keys) for every photo/video whose gallery
+    thumbnails (and sprite, with VIDEO_SPRITES, or display rendition, with
+    DISPLAY_PREGENERATE) aren't all cached, plus the number of files that
+    could not be stat'ed.
+    """
+    candidates = []
+    unreadable = 0
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            unreadable += 1
+            continue
+        keys = _gallery_keys(path, stat.st_mtime, stat.st_size)
+        if VIDEO_SPRITES and is_video(path):
+            keys["sprite"] = sprite_key(path, stat.st_mtime, stat.st_size)
+        elif DISPLAY_PREGENERATE and not is_video(path):
+            keys["display"] = display_key(path, stat.st_mtime, stat.st_size)
+        candidates.append((path, keys))
+
+    cached = thumb_cache.existing(k for _, keys in candidates for k in keys.values())
+    jobs = []
+    for path, keys in candidates:
+        missing = tuple(fmt for fmt, key in keys.items() if key not in cached)
+        if missing:
+            jobs.append((path, missing, keys))
+    return jobs, unreadable
+
+
+def pregenerate_gallery_thumbnails(folders, workers=THUMB_WORKERS):
+    """
+    Renders the gallery thumbnails of every photo / video poster in `folders`
+    (an iterable of (folder, [paths])) that is not cached yet, folder by
+    folder, on a pool of `workers` low-priority processes. Each file is
+    decoded once for all formats. Returns per-folder coverage {folder: (cached, total)}.
+    """
+    coverage = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, mp_context=_render_context()) as pool:
+        for folder, paths in folders:
+            jobs, failed = _missing_jobs(paths)
+            keys_by_path = {path: keys for path, _, keys in jobs}
+            for path, renders in pool.map(_render_gallery_job, [(p, m) for p, m, _ in jobs], chunksize=4):
+                if renders is None:
+                    failed += 1
+                    continue
+                for fmt, data in renders.items():
+                    mimetype = {"sprite": "image/jpeg", "display": f"image/{DISPLAY_FORMAT}"}.get(fmt, f"image/{fmt}")
+                    thumb_cache.put(keys_by_path[path][fmt], data, mimetype)
+            coverage[folder] = (len(paths) - failed, len(paths))
+            if jobs:
+                logger.info(
+                    f"[THUMBS] {folder}: rendered {len(jobs)} files, "
+                    f"coverage {len(paths) - failed}/{len(paths)}."
+                )
+    return coverage
+
+
+# ---------------------------------------------------------
+# Index Queries
+# ---------------------------------------------------------
+def _gallery_types_clause():
+    return f"type IN ({', '.join('?' * len(GALLERY_EXTENSIONS))})", tuple(sorted(GALLERY_EXTENSIONS))
+
+
+def gallery_media(db, root_path):
+    """(folder, [paths]) pairs below `root_path`, in gallery order within each folder."""
+    types_clause, types = _gallery_types_clause()
+    low, high = subtree_bounds(root_path)
+    rows = db.execute(
+        f"""
+        SELECT parent_path, path FROM file_index
+        WHERE is_folder = 0 AND is_media = 1 AND {types_clause}
+          AND (parent_path = ? OR (parent_path > ? AND parent_path < ?))
+        ORDER BY parent_path, sort_time DESC
+        """,
+        (*types, root_path, low, high)
+    ).fetchall()
+    folders = {}
+    for parent_path, path in rows:
+        folders.setdefault(parent_path, []).append(path)
+    return list(folders.items())
+
+
+def gallery_page_paths(db, folder, offset, limit, after=None):
+    """
+    Paths of one gallery page of `folder`, in the gallery view's order: the
+    page after keyset cursor `after` (storage_utils.encode_cursor) or at `offset`.
+    """
+    key = decode_cursor(after) if after else None
+    keyset = "AND (sort_time, id) < (?, ?)" if key else ""
+    return [r[0] for r in db.execute(
+        f"""
+        SELECT path FROM file_index
+        WHERE is_folder = 0 AND is_media = 1 AND parent_path = ? {keyset}
+        ORDER BY sort_time DESC, id DESC
+        LIMIT ? OFFSET ?
+        """,
+        (folder, *(key or ()), limit, 0 if key else offset)
+    )]
+
+
+def thumbnail_coverage(db, folder):
+    """How many photos/videos of `folder` have all gallery thumbnails cached (from the index, no disk I/O)."""
+    types_clause, types = _gallery_types_clause()
+    rows = db.execute(
+        f"""
+        SELECT path, modified_time, size FROM file_index
+        WHERE parent_path = ? AND is_folder = 0 AND is_media = 1 AND {types_clause}
+        """,
+        (folder, *types)
+    ).fetchall()
+    keys = [_gallery_keys(*row) for row in rows]
+    cached = thumb_cache.existing(k for item in keys for k in item.values())
+    covered = sum(1 for item in keys if all(k in cached for k in item.values()))
+    return {"folder": folder, "items": len(rows), "cached": covered}
+
+
+def mark_cached_thumbnails(items):
+    """
+    Sets "thumb_cached" on gallery item dicts (storage_utils._item_data) whose
+    thumbnails are cached in every gallery format (one index query, no disk I/O).
+    """
+    keys = [_gallery_keys(item["path"], item["modified_time"], item["size"]) for item in items]
+    cached = thumb_cache.existing(k for item_keys in keys for k in item_keys.values())
+    for item, item_keys in zip(items, keys):
+        item["thumb_cached"] = all(k in cached for k in item_keys.values())
+    return items
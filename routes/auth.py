@@ -2,8 +2,12 @@ import os
 import urllib.parse
 from flask import Blueprint, render_template, request, session, redirect, url_for, jsonify, current_app
 from werkzeug.security import check_password_hash, generate_password_hash
-from helpers import login_required, apology, get_db 
+from helpers import login_required, apology, get_db, get_file_index_db
 from storage_utils import get_flash_drives
+from drive_registry import remounted_drives
+from scan_state import read_progress
+from indexer import normalize_root
+from locks import DriveLock, QUEUED_LEASE_SECONDS
 import logging
 
 logger = logging.getLogger(__name__)
@@ -22,6 +26,19 @@ def index():
     except Exception as e:
         logger.error(f"Failed to get drive list or indexing status: {e}")
         return apology("Failed to get drive list or indexing status")
+
+    # A known drive that came back under another mountpoint keeps its index;
+    # the rows are rebased in the background, under the drive's lock
+    try:
+        if remounted_drives(get_file_index_db(), drives):
+            from app import redis_client
+            from celery_worker import rebase_remounted_drives
+            if redis_client:
+                rebase_remounted_drives.delay(
+                    [{"uuid": d["uuid"], "path": d["path"], "name": d["name"]} for d in drives if d.get("uuid")]
+                )
+    except Exception as e:
+        logger.error(f"Failed to queue the rebase of remounted drives: {e}")
     
     # Pass data to the template.
     return render_template(
@@ -36,7 +53,7 @@ def index():
 @login_required
 def trigger_drive_index(drive_path):
     """Triggers the background indexing task for a specific drive path."""
-    from app import redis_client, INDEX_LOCK_KEY, LOCK_EXPIRATION
+    from app import redis_client
     
     if not redis_client:
         return jsonify({"status": "error", "message": "Redis connection failed. Cannot set lock."}), 503
@@ -53,12 +70,24 @@ def trigger_drive_index(drive_path):
     # Add trailing separator if it's just a drive letter (e.g., 'E:')
     if os.path.splitdrive(path_to_index)[0] and not os.path.splitdrive(path_to_index)[1]:
         path_to_index += os.path.sep
+
+    # Optional per-drive scan concurrency (e.g. ?concurrency=2 for spinning disks)
+    concurrency = request.args.get("concurrency", type=int)
+
+    # ?mode=full forces a staged rebuild instead of an incremental sync
+    mode = request.args.get("mode", "auto")
+    if mode not in ("auto", "incremental", "full"):
+        return jsonify({"status": "error", "message": f"Invalid index mode: {mode}"}), 400
         
     # -----------------------------------------------------------------
-    # 🛑 LOCK
+    # 🛑 LOCK (per drive; other drives can be scanned at the same time)
     # -----------------------------------------------------------------
-    # Set the lock if redis_client.set returns False
-    if not redis_client.set(INDEX_LOCK_KEY, "running", nx=True, ex=LOCK_EXPIRATION):
+    # The queued lease covers the wait for a free worker; the task then
+    # switches to short, renewed leases (see locks.py)
+    path_to_index = normalize_root(path_to_index)
+    lock = DriveLock(redis_client, path_to_index)
+    token = lock.acquire(lease=QUEUED_LEASE_SECONDS)
+    if token is None:
         return jsonify({
             "status": "warning", 
             "message": "Drive is being synced in the background. Please try again later."
@@ -67,17 +96,17 @@ def trigger_drive_index(drive_path):
     try:
         # Release the lock if the path is invalid
         if not os.path.isdir(path_to_index):
-            redis_client.delete(INDEX_LOCK_KEY) # Release the lock if validation fails
+            lock.release() # Release the lock if validation fails
             return jsonify({"status": "error", "message": f"Drive not found: {path_to_index}"}), 400
 
         # Start the Celery task
         from celery_worker import index_drive_path
-        index_drive_path.delay(path_to_index)
+        index_drive_path.delay(path_to_index, concurrency=concurrency, mode=mode, lock_token=token)
         
     except Exception as e:
         # If queuing fails, we must release the lock
         logger.error(f"Failed to dispatch index task for {path_to_index}: {e}")
-        redis_client.delete(INDEX_LOCK_KEY) # Release lock
+        lock.release() # Release lock
         return jsonify({"status": "error", "message": "Failed to queue task on worker."}), 503
 
     # Success
@@ -183,11 +212,13 @@ def register():
 @auth_bp.route("/api/indexing", methods=["GET"])
 @login_required
 def indexing_status():
+    """Reports whether indexing work is queued plus live progress of each drive scan."""
     from celery_worker import is_celery_indexing
+    from app import redis_client
     
     try:
         indexing = is_celery_indexing()
-        return jsonify({"ok": True, "is_indexing": indexing})
+        return jsonify({"ok": True, "is_indexing": indexing, "scans": read_progress(redis_client)})
     except Exception as e:
         current_app.logger.exception("Failed to check indexing status")
         return jsonify({"ok": False, "error": str(e)}), 500
\ No newline at end of file
@@ -2,12 +2,21 @@ import os
 import urllib.parse
 from math import ceil
 from flask import Blueprint, render_template, request, abort, url_for, jsonify, current_app
-from helpers import login_required
-from storage_utils import list_directory_contents
+from helpers import login_required, get_file_index_db
+from storage_utils import (
+    list_directory_contents, folder_usage, directory_page, timeline_page, index_parent_path, decode_cursor,
+)
+from hashing import find_duplicates
+from search import search_files, search_available, parse_extensions
+from media_render import mark_cached_thumbnails
+from drive_registry import online_drives
 import hashlib
 
 GALLERY_PER_PAGE = 80
 FILES_PER_PAGE = 100
+DUPLICATES_PER_PAGE = 50
+SEARCH_PER_PAGE = 50
+TIMELINE_PER_PAGE = 120
 
 browse_bp = Blueprint("browse", __name__)
 
@@ -32,7 +41,12 @@ def browse_directory(view_mode):
     
     path = os.path.normpath(urllib.parse.unquote(raw_path))
     
+    # Keyset cursors (after / before / last) select the rows; page is the
+    # position shown to the user and only selects rows for bare page=N links
     page = max(int(request.args.get("page", 1)), 1)
+    after = request.args.get("after")
+    before = request.args.get("before")
+    last = request.args.get("last") == "1"
     per_page = FILES_PER_PAGE
 
     # Adjust per_page for gallery view      
@@ -42,18 +56,24 @@ def browse_directory(view_mode):
     offset = (page - 1) * per_page
     
     # Call Directory Contents Listing (DB Query) ---
-    folders, paginated_files, total_file_count, paginated_media_assets, total_media_asset_count = list_directory_contents(
+    folders, paginated_files, total_file_count, paginated_media_assets, total_media_asset_count, cursors = list_directory_contents(
         path, 
         offset=offset, 
         limit=per_page,
         view_mode=view_mode,
         # Dependency Injection for URL creation and Hashing:
         url_for_func=url_for, 
-        get_thumb_hash_func=get_thumb_hash
+        get_thumb_hash_func=get_thumb_hash,
+        after=after,
+        before=before,
+        last=last
     )
     
     total_items = total_file_count if view_mode == "files" else total_media_asset_count
     total_pages = max(1, ceil(total_items / per_page))
+    if last:
+        page = total_pages
+    page = min(page, total_pages)
     
     # Determine parent directory for navigation 
     parent_dir = os.path.normpath(os.path.dirname(path))
@@ -74,6 +94,8 @@ def browse_directory(view_mode):
         "total_media_asset_count": total_media_asset_count,
         "folders": folders,
         "per_page": per_page,
+        "prev_cursor": cursors["prev"],
+        "next_cursor": cursors["next"],
         "is_indexing": is_celery_indexing(),
     }
     
@@ -81,11 +103,187 @@ def browse_directory(view_mode):
     if view_mode == "files":
         context[asset_list_key] = paginated_files
     else: # gallery mode
-        context[asset_list_key] = paginated_media_assets
+        # Tiles whose thumbnails are cached point straight at their (browser-cacheable) URLs
+        context[asset_list_key] = mark_cached_thumbnails(paginated_media_assets)
 
     # Render the single template
     return render_template("browse/browse.html", **context)
 
+@browse_bp.route("/api/browse/<view_mode>")
+@login_required
+def browse_items(view_mode):
+    """
+    The next page of a folder's files or media for infinite scroll: only the
+    rows after the `after` cursor as file cards / gallery tiles (the same
+    partials as the page), plus the next page's URL. No folders, counts or layout.
+    """
+    if view_mode not in ("files", "gallery"):
+        abort(404, f"Invalid view mode: {view_mode}")
+    raw_path = request.args.get("path")
+    if not raw_path:
+        return jsonify({"ok": False, "error": "path is required"}), 400
+    after = request.args.get("after")
+    cursor = decode_cursor(after) if after else None
+    if after and cursor is None:
+        return jsonify({"ok": False, "error": "Invalid cursor"}), 400
+    per_page = GALLERY_PER_PAGE if view_mode == "gallery" else FILES_PER_PAGE
+    limit = min(max(request.args.get("limit", per_page, type=int), 1), 500)
+
+    try:
+        items, _, next_cursor = directory_page(
+            get_file_index_db(), index_parent_path(raw_path), view_mode, limit, url_for, after=cursor
+        )
+        if view_mode == "gallery":
+            mark_cached_thumbnails(items)
+    except Exception as e:
+        current_app.logger.exception("Failed to page folder contents")
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+    next_url = url_for(
+        "browse.browse_items", view_mode=view_mode, path=raw_path, after=next_cursor, limit=request.args.get("limit")
+    ) if next_cursor else None
+    return jsonify({
+        "ok": True,
+        "next": next_cursor,
+        "next_url": next_url,
+        "count": len(items),
+        "html": render_template("browse/_browse_items.html", items=items, view_mode=view_mode),
+    })
+
+@browse_bp.route("/timeline")
+@login_required
+def timeline():
+    """Every photo and video of one drive (or of all drives), newest first, grouped by month."""
+    drive = request.args.get("drive") or None
+    after = request.args.get("after")
+    db = get_file_index_db()
+
+    drives = online_drives(db)
+
+    items, next_cursor = timeline_page(
+        db, url_for, [d[0] for d in drives], drive=drive, limit=TIMELINE_PER_PAGE,
+        after=decode_cursor(after) if after else None
+    )
+    mark_cached_thumbnails(items)
+
+    return render_template(
+        "browse/timeline.html",
+        assets=items,
+        drive=drive,
+        drives=drives,
+        next_cursor=next_cursor,
+    )
+
+@browse_bp.route("/api/timeline")
+@login_required
+def timeline_items():
+    """The next page of the timeline for infinite scroll: its tiles as HTML, plus the next page's URL."""
+    drive = request.args.get("drive") or None
+    after = request.args.get("after")
+    cursor = decode_cursor(after) if after else None
+    if after and cursor is None:
+        return jsonify({"ok": False, "error": "Invalid cursor"}), 400
+    limit = min(max(request.args.get("limit", TIMELINE_PER_PAGE, type=int), 1), 500)
+
+    try:
+        db = get_file_index_db()
+        online = [d[0] for d in online_drives(db)]
+        items, next_cursor = timeline_page(db, url_for, online, drive=drive, limit=limit, after=cursor)
+        mark_cached_thumbnails(items)
+    except Exception as e:
+        current_app.logger.exception("Failed to page the timeline")
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+    next_url = url_for(
+        "browse.timeline_items", drive=drive, after=next_cursor, month=items[-1]["month"],
+        limit=request.args.get("limit")
+    ) if next_cursor else None
+    return jsonify({
+        "ok": True,
+        "next": next_cursor,
+        "next_url": next_url,
+        "count": len(items),
+        # `month` (of the tile before this page) avoids repeating its heading
+        "html": render_template("browse/_timeline_tiles.html", assets=items, month=request.args.get("month")),
+    })
+
+@browse_bp.route("/api/duplicates")
+@login_required
+def duplicates():
+    """Groups of identical files across all drives, largest wasted space first."""
+    limit = min(max(request.args.get("limit", DUPLICATES_PER_PAGE, type=int), 1), 500)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    min_size = max(request.args.get("min_size", 0, type=int), 0)
+
+    try:
+        groups, total = find_duplicates(get_file_index_db(), limit=limit, offset=offset, min_size=min_size)
+    except Exception as e:
+        current_app.logger.exception("Failed to query duplicates")
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+    return jsonify({
+        "ok": True,
+        "total_groups": total,
+        "limit": limit,
+        "offset": offset,
+        "groups": groups,
+    })
+
+@browse_bp.route("/api/search")
+@login_required
+def search():
+    """Files and folders whose name (or path, with field=path) contains every term of `q`."""
+    limit = min(max(request.args.get("limit", SEARCH_PER_PAGE, type=int), 1), 500)
+    within = request.args.get("path")
+    db = get_file_index_db()
+    if not search_available(db):
+        return jsonify({"ok": False, "error": "Search needs SQLite 3.34+ with FTS5"}), 503
+
+    try:
+        results, next_id = search_files(
+            db,
+            request.args.get("q", ""),
+            field=request.args.get("field", "name"),
+            kind=request.args.get("type") or None,
+            extensions=parse_extensions(request.args.get("ext")),
+            drive=request.args.get("drive") or None,
+            within=os.path.normpath(within) if within else None,
+            limit=limit,
+            after=request.args.get("after", type=int),
+        )
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    except Exception as e:
+        current_app.logger.exception("Search failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+    return jsonify({
+        "ok": True,
+        "limit": limit,
+        "next": next_id,
+        "results": results,
+    })
+
+@browse_bp.route("/api/usage")
+@login_required
+def usage():
+    """Disk usage of a folder and of each of its subfolders (largest first), from folder_stats."""
+    path = request.args.get("path", "")
+    if not path:
+        return jsonify({"ok": False, "error": "path is required"}), 400
+    limit = request.args.get("limit", type=int)
+
+    try:
+        result = folder_usage(get_file_index_db(), os.path.normpath(path),
+                              limit=max(limit, 1) if limit is not None else None)
+    except Exception as e:
+        current_app.logger.exception("Failed to query folder usage")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    if result is None:
+        return jsonify({"ok": False, "error": "Folder is not indexed"}), 404
+
+    return jsonify({"ok": True, **result})
+
 def get_thumb_hash(src: str) -> str:
     """Generates a unique, safe filename (SHA1 hash) based on the source file's full path."""
     # Use the full, normalized path as the unique key
@@ -1,14 +1,128 @@
 import os, io
-from flask import Blueprint, send_file, abort, request
-from helpers import login_required
-from PIL import Image, ImageOps
-from pillow_heif import register_heif_opener
+import json
+import logging
+import struct
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Blueprint, send_file, abort, request, jsonify, current_app, stream_with_context
+from helpers import login_required, get_file_index_db
+from disk_cache import thumb_cache, thumbnail_key, media_version
+from media_render import (
+    render_thumbnail, sprite_key, is_video, thumbnail_coverage, DEFAULT_QUALITY,
+    render_pool, RenderBusy, gallery_page_paths, GALLERY_THUMB_SIZE, GALLERY_FORMATS, _gallery_keys,
+    render_gallery_thumbnails, DISPLAY_SIZE, DISPLAY_QUALITY, DISPLAY_FORMAT,
+)
+from singleflight import SingleFlight
+from video_stream import (
+    video_duration, playlist, segment_count, get_segment, SEGMENT_MIMETYPE, PLAYLIST_MIMETYPE,
+)
+from config import FFMPEG_BIN, RENDER_RETRY_AFTER, RENDER_BUSY_FALLBACK, RENDER_WORKERS
 import urllib.parse
 
-# Add HEIC support
-register_heif_opener()
-
 media_bp = Blueprint("media", __name__)
+logger = logging.getLogger(__name__)
+
+# --- Cache Policy ---
+# Versioned URLs (?v= matching the file) never change content; anything else
+# is revalidated with ETag / Last-Modified on every use
+IMMUTABLE = "private, max-age=31536000, immutable"
+REVALIDATE = "private, no-cache"
+
+# Identical renders requested concurrently from this server process (repeat
+# tabs, several devices) share one decode of the original. Coalescing is
+# per-process: Celery pre-generation or another server worker may still
+# render the same key, and the cache keeps whichever write lands last
+render_flight = SingleFlight("RENDER", wait_timeout=120)
+
+# --- Batch Thumbnails ---
+BATCH_MAX_ITEMS = 200
+BATCH_MIMETYPE = "application/x-nestbox-thumbs"
+
+
+def _indexed_identity(full_path):
+    """(modified_time, size) as indexed, without touching the drive; None if not indexed."""
+    row = get_file_index_db().execute(
+        "SELECT modified_time, size FROM file_index WHERE path = ? AND is_folder = 0", (full_path,)
+    ).fetchone()
+    if row is None or row[0] is None or row[1] is None:
+        return None
+    return row[0], row[1]
+
+
+def _cache_control(modified_time, size):
+    return IMMUTABLE if request.args.get("v") == media_version(modified_time, size) else REVALIDATE
+
+
+def _not_modified(etag, modified_time, cache_control):
+    """A 304 response if the client's copy (If-None-Match / If-Modified-Since) is current."""
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif request.if_modified_since:
+        fresh = int(modified_time) <= request.if_modified_since.timestamp()
+    else:
+        fresh = False
+    if not fresh:
+        return None
+
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def _store(key, data, mimetype):
+    try:
+        thumb_cache.put(key, data, mimetype)
+    except Exception as e:
+        # Serving the rendition matters more than caching it
+        logger.warning(f"[THUMBS] Could not cache {key}: {e}")
+
+
+def _render_cached(key, fn, *args):
+    """
+    fn(*args) -> (bytes, mimetype) on the render pool, once for all concurrent
+    requests of `key`, stored in the thumbnail cache. Raises RenderBusy.
+    """
+    def render():
+        rendered = render_pool.run(fn, *args)
+        _store(key, *rendered)
+        return rendered
+
+    return render_flight.do(key, render)[0]
+
+
+def _render_gallery_cached(path, keys, fmt):
+    """
+    The `fmt` gallery thumbnail of `path` as (bytes, mimetype). Every gallery
+    format is rendered from the one decode and cached, so the next view of
+    the tile uses its plain (browser-cacheable) URLs. Raises RenderBusy.
+    """
+    def render():
+        renders = render_pool.run(render_gallery_thumbnails, path)
+        for rendered_fmt, data in renders.items():
+            _store(keys[rendered_fmt], data, f"image/{rendered_fmt}")
+        return renders[fmt], f"image/{fmt}"
+
+    return render_flight.do(keys[fmt], render)[0]
+
+
+def _render_busy(fallback=RENDER_BUSY_FALLBACK):
+    """Render queue full: the default thumbnail, or 503 so the browser retries later."""
+    if fallback:
+        response = send_file(os.path.join(current_app.static_folder, "default_thumb.png"))
+    else:
+        response = current_app.response_class("Render queue full", status=503, mimetype="text/plain")
+        response.headers["Retry-After"] = str(RENDER_RETRY_AFTER)
+    # Never let the stand-in replace the real rendition in a cache
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+def _with_validators(response, etag, modified_time, cache_control):
+    response.set_etag(etag)
+    response.last_modified = modified_time
+    response.headers["Cache-Control"] = cache_control
+    return response
+
 
 @media_bp.route("/media/<path:path>")
 @login_required
@@ -34,42 +148,304 @@ def serve_media(path):
     # if os.name != "nt" and not full_path.startswith("/Volumes/"):
     #     return abort(400)
 
-    # Ensure file exists
-    if not os.path.exists(full_path) or not os.path.isfile(full_path):
-        return abort(404)
-
     # Query parameters (Imgproxy-style)
     w = request.args.get("w", type=int)
     h = request.args.get("h", type=int)
-    q = request.args.get("q", type=int, default=95)
+    q = request.args.get("q", type=int, default=DEFAULT_QUALITY)
     f = request.args.get("fmt", default="jpeg").lower()
 
-    # If NO resizing parameters → serve original file
-    if not w and not h:
-        return send_file(full_path)
+    # ?rendition=display → screen-sized web-format rendition for full-screen
+    # previews (videos stream their original)
+    if request.args.get("rendition") == "display" and not is_video(full_path):
+        w = h = DISPLAY_SIZE
+        q = DISPLAY_QUALITY
+        f = DISPLAY_FORMAT
+
+    # ?sprite=1 → scrub sprite sheet of a video (pre-rendered with VIDEO_SPRITES only)
+    sprite = request.args.get("sprite", type=int) == 1 and is_video(full_path)
+    original = not w and not h and not sprite
+    # ?download=1 → the original as an attachment
+    download = original and request.args.get("download", type=int) == 1
+
+    def etag_for(modified_time, size):
+        if download:
+            return media_version(modified_time, size) + "-dl"
+        if original:
+            return media_version(modified_time, size)
+        if sprite:
+            return sprite_key(full_path, modified_time, size)
+        return thumbnail_key(full_path, modified_time, size, w, h, q, f)
+
+    # Revalidation against the index: a browser's cached copy is confirmed
+    # without touching the drive
+    indexed = _indexed_identity(full_path)
+    if indexed:
+        not_modified = _not_modified(etag_for(*indexed), indexed[0], _cache_control(*indexed))
+        if not_modified:
+            return not_modified
+
+    # Ensure file exists
+    if not os.path.exists(full_path) or not os.path.isfile(full_path):
+        return abort(404)
+
+    stat = os.stat(full_path)
+    etag = etag_for(stat.st_mtime, stat.st_size)
+    cache_control = _cache_control(stat.st_mtime, stat.st_size)
+
+    # If NO resizing parameters → serve original file (Range requests included)
+    if original:
+        response = send_file(
+            full_path, etag=etag, last_modified=stat.st_mtime, conditional=True,
+            as_attachment=download, download_name=os.path.basename(full_path)
+        )
+        response.headers["Cache-Control"] = cache_control
+        return response
+
+    # Video posters/sprites need ffmpeg; the grid falls back to the default thumbnail
+    if is_video(full_path) and not FFMPEG_BIN:
+        return abort(404)
+
+    not_modified = _not_modified(etag, stat.st_mtime, cache_control)
+    if not_modified:
+        return not_modified
 
-    # Otherwise serve resized file
+    # Resized renditions are cached on disk, keyed by the source file's
+    # identity (path + mtime + size) and the render options; the key doubles as ETag
+    key = etag
+    cached = thumb_cache.get(key)
+    if cached:
+        cached_path, mimetype = cached
+        try:
+            # Open now: an entry evicted after this point stays readable
+            response = send_file(open(cached_path, "rb"), mimetype=mimetype, as_attachment=False)
+            return _with_validators(response, etag, stat.st_mtime, cache_control)
+        except OSError:
+            pass
+
+    # Sprites decode the whole video: too slow to hold a request for, so a
+    # sheet pre-generation hasn't made yet is simply not there
+    if sprite:
+        return abort(404)
+
+    # Otherwise render the resized file, once for all concurrent identical requests
     try:
-        # Open image
-        with Image.open(full_path) as img:
-            # Img orientation
-            img = ImageOps.exif_transpose(img)
-
-            # Resize if needed
-            if w or h:
-                img.thumbnail((w or img.width, h or img.height))
-
-            # Save to buffer
-            buf = io.BytesIO()
-            img.save(buf, format=f, quality=q, optimize=True)
-            buf.seek(0)
-
-            # Return file
-            return send_file(
-                buf,
-                mimetype=f"image/{f}",
-                as_attachment=False
-            )
+        data, mimetype = _render_cached(key, render_thumbnail, full_path, w, h, q, f)
+    except RenderBusy:
+        return _render_busy()
     except Exception as e:
         print("IMAGE ERROR:", e)
-        return abort(500)
\ No newline at end of file
+        return abort(500)
+
+    # Return file
+    response = send_file(
+        io.BytesIO(data),
+        mimetype=mimetype,
+        as_attachment=False
+    )
+    return _with_validators(response, etag, stat.st_mtime, cache_control)
+
+
+def _stream_source():
+    """(full path, stat) of the ?path= video of an HLS request, aborting if it can't be streamed."""
+    raw_path = request.args.get("path")
+    if not raw_path:
+        abort(400)
+    full_path = os.path.normpath(urllib.parse.unquote(raw_path))
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        abort(404)
+    if not (FFMPEG_BIN and is_video(full_path)):
+        abort(404)
+    return full_path, stat
+
+
+@media_bp.route("/hls/playlist.m3u8")
+@login_required
+def hls_playlist():
+    """HLS playlist of a video (see video_stream.py); segments are rendered when requested."""
+    full_path, stat = _stream_source()
+    duration = video_duration(full_path, stat.st_mtime, stat.st_size)
+    if not duration:
+        return abort(415)
+
+    etag = media_version(stat.st_mtime, stat.st_size) + "-hls"
+    cache_control = _cache_control(stat.st_mtime, stat.st_size)
+    not_modified = _not_modified(etag, stat.st_mtime, cache_control)
+    if not_modified:
+        return not_modified
+
+    response = current_app.response_class(
+        playlist(full_path, media_version(stat.st_mtime, stat.st_size), duration), mimetype=PLAYLIST_MIMETYPE
+    )
+    return _with_validators(response, etag, stat.st_mtime, cache_control)
+
+
+@media_bp.route("/hls/<int:index>.ts")
+@login_required
+def hls_segment(index):
+    full_path, stat = _stream_source()
+    duration = video_duration(full_path, stat.st_mtime, stat.st_size)
+    count = segment_count(duration) if duration else 0
+    if index >= count:
+        return abort(404)
+
+    etag = f"{media_version(stat.st_mtime, stat.st_size)}-hls-{index}"
+    cache_control = _cache_control(stat.st_mtime, stat.st_size)
+    not_modified = _not_modified(etag, stat.st_mtime, cache_control)
+    if not_modified:
+        return not_modified
+
+    try:
+        cached_path, data = get_segment(full_path, stat.st_mtime, stat.st_size, index, count)
+    except RenderBusy:
+        return _render_busy(fallback=False)
+    except Exception:
+        logger.exception(f"[HLS] Segment {index} of {full_path} failed")
+        return abort(500)
+
+    if cached_path:
+        try:
+            response = send_file(open(cached_path, "rb"), mimetype=SEGMENT_MIMETYPE)
+        except OSError:
+            return abort(500)
+    else:
+        response = send_file(io.BytesIO(data), mimetype=SEGMENT_MIMETYPE)
+    return _with_validators(response, etag, stat.st_mtime, cache_control)
+
+
+def _frame(header, body=b""):
+    """One item of a batch stream: u32 header length, JSON header, u32 body length, body."""
+    header = json.dumps(header).encode("utf-8")
+    return struct.pack(">I", len(header)) + header + struct.pack(">I", len(body)) + body
+
+
+@media_bp.route("/api/thumbnails/batch", methods=["POST"])
+@login_required
+def thumbnails_batch():
+    """
+    Thumbnails of the gallery tiles a page could not point at cached URLs, in
+    one response. Takes JSON with either "paths" or "folder" + "page" / "after"
+    (gallery pagination), plus optional "size" (the gallery size) and "fmt"
+    (one of GALLERY_FORMATS). Streams one length-prefixed frame per item (see
+    _frame), cached thumbnails first; the header's "i" is the item's index in
+    the request and "status" is ok / busy / error / missing. Busy and failed
+    items can be fetched individually from /media/.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"ok": False, "error": "Expected a JSON object"}), 400
+    fmt = str(payload.get("fmt") or "webp").lower()
+    if fmt not in GALLERY_FORMATS:
+        return jsonify({"ok": False, "error": f"fmt must be one of {', '.join(GALLERY_FORMATS)}"}), 400
+    if payload.get("size") not in (None, GALLERY_THUMB_SIZE, str(GALLERY_THUMB_SIZE)):
+        return jsonify({"ok": False, "error": f"size must be {GALLERY_THUMB_SIZE}"}), 400
+
+    if payload.get("paths") is not None:
+        if not isinstance(payload["paths"], list) or not all(isinstance(p, str) for p in payload["paths"]):
+            return jsonify({"ok": False, "error": "paths must be a list of strings"}), 400
+        paths = [os.path.normpath(p) for p in payload["paths"]]
+    elif payload.get("folder"):
+        from routes.browse import GALLERY_PER_PAGE
+        try:
+            page = max(int(payload.get("page") or 1), 1)
+        except (TypeError, ValueError):
+            return jsonify({"ok": False, "error": "page must be a number"}), 400
+        paths = gallery_page_paths(
+            get_file_index_db(), os.path.normpath(str(payload["folder"])), (page - 1) * GALLERY_PER_PAGE,
+            GALLERY_PER_PAGE, after=payload.get("after")
+        )
+    else:
+        return jsonify({"ok": False, "error": "Missing paths or folder"}), 400
+
+    if len(paths) > BATCH_MAX_ITEMS:
+        return jsonify({"ok": False, "error": f"At most {BATCH_MAX_ITEMS} items per batch"}), 400
+
+    # Split into cache hits and renders before streaming; an item counts as
+    # cached only with every gallery format, else it is rendered in all of them
+    items = []
+    for i, path in enumerate(paths):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            items.append((i, path, None))
+            continue
+        items.append((i, path, _gallery_keys(path, stat.st_mtime, stat.st_size)))
+    cached_keys = thumb_cache.existing(k for _, _, keys in items if keys for k in keys.values())
+
+    hits, misses = [], []
+    for i, path, keys in items:
+        if keys is None:
+            hits.append((i, path, None))
+        elif all(k in cached_keys for k in keys.values()):
+            hits.append((i, path, thumb_cache.get(keys[fmt])))
+        elif is_video(path) and not FFMPEG_BIN:
+            hits.append((i, path, None))
+        else:
+            misses.append((i, path, keys))
+
+    def generate():
+        for i, path, cached in hits:
+            if cached is None:
+                yield _frame({"i": i, "path": path, "status": "missing"})
+                continue
+            cached_path, mimetype = cached
+            try:
+                with open(cached_path, "rb") as fh:
+                    yield _frame({"i": i, "path": path, "status": "ok", "type": mimetype}, fh.read())
+            except OSError:
+                yield _frame({"i": i, "path": path, "status": "missing"})
+
+        if not misses:
+            return
+        # Renders run concurrently, one thread per render process; frames go
+        # out in completion order
+        with ThreadPoolExecutor(max_workers=RENDER_WORKERS) as threads:
+            futures = {
+                threads.submit(_render_gallery_cached, path, keys, fmt): (i, path)
+                for i, path, keys in misses
+            }
+            for future in as_completed(futures):
+                i, path = futures[future]
+                try:
+                    data, mimetype = future.result()
+                except RenderBusy:
+                    yield _frame({"i": i, "path": path, "status": "busy"})
+                    continue
+                except Exception as e:
+                    logger.warning(f"[THUMBS] Batch render of {path} failed: {e}")
+                    yield _frame({"i": i, "path": path, "status": "error"})
+                    continue
+                yield _frame({"i": i, "path": path, "status": "ok", "type": mimetype}, data)
+
+    response = current_app.response_class(stream_with_context(generate()), mimetype=BATCH_MIMETYPE)
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Batch-Items"] = str(len(paths))
+    return response
+
+
+@media_bp.route("/api/thumbnails/coverage")
+@login_required
+def thumbnails_coverage():
+    """How many photos of a folder already have their gallery thumbnails pre-rendered."""
+    raw_path = request.args.get("path")
+    if not raw_path:
+        return jsonify({"ok": False, "error": "Missing path"}), 400
+
+    try:
+        coverage = thumbnail_coverage(get_file_index_db(), os.path.normpath(urllib.parse.unquote(raw_path)))
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+    return jsonify({"ok": True, **coverage})
+
+
+@media_bp.route("/api/thumbnails/stats")
+@login_required
+def thumbnails_stats():
+    """Render coalescing, render pool and thumbnail cache counters."""
+    return jsonify({
+        "ok": True,
+        "render": render_flight.stats(),
+        "pool": render_pool.stats(),
+        "cache": thumb_cache.stats(),
+    })
@@ -39,11 +39,49 @@ celery_proc = subprocess.Popen(
         "worker",
         "-l", "info",
         "--pool=threads",
-        "--concurrency=3"
+        "--concurrency=3",
+        "-Q", "celery",
+        "-n", "main@%h",
     ],
     env=env_with_venv()
 )
 
+# Start the drive-scan worker (one thread per drive scanned in parallel)
+index_proc = subprocess.Popen(
+    [
+        VENV_PYTHON, "-m", "celery",
+        "-A", "app.celery",
+        "worker",
+        "-l", "info",
+        "--pool=threads",
+        "--concurrency=4",
+        "-Q", "indexing",
+        "-n", "indexing@%h",
+    ],
+    env=env_with_venv()
+)
+
+# Start the thumbnail worker (one task at a time; renders on its own process pool)
+thumbs_proc = subprocess.Popen(
+    [
+        VENV_PYTHON, "-m", "celery",
+        "-A", "app.celery",
+        "worker",
+        "-l", "info",
+        "--pool=threads",
+        "--concurrency=1",
+        "-Q", "thumbs",
+        "-n", "thumbs@%h",
+    ],
+    env=env_with_venv()
+)
+
+# Start the index watcher (live updates for indexed drives)
+watcher_proc = subprocess.Popen(
+    [VENV_PYTHON, "watcher.py"],
+    env=env_with_venv()
+)
+
 # Start Flask
 flask_proc = subprocess.Popen(
     [VENV_PYTHON, "app.py"],
@@ -62,11 +100,17 @@ except KeyboardInterrupt:
     # TERM on Unix, CTRL_BREAK_EVENT on Windows for structured kill
     if platform.system() == "Windows":
         flask_proc.send_signal(signal.CTRL_BREAK_EVENT)
+        watcher_proc.send_signal(signal.CTRL_BREAK_EVENT)
         celery_proc.send_signal(signal.CTRL_BREAK_EVENT)
+        index_proc.send_signal(signal.CTRL_BREAK_EVENT)
+        thumbs_proc.send_signal(signal.CTRL_BREAK_EVENT)
         redis_proc.send_signal(signal.CTRL_BREAK_EVENT)
     else:
         flask_proc.terminate()
+        watcher_proc.terminate()
         celery_proc.terminate()
+        index_proc.terminate()
+        thumbs_proc.terminate()
         redis_proc.terminate()
 
     time.sleep(1)
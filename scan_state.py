@@ -0,0 +1,308 @@
+# scan_state.py
+
+import json
+import time
+import logging
+from indexer import subtree_bounds
+from locks import LockLostError
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_KEY_PREFIX = "index_progress:"
+PROGRESS_TTL = 24 * 3600          # progress of a running scan (refreshed on every publish)
+FINISHED_PROGRESS_TTL = 10 * 60   # keep the final numbers around for the dashboard
+PROGRESS_INTERVAL = 2.0           # seconds between Redis progress publishes
+
+# Checkpoint statuses a later run picks up: "running" (the worker died) and
+# "interrupted" (the scan failed and said so)
+RESUMABLE_STATUSES = ("running", "interrupted")
+
+
+# ---------------------------------------------------------
+# Persisted Checkpoint (file_index.db)
+# ---------------------------------------------------------
+def _newer_claim(db, drive_id, fence):
+    """Whether a root on drive `drive_id` was claimed with a token newer than `fence`."""
+    if drive_id is None:
+        return False
+    return db.execute(
+        "SELECT 1 FROM scan_checkpoints WHERE drive_id = ? AND fence > ? LIMIT 1", (drive_id, fence)
+    ).fetchone() is not None
+
+
+class DriveFence:
+    """
+    Fencing for writers that hold a drive lease but keep no checkpoint (the
+    watcher). Passed to BatchWriter as its `checkpoint`: every batch commit
+    fails with LockLostError once a scan with a newer token has claimed any
+    root of the drive. The check runs after the batch's writes, so the
+    transaction already holds the write lock and no claim can slip in before
+    the commit.
+    """
+
+    pending = 0
+
+    def __init__(self, db, drive_id, fence):
+        self.db = db
+        self.drive_id = drive_id
+        self.fence = fence
+
+    def persist(self):
+        if _newer_claim(self.db, self.drive_id, self.fence):
+            raise LockLostError(f"A newer scan claimed drive {self.drive_id} (token {self.fence} is stale)")
+
+
+class ScanCheckpoint:
+    """
+    Resumable cursor for one drive scan, stored next to the index it describes.
+
+    A folder is recorded as finished in the same transaction that writes its
+    rows (see BatchWriter.flush), so after a crash every folder in
+    scan_finished_dirs is guaranteed to be fully reflected in the target table
+    and can be skipped on resume.
+    """
+
+    def __init__(self, db, root_path):
+        self.db = db
+        self.root_path = root_path
+        self.fence = None
+        self.drive_id = None
+        self.mode = None
+        self.resumed = False
+        self.dirs_done = 0
+        self.files_done = 0
+        self.estimated_total = None
+        self.finished_dirs = set()
+        self._pending_dirs = []
+
+    def claim(self, fence, drive_id=None):
+        """
+        Registers `fence` (a token of drive `drive_id`, see locks.DriveLock)
+        as the token allowed to write this root. Fails with LockLostError if
+        a scan with a newer token has already claimed this root or any other
+        root on the same drive.
+        """
+        if _newer_claim(self.db, drive_id, fence):
+            raise LockLostError(f"{self.root_path} is on a drive claimed by a newer scan")
+        cur = self.db.execute(
+            """
+            INSERT INTO scan_checkpoints (root_path, mode, status, fence, drive_id)
+            VALUES (?, 'auto', 'new', ?, ?)
+            ON CONFLICT(root_path) DO UPDATE SET fence = excluded.fence, drive_id = excluded.drive_id
+            WHERE scan_checkpoints.fence IS NULL OR scan_checkpoints.drive_id IS NOT excluded.drive_id
+               OR scan_checkpoints.fence <= excluded.fence
+            """,
+            (self.root_path, fence, drive_id)
+        )
+        self.db.commit()
+        if cur.rowcount != 1:
+            raise LockLostError(f"{self.root_path} was claimed by a newer scan")
+        self.fence = fence
+        self.drive_id = drive_id
+
+    def verify_fence(self):
+        """
+        Inside the caller's transaction: abort unless our token is still the
+        current one. Done as an UPDATE so the check takes the write lock and
+        no newer scan can claim the root between the check and the commit.
+        """
+        if self.fence is None:
+            return
+        cur = self.db.execute(
+            "UPDATE scan_checkpoints SET updated_at = ? WHERE root_path = ? AND fence = ?",
+            (time.time(), self.root_path, self.fence)
+        )
+        if cur.rowcount != 1 or _newer_claim(self.db, self.drive_id, self.fence):
+            raise LockLostError(f"{self.root_path} was claimed by a newer scan (token {self.fence} is stale)")
+
+    def load(self, mode):
+        """
+        Picks up an unfinished scan of `mode` ("auto" accepts any mode).
+        Returns True when resuming; otherwise call start().
+        """
+        row = self.db.execute(
+            """
+            SELECT mode, status, dirs_done, files_done, last_total
+            FROM scan_checkpoints WHERE root_path = ?
+            """,
+            (self.root_path,)
+        ).fetchone()
+        self.estimated_total = row[4] if row else None
+
+        if not row or row[1] not in RESUMABLE_STATUSES or (mode != "auto" and row[0] != mode):
+            return False
+
+        if row[1] != "running":
+            self.db.execute(
+                "UPDATE scan_checkpoints SET status = 'running', updated_at = ? WHERE root_path = ?",
+                (time.time(), self.root_path)
+            )
+            self.db.commit()
+        self.mode = row[0]
+        self.resumed = True
+        self.dirs_done, self.files_done = row[2], row[3]
+        self.finished_dirs = {
+            r[0] for r in self.db.execute(
+                "SELECT path FROM scan_finished_dirs WHERE root_path = ?", (self.root_path,)
+            )
+        }
+        logger.info(
+            f"[RESUME] {self.root_path}: {len(self.finished_dirs)} folders / "
+            f"{self.files_done} files already done ({self.mode} scan)."
+        )
+        return True
+
+    def start(self, mode, estimated_total=None):
+        """Opens a fresh checkpoint, discarding any earlier one for this root."""
+        self.mode = mode
+        if self.estimated_total is None:
+            self.estimated_total = estimated_total
+        now = time.time()
+        self.db.execute("DELETE FROM scan_finished_dirs WHERE root_path = ?", (self.root_path,))
+        self.db.execute(
+            """
+            INSERT INTO scan_checkpoints (root_path, mode, status, started_at, updated_at, dirs_done, files_done, last_total)
+            VALUES (?, ?, 'running', ?, ?, 0, 0, ?)
+            ON CONFLICT(root_path) DO UPDATE SET
+                mode = excluded.mode, status = 'running', started_at = excluded.started_at,
+                updated_at = excluded.updated_at, dirs_done = 0, files_done = 0,
+                last_total = excluded.last_total
+            """,
+            (self.root_path, mode, now, now, self.estimated_total)
+        )
+        self.db.commit()
+
+    def mark_done(self, dir_path, file_count):
+        """Queues a folder as finished; written by persist() with its rows."""
+        self._pending_dirs.append((self.root_path, dir_path))
+        self.dirs_done += 1
+        self.files_done += file_count
+
+    @property
+    def pending(self):
+        return len(self._pending_dirs)
+
+    def persist(self):
+        """Writes queued folders and counters (caller commits). Fenced: see verify_fence()."""
+        self.verify_fence()
+        if self._pending_dirs:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO scan_finished_dirs (root_path, path) VALUES (?, ?)",
+                self._pending_dirs
+            )
+            self._pending_dirs.clear()
+        self.db.execute(
+            "UPDATE scan_checkpoints SET dirs_done = ?, files_done = ?, updated_at = ? WHERE root_path = ?",
+            (self.dirs_done, self.files_done, time.time(), self.root_path)
+        )
+
+    def finish(self, status="complete"):
+        """Closes the checkpoint; the finished-folder list is only needed while running."""
+        self.db.execute("DELETE FROM scan_finished_dirs WHERE root_path = ?", (self.root_path,))
+        if status == "complete":
+            self.db.execute(
+                "UPDATE scan_checkpoints SET status = ?, updated_at = ?, last_total = ? WHERE root_path = ?",
+                (status, time.time(), self.files_done, self.root_path)
+            )
+        else:
+            self.db.execute(
+                "UPDATE scan_checkpoints SET status = ?, updated_at = ? WHERE root_path = ?",
+                (status, time.time(), self.root_path)
+            )
+        self.db.commit()
+
+    def interrupt(self):
+        """
+        Marks a failed scan "interrupted": its finished folders are kept, so
+        the next run resumes it, but it no longer counts as running. Only
+        while our token is current; otherwise a newer scan owns the checkpoint.
+        """
+        self.db.execute(
+            """
+            UPDATE scan_checkpoints SET status = 'interrupted', updated_at = ?
+            WHERE root_path = ? AND status = 'running' AND (? IS NULL OR fence = ?)
+            """,
+            (time.time(), self.root_path, self.fence, self.fence)
+        )
+        self.db.commit()
+
+    def resume_children(self, table):
+        """
+        Maps each finished folder to its indexed sub-folders in `table`, so the
+        walker can descend through finished folders without listing them again.
+        """
+        if not self.finished_dirs:
+            return {}
+        children = {path: [] for path in self.finished_dirs}
+        low, high = subtree_bounds(self.root_path)
+        for parent_path, path in self.db.execute(
+            f"SELECT parent_path, path FROM {table} WHERE is_folder = 1 AND path > ? AND path < ?",
+            (low, high)
+        ):
+            if parent_path in children:
+                children[parent_path].append(path)
+        return children
+
+
+# ---------------------------------------------------------
+# Live Progress (Redis)
+# ---------------------------------------------------------
+class ScanProgress:
+    """Publishes throttled scan progress (counts, rate, ETA) to Redis for /api/indexing."""
+
+    def __init__(self, redis_client, checkpoint):
+        self.redis = redis_client
+        self.checkpoint = checkpoint
+        self.started_at = time.time()
+        self.start_files = checkpoint.files_done
+        self._last_publish = 0.0
+
+    def snapshot(self, status="running"):
+        cp = self.checkpoint
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        rate = (cp.files_done - self.start_files) / elapsed
+        eta = None
+        if status == "running" and cp.estimated_total and rate > 0:
+            eta = max(cp.estimated_total - cp.files_done, 0) / rate
+        return {
+            "root": cp.root_path,
+            "mode": cp.mode,
+            "status": status,
+            "resumed": cp.resumed,
+            "dirs_done": cp.dirs_done,
+            "files_done": cp.files_done,
+            "estimated_total": cp.estimated_total,
+            "rate": round(rate, 1),
+            "eta_seconds": round(eta) if eta is not None else None,
+            "started_at": self.started_at,
+            "updated_at": time.time(),
+        }
+
+    def publish(self, status="running", force=False):
+        if not self.redis:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_publish < PROGRESS_INTERVAL:
+            return
+        self._last_publish = now
+        ttl = PROGRESS_TTL if status == "running" else FINISHED_PROGRESS_TTL
+        try:
+            self.redis.set(
+                PROGRESS_KEY_PREFIX + self.checkpoint.root_path,
+                json.dumps(self.snapshot(status)),
+                ex=ttl,
+            )
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"Could not publish scan progress: {e}")
+
+
+def read_progress(redis_client):
+    """Returns the progress dicts of all running and recently finished scans."""
+    if not redis_client:
+        return []
+    scans = []
+    for key in redis_client.scan_iter(match=PROGRESS_KEY_PREFIX + "*"):
+        raw = redis_client.get(key)
+        if raw:
+            scans.append(json.loads(raw))
+    return sorted(scans, key=lambda s: s.get("started_at") or 0)
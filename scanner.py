@@ -0,0 +1,130 @@
+# scanner.py
+
+import os
+import stat as stat_module
+import time
+import logging
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from indexer import created_time_from_stat
+from config import SCAN_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# One listed folder:
+#   subdirs -> [(name, modified_time)]
+#   files   -> [(name, size, modified_time, created_time)]
+#   links   -> names of symlinked sub-folders (indexed, but not descended into)
+#   ok      -> False if the folder could not be read (its index rows must be left alone)
+DirListing = namedtuple("DirListing", "path subdirs files links ok")
+
+
+def _is_hidden_entry(entry_stat):
+    """Windows 'Hidden' attribute (e.g. System Volume Information), read from the cached stat."""
+    attrs = getattr(entry_stat, "st_file_attributes", None)
+    return attrs is not None and bool(attrs & stat_module.FILE_ATTRIBUTE_HIDDEN)
+
+
+def list_directory(path):
+    """
+    Lists one folder with os.scandir, reusing each DirEntry's stat result
+    (free on Windows, a single stat per entry on Linux) instead of a separate
+    os.stat()/getmtime() per child.
+    """
+    subdirs = []
+    files = []
+    links = set()
+
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                    entry_stat = entry.stat()
+                except OSError as e:
+                    logger.warning(f"Entry vanished during scan: {entry.path} ({e})")
+                    continue
+
+                if is_dir:
+                    if _is_hidden_entry(entry_stat):
+                        continue
+                    subdirs.append((entry.name, entry_stat.st_mtime))
+                    if entry.is_symlink():
+                        links.add(entry.name)
+                else:
+                    files.append(
+                        (entry.name, entry_stat.st_size, entry_stat.st_mtime, created_time_from_stat(entry_stat))
+                    )
+    except OSError as e:
+        logger.warning(f"Could not list folder {path}: {e}")
+        return DirListing(path, [], [], links, False)
+
+    return DirListing(path, subdirs, files, links, True)
+
+
+class ScandirWalker:
+    """
+    Walks a tree with a bounded thread pool. Each folder is listed by one
+    worker; its sub-folders are queued as soon as the listing comes back, so
+    independent subtrees are read concurrently. Listings are yielded to the
+    caller (a single thread) in completion order: a parent is always yielded
+    before any of its children.
+
+    `resume` maps folders finished by an interrupted scan to their known
+    sub-folders; those are descended into without being listed or yielded.
+    """
+
+    def __init__(self, root_path, concurrency=None, resume=None):
+        self.root_path = root_path
+        self.concurrency = max(1, concurrency or SCAN_CONCURRENCY)
+        self.resume = resume or {}
+        self.dir_count = 0
+        self.file_count = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def walk(self):
+        self.started_at = time.monotonic()
+        queue = deque([self.root_path])
+        # Keep a few listings per worker in flight so the pool never starves,
+        # without materializing a future for every folder on the drive.
+        max_in_flight = self.concurrency * 4
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="scan") as pool:
+            in_flight = set()
+            while queue or in_flight:
+                while queue and len(in_flight) < max_in_flight:
+                    path = queue.popleft()
+                    if path in self.resume:
+                        queue.extend(c for c in self.resume[path] if not os.path.islink(c))
+                        continue
+                    in_flight.add(pool.submit(list_directory, path))
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    listing = future.result()
+                    self.dir_count += 1
+                    self.file_count += len(listing.files)
+
+                    queue.extend(
+                        os.path.join(listing.path, name)
+                        for name, _ in listing.subdirs
+                        if name not in listing.links
+                    )
+
+                    yield listing
+
+        self.finished_at = time.monotonic()
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def files_per_second(self):
+        elapsed = self.elapsed
+        return round(self.file_count / elapsed, 1) if elapsed else 0.0
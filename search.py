@@ -0,0 +1,123 @@
+# search.py
+#
+# Filename search over file_search, an FTS5 table with the trigram tokenizer
+# (see helpers.init_all_dbs). Every 3-character substring of name and path is
+# indexed, so `x` anywhere in a name is an index lookup instead of a
+# `LIKE '%x%'` scan of file_index. Results come in rowid order (most recently
+# indexed first) and are paged by keyset cursor, so a page never has to rank
+# or count every match.
+
+from disk_cache import media_version
+from indexer import subtree_bounds
+from storage_utils import PHOTO_EXTENSIONS, VIDEO_EXTENSIONS
+
+TRIGRAM = 3  # shorter terms can't use the index; they only narrow longer ones
+SEARCH_FIELDS = ("name", "path")
+
+KIND_CLAUSES = {
+    "folder": ("f.is_folder = 1", ()),
+    "file": ("f.is_folder = 0", ()),
+    "media": ("f.is_folder = 0 AND f.is_media = 1", ()),
+    "photo": (f"f.is_folder = 0 AND f.type IN ({', '.join('?' * len(PHOTO_EXTENSIONS))})",
+              tuple(sorted(PHOTO_EXTENSIONS))),
+    "video": (f"f.is_folder = 0 AND f.type IN ({', '.join('?' * len(VIDEO_EXTENSIONS))})",
+              tuple(sorted(VIDEO_EXTENSIONS))),
+}
+
+
+def _fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _like_pattern(term):
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def search_available(db):
+    """Whether file_search exists (helpers._init_search skips it without FTS5 trigram support)."""
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'file_search'"
+    ).fetchone() is not None
+
+
+def search_files(db, query, field="name", kind=None, extensions=None, drive=None, within=None,
+                 limit=50, after=None):
+    """
+    Rows whose `field` ("name" or "path") contains every whitespace-separated
+    term of `query` (case-insensitive), optionally limited to a kind
+    (KIND_CLAUSES), extensions, a drive UUID or the subtree of `within`.
+    `after` is the id of the last row of the previous page. Returns
+    (rows, next id or None). Raises ValueError for unusable queries.
+    """
+    if field not in SEARCH_FIELDS:
+        raise ValueError(f"field must be one of {', '.join(SEARCH_FIELDS)}")
+    if kind is not None and kind not in KIND_CLAUSES:
+        raise ValueError(f"type must be one of {', '.join(KIND_CLAUSES)}")
+
+    terms = query.split()
+    indexed = [t for t in terms if len(t) >= TRIGRAM]
+    if not indexed:
+        raise ValueError(f"Search for at least one term of {TRIGRAM} or more characters")
+
+    where = ["file_search MATCH ?"]
+    phrases = [f"{field} : {_fts_phrase(t)}" for t in indexed]
+    if within and len(within) >= TRIGRAM:
+        # Narrows the index lookup; the range below keeps only the subtree itself
+        phrases.append(f"path : {_fts_phrase(within)}")
+    params = [" AND ".join(phrases)]
+    for term in terms:
+        if len(term) < TRIGRAM:
+            where.append(f"f.{field} LIKE ? ESCAPE '\\'")
+            params.append(_like_pattern(term))
+    if kind is not None:
+        clause, kind_params = KIND_CLAUSES[kind]
+        where.append(clause)
+        params.extend(kind_params)
+    if extensions:
+        where.append(f"f.type IN ({', '.join('?' * len(extensions))})")
+        params.extend(extensions)
+    if drive:
+        where.append("f.drive_uuid = ?")
+        params.append(drive)
+    if within:
+        where.append("(f.path = ? OR (f.path > ? AND f.path < ?))")
+        params.extend((within, *subtree_bounds(within)))
+    if after is not None:
+        where.append("file_search.rowid < ?")
+        params.append(after)
+
+    rows = db.execute(
+        f"""
+        SELECT f.id, f.name, f.path, f.parent_path, f.is_folder, f.is_media, f.size, f.modified_time,
+               f.type, f.drive_uuid
+        FROM file_search JOIN file_index AS f ON f.id = file_search.rowid
+        WHERE {" AND ".join(where)}
+        ORDER BY file_search.rowid DESC
+        LIMIT ?
+        """,
+        (*params, limit + 1)
+    ).fetchall()
+
+    results = [{
+        "name": r["name"],
+        "path": r["path"],
+        "parent_path": r["parent_path"],
+        "is_folder": bool(r["is_folder"]),
+        "is_media": bool(r["is_media"]),
+        "size": r["size"],
+        "modified_time": r["modified_time"],
+        "type": r["type"],
+        "drive_uuid": r["drive_uuid"],
+        "version": None if r["is_folder"] else media_version(r["modified_time"], r["size"]),
+    } for r in rows[:limit]]
+    next_id = rows[limit - 1]["id"] if len(rows) > limit else None
+    return results, next_id
+
+
+def parse_extensions(value):
+    """Comma-separated extensions as stored in file_index.type ("jpg, .PNG" -> [".jpg", ".png"])."""
+    return [
+        ext if ext.startswith(".") else "." + ext
+        for ext in (e.strip().lower() for e in (value or "").split(","))
+        if ext
+    ]
@@ -0,0 +1,94 @@
+# singleflight.py
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller (leader)
+    runs the work, callers arriving while it is in flight wait for and share
+    its result (or its exception) instead of repeating the work. Nothing is
+    kept once the call finishes; caching results is the caller's business.
+    """
+
+    def __init__(self, name, wait_timeout=None):
+        self.name = name
+        self.wait_timeout = wait_timeout  # seconds; a follower past this runs the work itself
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {
+            "executed": 0,     # calls that ran the work
+            "coalesced": 0,    # calls served by another call's work
+            "errors": 0,       # executed calls that raised
+            "timeouts": 0,     # followers that gave up waiting
+            "max_waiters": 0,  # most followers sharing one call
+            "busy_seconds": 0.0,
+        }
+
+    def do(self, key, fn):
+        """Runs fn() once per key at a time. Returns (result, shared)."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                call.waiters += 1
+                leader = False
+
+        if not leader:
+            if call.done.wait(self.wait_timeout):
+                with self._lock:
+                    self._stats["coalesced"] += 1
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            with self._lock:
+                self._stats["timeouts"] += 1
+            logger.warning(f"[{self.name}] Waited {self.wait_timeout}s for {key}; running it again.")
+            return self._run(fn), False
+
+        try:
+            call.result = self._run(fn)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                self._stats["max_waiters"] = max(self._stats["max_waiters"], call.waiters)
+            call.done.set()
+        return call.result, False
+
+    def _run(self, fn):
+        start = time.monotonic()
+        try:
+            return fn()
+        except BaseException:
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._stats["executed"] += 1
+                self._stats["busy_seconds"] += time.monotonic() - start
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, in_flight=len(self._calls))
+        total = stats["executed"] + stats["coalesced"]
+        stats["busy_seconds"] = round(stats["busy_seconds"], 3)
+        stats["saved_ratio"] = round(stats["coalesced"] / total, 3) if total else 0.0
+        return stats
@@ -41,7 +41,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
 				// Scan started
 				statusDiv.innerHTML = 'Scanning drive...';
-				startIndexingPoll(driveId, statusDiv, buttonElement);
+				startIndexingPoll(driveId, data.path || drivePath, statusDiv, buttonElement);
 			})
 			.catch((error) => {
 				console.error('Scanning error:', error);
@@ -50,7 +50,21 @@ document.addEventListener('DOMContentLoaded', () => {
 			});
 	}
 
-	function startIndexingPoll(driveId, statusDiv, buttonElement) {
+	function formatEta(seconds) {
+		if (seconds == null) return '';
+		if (seconds < 60) return ` · ~${seconds}s left`;
+		if (seconds < 3600) return ` · ~${Math.round(seconds / 60)}m left`;
+		return ` · ~${(seconds / 3600).toFixed(1)}h left`;
+	}
+
+	function formatProgress(scan) {
+		const files = scan.files_done.toLocaleString();
+		const rate = Math.round(scan.rate).toLocaleString();
+		const resumed = scan.resumed ? ' (resumed)' : '';
+		return `Scanning drive${resumed}... ${files} files · ${rate}/s${formatEta(scan.eta_seconds)}`;
+	}
+
+	function startIndexingPoll(driveId, drivePath, statusDiv, buttonElement) {
 		// Clear previous timer if any
 		if (pollingTimers[driveId]) {
 			clearInterval(pollingTimers[driveId]);
@@ -65,7 +79,11 @@ document.addEventListener('DOMContentLoaded', () => {
 						return;
 					}
 
-					if (data.is_indexing) {
+					const scan = (data.scans || []).find((s) => s.root === drivePath);
+
+					if (scan && scan.status === 'running') {
+						statusDiv.innerHTML = formatProgress(scan);
+					} else if (data.is_indexing) {
 						statusDiv.innerHTML = 'Scanning drive...';
 					} else {
 						clearInterval(pollingTimers[driveId]);
@@ -1,15 +1,309 @@
+// --- Thumbnail Retry ---
+// A busy server answers 503 (render queue full); retry a few times with
+// backoff before settling on the default thumbnail
+const THUMB_RETRIES = 3;
+
+function retryThumbnail(img) {
+	const attempt = Number(img.dataset.retries || 0);
+	if (attempt >= THUMB_RETRIES) {
+		img.onerror = null;
+		img.src = '/static/default_thumb.png';
+		return;
+	}
+	img.dataset.retries = attempt + 1;
+	setTimeout(() => {
+		// Re-setting src makes the <picture> pick its source again
+		img.src = img.getAttribute('src');
+	}, 1000 * 2 ** attempt);
+}
+
+// --- Placeholders ---
+// Tiles carry a BlurHash (https://blurha.sh) of their media; it is decoded
+// into a tiny canvas and painted as the tile background
+const BLURHASH_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~';
+const PLACEHOLDER_PIXELS = 32;
+
+function decode83(str) {
+	let value = 0;
+	for (const c of str) value = value * 83 + BLURHASH_CHARS.indexOf(c);
+	return value;
+}
+
+function srgbToLinear(value) {
+	const v = value / 255;
+	return v <= 0.04045 ? v / 12.92 : Math.pow((v + 0.055) / 1.055, 2.4);
+}
+
+function linearToSrgb(value) {
+	const v = Math.max(0, Math.min(1, value));
+	return v <= 0.0031308 ? Math.round(v * 12.92 * 255) : Math.round((1.055 * Math.pow(v, 1 / 2.4) - 0.055) * 255);
+}
+
+function signPow(value, exp) {
+	return Math.sign(value) * Math.pow(Math.abs(value), exp);
+}
+
+function decodeBlurhash(hash, width, height) {
+	const sizeFlag = decode83(hash[0]);
+	const numX = (sizeFlag % 9) + 1;
+	const numY = Math.floor(sizeFlag / 9) + 1;
+	if (hash.length !== 4 + 2 * numX * numY) throw new Error('Invalid BlurHash');
+
+	const maxValue = (decode83(hash[1]) + 1) / 166;
+	const colors = [];
+	const dc = decode83(hash.substring(2, 6));
+	colors.push([srgbToLinear(dc >> 16), srgbToLinear((dc >> 8) & 255), srgbToLinear(dc & 255)]);
+	for (let i = 1; i < numX * numY; i++) {
+		const value = decode83(hash.substring(4 + i * 2, 6 + i * 2));
+		colors.push([
+			signPow((Math.floor(value / (19 * 19)) - 9) / 9, 2) * maxValue,
+			signPow(((Math.floor(value / 19) % 19) - 9) / 9, 2) * maxValue,
+			signPow(((value % 19) - 9) / 9, 2) * maxValue,
+		]);
+	}
+
+	const pixels = new Uint8ClampedArray(width * height * 4);
+	for (let y = 0; y < height; y++) {
+		for (let x = 0; x < width; x++) {
+			let r = 0, g = 0, b = 0;
+			for (let j = 0; j < numY; j++) {
+				for (let i = 0; i < numX; i++) {
+					const basis = Math.cos((Math.PI * x * i) / width) * Math.cos((Math.PI * y * j) / height);
+					const color = colors[i + j * numX];
+					r += color[0] * basis;
+					g += color[1] * basis;
+					b += color[2] * basis;
+				}
+			}
+			const offset = 4 * (x + y * width);
+			pixels[offset] = linearToSrgb(r);
+			pixels[offset + 1] = linearToSrgb(g);
+			pixels[offset + 2] = linearToSrgb(b);
+			pixels[offset + 3] = 255;
+		}
+	}
+	return pixels;
+}
+
+function paintPlaceholders(tiles) {
+	const canvas = document.createElement('canvas');
+	canvas.width = canvas.height = PLACEHOLDER_PIXELS;
+	const ctx = canvas.getContext('2d');
+	const image = ctx.createImageData(PLACEHOLDER_PIXELS, PLACEHOLDER_PIXELS);
+
+	tiles.forEach((tile) => {
+		if (!tile.dataset.blurhash) return;
+		try {
+			image.data.set(decodeBlurhash(tile.dataset.blurhash, PLACEHOLDER_PIXELS, PLACEHOLDER_PIXELS));
+			ctx.putImageData(image, 0, 0);
+			tile.style.backgroundImage = `url(${canvas.toDataURL()})`;
+		} catch (err) {
+			// The average color stays as the placeholder
+		}
+	});
+}
+
+// --- Batched Thumbnails ---
+// Tiles whose thumbnails the server has cached carry real src/srcset (the
+// browser's cached copies are reused); the others (data-batch) are fetched in
+// one request that renders them. The response is a stream of frames:
+// u32 header length, JSON header, u32 body length, body
+const BATCH_FORMAT = 'webp';
+
+// Fall back to the tile's own <picture> URLs (one request per tile)
+function loadTileIndividually(tile) {
+	tile.querySelectorAll('source[data-srcset]').forEach((source) => {
+		source.srcset = source.dataset.srcset;
+	});
+	const img = tile.querySelector('img[data-src]');
+	if (img && !img.getAttribute('src')) {
+		img.src = img.dataset.src;
+	}
+}
+
+function showBatchThumbnail(tile, blob) {
+	const img = tile.querySelector('img');
+	const url = URL.createObjectURL(blob);
+	// The blob replaces every source of the <picture>
+	tile.querySelectorAll('source').forEach((source) => source.remove());
+	img.addEventListener('load', () => URL.revokeObjectURL(url), { once: true });
+	img.src = url;
+}
+
+async function loadBatchThumbnails(gallery, tiles) {
+	if (!tiles.length) return;
+	const pending = new Set(tiles);
+
+	try {
+		const response = await fetch(gallery.dataset.batchUrl, {
+			method: 'POST',
+			headers: { 'Content-Type': 'application/json' },
+			body: JSON.stringify({ paths: tiles.map((tile) => tile.dataset.path), fmt: BATCH_FORMAT }),
+		});
+		if (!response.ok || !response.body) throw new Error(`HTTP ${response.status}`);
+
+		const reader = response.body.getReader();
+		let buffer = new Uint8Array(0);
+		const decoder = new TextDecoder();
+
+		while (true) {
+			const { done, value } = await reader.read();
+			if (done) break;
+
+			const merged = new Uint8Array(buffer.length + value.length);
+			merged.set(buffer);
+			merged.set(value, buffer.length);
+			buffer = merged;
+
+			// Consume every complete frame in the buffer
+			while (buffer.length >= 4) {
+				const view = new DataView(buffer.buffer, buffer.byteOffset);
+				const headerLength = view.getUint32(0);
+				if (buffer.length < 8 + headerLength) break;
+				const bodyLength = view.getUint32(4 + headerLength);
+				const frameLength = 8 + headerLength + bodyLength;
+				if (buffer.length < frameLength) break;
+
+				const header = JSON.parse(decoder.decode(buffer.subarray(4, 4 + headerLength)));
+				const tile = tiles[header.i];
+				if (tile && header.status === 'ok') {
+					const body = buffer.slice(8 + headerLength, frameLength);
+					showBatchThumbnail(tile, new Blob([body], { type: header.type }));
+					pending.delete(tile);
+				}
+				buffer = buffer.slice(frameLength);
+			}
+		}
+	} catch (err) {
+		console.log('Batch thumbnails failed, loading tiles individually:', err);
+	}
+
+	// Busy / failed / missing items (or a failed batch) load per tile
+	pending.forEach(loadTileIndividually);
+}
+
+// --- Infinite Scroll ---
+// A grid with data-next-url appends the following rows from the browse API
+// when the sentinel below it comes near the viewport; only new rows are
+// transferred, as HTML rendered from the same template partials as the page
+const SCROLL_MARGIN = '800px 0px';
+
+function setupInfiniteScroll(grid, onAppend) {
+	const sentinel = grid.nextElementSibling;
+	if (!grid.dataset.nextUrl || !sentinel || !('IntersectionObserver' in window)) return;
+	const pager = document.querySelector('.pagination-container nav.pager');
+	const shownEnd = document.querySelector('.pagination-end');
+	if (pager) pager.hidden = true;
+	let loading = false;
+
+	const observer = new IntersectionObserver(async (entries) => {
+		if (loading || !entries.some((entry) => entry.isIntersecting)) return;
+		loading = true;
+		try {
+			const response = await fetch(grid.dataset.nextUrl);
+			if (!response.ok) throw new Error(`HTTP ${response.status}`);
+			const page = await response.json();
+
+			const fragment = document.createElement('template');
+			fragment.innerHTML = page.html;
+			const added = Array.from(fragment.content.children);
+			grid.append(fragment.content);
+			if (shownEnd) shownEnd.textContent = Number(shownEnd.textContent) + page.count;
+			onAppend(added);
+
+			if (page.next_url) {
+				grid.dataset.nextUrl = page.next_url;
+				// Observe again: fires at once if the sentinel is still in view
+				observer.unobserve(sentinel);
+				observer.observe(sentinel);
+			} else {
+				delete grid.dataset.nextUrl;
+				observer.disconnect();
+			}
+		} catch (err) {
+			console.log('Loading more items failed, back to pages:', err);
+			observer.disconnect();
+			if (pager) pager.hidden = false;
+		} finally {
+			loading = false;
+		}
+	}, { rootMargin: SCROLL_MARGIN });
+	observer.observe(sentinel);
+}
+
+// --- HLS Playback ---
+// Non-web videos (.mkv, .avi, ...) stream as HLS. Safari and most mobile
+// browsers play it natively; elsewhere hls.js is used if it is installed at
+// static/js/lib/hls.min.js, else the original file is tried directly
+const HLS_LIB_URL = '/static/js/lib/hls.min.js';
+let hlsLibrary = null;
+let hlsPlayer = null;
+
+function loadHlsLibrary() {
+	if (!hlsLibrary) {
+		hlsLibrary = new Promise((resolve) => {
+			if (window.Hls) return resolve(window.Hls);
+			const script = document.createElement('script');
+			script.src = HLS_LIB_URL;
+			script.onload = () => resolve(window.Hls || null);
+			script.onerror = () => resolve(null);
+			document.head.appendChild(script);
+		});
+	}
+	return hlsLibrary;
+}
+
+async function playVideo(videoEl, src, hlsSrc) {
+	if (hlsSrc && videoEl.canPlayType('application/vnd.apple.mpegurl')) {
+		videoEl.src = hlsSrc;
+	} else if (hlsSrc) {
+		const Hls = await loadHlsLibrary();
+		if (Hls && Hls.isSupported()) {
+			hlsPlayer = new Hls();
+			hlsPlayer.loadSource(hlsSrc);
+			hlsPlayer.attachMedia(videoEl);
+		} else {
+			videoEl.src = src;
+		}
+	} else {
+		videoEl.src = src;
+	}
+	videoEl.play().catch((err) => console.log('Auto-play prevented:', err));
+}
+
+function stopHls() {
+	if (hlsPlayer) {
+		hlsPlayer.destroy();
+		hlsPlayer = null;
+	}
+}
+
 document.addEventListener('DOMContentLoaded', () => {
+	const gallery = document.querySelector('.gallery-view[data-batch-url]');
+	if (gallery) {
+		const tiles = Array.from(gallery.querySelectorAll('.img-container[data-path]'));
+		const unrendered = (list) => list.filter((tile) => 'batch' in tile.dataset);
+		paintPlaceholders(tiles);
+		loadBatchThumbnails(gallery, unrendered(tiles));
+		setupInfiniteScroll(gallery, (nodes) => {
+			const added = nodes.map((node) => node.querySelector('.img-container')).filter(Boolean);
+			paintPlaceholders(added);
+			loadBatchThumbnails(gallery, unrendered(added));
+		});
+	}
+
+	const fileGrid = document.querySelector('.file-grid');
+	if (fileGrid) {
+		setupInfiniteScroll(fileGrid, () => {});
+	}
+
 	// --- Preview Element Selectors ---
 	const preview = document.getElementById('media-preview');
 	const previewImg = document.getElementById('media-preview-img');
 	const previewVideo = document.getElementById('media-preview-video');
+	const previewDownload = document.getElementById('media-preview-download');
 	const closeBtn = document.querySelector('.media-preview-close');
 
-	// --- Assets Selectors ---
-	const clickableImages = document.querySelectorAll('.clickable-image');
-	const clickableVideos = document.querySelectorAll('.clickable-video');
-	const videosToLoad = document.querySelectorAll('.video-needs-loading');
-
 	// --- Close Preview ---
 	const closePreview = () => {
 		preview.classList.add('hidden');
@@ -19,46 +313,51 @@ document.addEventListener('DOMContentLoaded', () => {
 		previewImg.style.display = 'none';
 
 		// Clear Video (Stop playback)
+		stopHls();
 		previewVideo.pause();
 		previewVideo.src = '';
 		previewVideo.style.display = 'none';
 	};
 
-	// ---  IMAGE Preview Logic ---
-	clickableImages.forEach((img) => {
-		img.addEventListener('click', (e) => {
+	// Delegated, so tiles appended by infinite scroll open too
+	document.addEventListener('click', (e) => {
+		const img = e.target.closest('.clickable-image');
+		const video = img ? null : e.target.closest('.clickable-video');
+
+		// ---  IMAGE Preview Logic ---
+		if (img) {
 			// Prevent default just in case it's inside a link
 			e.preventDefault();
 			const fullSrc = img.dataset.full;
 
-			// UI Updates
+			// UI Updates: the display rendition; the original only via the download link
 			previewImg.src = fullSrc;
+			previewDownload.href = img.dataset.download;
 			previewImg.style.display = 'block';
 			previewVideo.style.display = 'none';
 
 			console.log('Showing image preview for:', fullSrc);
 			preview.classList.remove('hidden');
-		});
-	});
+		}
 
-	// --- VIDEO Preview Logic ---
-	clickableVideos.forEach((video) => {
-		video.addEventListener('click', (e) => {
-			e.preventDefault(); // Prevent the thumbnail from playing inline
+		// --- VIDEO Preview Logic ---
+		// Grid tiles are poster images; the video is only streamed once opened
+		if (video) {
+			e.preventDefault();
 
-			// Get URL from data-full, fallback to current src if missing
-			const fullSrc = video.dataset.full || video.currentSrc;
+			const fullSrc = video.dataset.full;
 
 			// UI Updates
-			previewVideo.src = fullSrc;
+			previewDownload.href = video.dataset.download;
 			previewVideo.style.display = 'block';
 			previewImg.style.display = 'none';
 
 			preview.classList.remove('hidden');
 
-			// Auto-play the modal video
-			previewVideo.play().catch((err) => console.log('Auto-play prevented:', err));
-		});
+			// Auto-play the modal video (HLS for non-web formats)
+			stopHls();
+			playVideo(previewVideo, fullSrc, video.dataset.hls);
+		}
 	});
 
 	closeBtn.addEventListener('click', closePreview);
@@ -69,23 +368,4 @@ document.addEventListener('DOMContentLoaded', () => {
 		}
 	});
 
-	// --- Thumbnail Loading Logic (Helps load videos on mobile) ---
-	videosToLoad.forEach((video) => {
-		// Check if the video is ready to draw a frame
-		if (video.readyState >= 1) return;
-
-		// Helps load the video on mobile devices
-		video.load();
-
-		// Safety check: attempt to seek to 0 after loading metadata
-		video.addEventListener(
-			'loadedmetadata',
-			() => {
-				if (video.currentTime !== 0) {
-					video.currentTime = 0;
-				}
-			},
-			{ once: true }
-		);
-	});
 });
@@ -1,14 +1,25 @@
 import os
 import re
+import json
+import base64
+import heapq
 import platform
 import ctypes
+import plistlib
+import logging
+import subprocess
 from datetime import datetime
 import psutil
 from helpers import get_file_index_db
+from disk_cache import media_version
+
+logger = logging.getLogger(__name__)
 
 # Shared constants
 PHOTO_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".heic", ".webp"}
 VIDEO_EXTENSIONS = {".mp4", ".mkv", ".mov", ".avi", ".webm", ".flv", ".m4v"}
+# Containers browsers play directly; other videos are streamed as HLS (video_stream.py)
+WEB_VIDEO_EXTENSIONS = {".mp4", ".mov", ".webm", ".m4v"}
 
 SKIP_PREFIXES = {".", "._"}
 SKIP_NAMES = {"Thumbs.db", "desktop.ini", ".DS_Store"}
@@ -58,14 +69,102 @@ def is_hidden_folder(path):
     # Standard Unix-like check (Linux, macOS): starts with '.'
     return os.path.basename(path).startswith('.')
 
+# --- Drive Identity ---
+def find_mountpoint(path):
+    """Returns the mountpoint (drive root) that contains `path`."""
+    path = os.path.normpath(path)
+    best = None
+    for part in psutil.disk_partitions(all=True):
+        mount = part.mountpoint
+        if not mount:
+            continue
+        prefix = mount if mount.endswith(os.path.sep) else mount + os.path.sep
+        if path == mount or path.startswith(prefix):
+            if best is None or len(mount) > len(best.mountpoint):
+                best = part
+    return best
+
+
+# Lookups by mountpoint -> (device, st_dev, uuid). A lookup can start a
+# subprocess (diskutil), so it is only redone once something else is mounted there
+_volume_uuids = {}
+
+
+def _mount_identity(mountpoint, device):
+    try:
+        return device, os.stat(mountpoint).st_dev
+    except OSError:
+        return None
+
+
+def get_volume_uuid(mountpoint, device=None):
+    """
+    Returns a stable identifier for the filesystem mounted at `mountpoint`
+    (filesystem UUID on Linux/macOS, volume serial on Windows), or None.
+    Cached per mountpoint while the same device stays mounted there.
+    """
+    identity = _mount_identity(mountpoint, device)
+    cached = _volume_uuids.get(mountpoint)
+    if identity is not None and cached is not None and cached[:2] == identity:
+        return cached[2]
+    uuid = _lookup_volume_uuid(mountpoint, device)
+    if identity is not None:
+        _volume_uuids[mountpoint] = (*identity, uuid)
+    return uuid
+
+
+def forget_volume_uuids(mountpoints):
+    """Drops cached UUIDs of mountpoints other than `mountpoints` (unplugged drives)."""
+    for mountpoint in set(_volume_uuids) - set(mountpoints):
+        _volume_uuids.pop(mountpoint, None)
+
+
+def _lookup_volume_uuid(mountpoint, device=None):
+    system = platform.system()
+    try:
+        if system == "Linux":
+            if device is None:
+                part = find_mountpoint(mountpoint)
+                device = part.device if part else None
+            if not device or not device.startswith("/dev/"):
+                return None
+            real_device = os.path.realpath(device)
+            for by_dir in ("/dev/disk/by-uuid", "/dev/disk/by-partuuid"):
+                if not os.path.isdir(by_dir):
+                    continue
+                for name in os.listdir(by_dir):
+                    if os.path.realpath(os.path.join(by_dir, name)) == real_device:
+                        return name
+        elif system == "Darwin":
+            out = subprocess.run(
+                ["diskutil", "info", "-plist", mountpoint],
+                capture_output=True, timeout=5, check=True
+            )
+            info = plistlib.loads(out.stdout)
+            return info.get("VolumeUUID") or info.get("DiskUUID")
+        elif system == "Windows":
+            serial = ctypes.c_uint32()
+            ok = ctypes.windll.kernel32.GetVolumeInformationW(
+                ctypes.c_wchar_p(mountpoint), None, 0, ctypes.byref(serial), None, None, None, 0
+            )
+            if ok:
+                return f"{serial.value:08X}"
+    except Exception as e:
+        logger.warning(f"[DRIVE] UUID lookup failed for {mountpoint}: {e}")
+    return None
+
+
 # --- Drive and Space Functions ---
 def get_flash_drives():
     """
     Retrieves information about mounted external removable drives.
     """
     drives = []
+    partitions = psutil.disk_partitions(all=False)
+    # A drive unplugged since the last call must be looked up again when it (or another) shows up
+    forget_volume_uuids(part.mountpoint for part in partitions)
     
-    for part in psutil.disk_partitions(all=False):
+    for part in partitions:
         if not part.device or not part.mountpoint:
             continue
         
@@ -96,6 +195,7 @@ def get_flash_drives():
                 drives.append({
                     "name": name,
                     "path": part.mountpoint,
+                    "uuid": get_volume_uuid(part.mountpoint, part.device),
                     "size_gb": total_gb,
                     "used_percent": used_percent,
                 })
@@ -107,30 +207,265 @@ def get_flash_drives():
     return drives
 
 # --- Directory Listing Function ---
-def list_directory_contents(path, offset=0, limit=40, view_mode="files", url_for_func=None, get_thumb_hash_func=None):
+# --- Keyset Pagination ---
+# Pages continue from the sort key of the last row shown instead of skipping
+# OFFSET rows, so a deep page costs the same as the first. Each view orders
+# by a unique (column, id) key: (order column, descending)
+SORT_KEYS = {
+    "files": ("name", False),
+    "gallery": ("sort_time", True),
+}
+
+
+def encode_cursor(row_key):
+    """Opaque URL-safe cursor for a (sort value, id) key."""
+    return base64.urlsafe_b64encode(json.dumps(list(row_key)).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(sort value, id) of a cursor, or None if it is malformed."""
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return value, int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def count_directory(db, parent_path):
+    """
+    {"folders", "files", "media"} of a folder: one folder_stats row, or one
+    grouped (index-only) query for folders that have no stats yet.
+    """
+    row = db.execute("SELECT folders, files, media FROM folder_stats WHERE path = ?", (parent_path,)).fetchone()
+    if row is not None:
+        return {"folders": row[0], "files": row[1], "media": row[2]}
+    counts = {"folders": 0, "files": 0, "media": 0}
+    for is_folder, is_media, count in db.execute(
+        "SELECT is_folder, is_media, COUNT(*) FROM file_index WHERE parent_path = ? GROUP BY is_folder, is_media",
+        (parent_path,)
+    ):
+        counts["folders" if is_folder else "media" if is_media else "files"] += count
+    return counts
+
+
+def folder_usage(db, path, limit=None):
+    """
+    Disk usage of a folder from folder_stats: its own totals plus one entry per
+    subfolder (largest first), or None if the folder has no stats.
+    """
+    columns = "path, files, media, bytes, latest_mtime, total_folders, total_files, total_media, total_bytes, " \
+              "total_latest_mtime"
+    row = db.execute(f"SELECT {columns} FROM folder_stats WHERE path = ?", (path,)).fetchone()
+    if row is None:
+        return None
+    children = db.execute(
+        f"SELECT {columns} FROM folder_stats WHERE parent_path = ? AND path != parent_path "
+        f"ORDER BY total_bytes DESC LIMIT ?",
+        (path, -1 if limit is None else limit)
+    ).fetchall()
+
+    def usage(r):
+        return {
+            "path": r["path"],
+            "name": os.path.basename(r["path"]) or r["path"],
+            "folders": r["total_folders"],
+            "files": r["total_files"],
+            "media": r["total_media"],
+            "bytes": r["total_bytes"],
+            "latest_mtime": r["total_latest_mtime"],
+        }
+
+    result = usage(row)
+    result["own"] = {"files": row["files"], "media": row["media"], "bytes": row["bytes"],
+                     "latest_mtime": row["latest_mtime"]}
+    result["children"] = [usage(r) for r in children]
+    return result
+
+
+def _page_rows(db, columns, where, params, view_mode, limit, offset=0, after=None, before=None, last=False, total=0):
+    """
+    One page of rows in the view's order plus (previous, next) cursors.
+    `after` / `before` are decoded cursors; `last` fetches the final page;
+    with none of them the page starts at `offset` (old page=N links).
+    """
+    column, descending = SORT_KEYS[view_mode]
+    order = "DESC" if descending else "ASC"
+    reverse = "ASC" if descending else "DESC"
+    forward_op, backward_op = ("<", ">") if descending else (">", "<")
+    key = f"({column}, id)"
+
+    if before is not None:
+        rows = db.execute(
+            f"SELECT {columns}, {column}, id FROM file_index WHERE {where} AND {key} {backward_op} (?, ?) "
+            f"ORDER BY {column} {reverse}, id {reverse} LIMIT ?",
+            (*params, *before, limit + 1)
+        ).fetchall()
+        has_prev, has_next = len(rows) > limit, True
+        rows = rows[:limit][::-1]
+    elif last:
+        size = (total - 1) % limit + 1 if total else limit
+        rows = db.execute(
+            f"SELECT {columns}, {column}, id FROM file_index WHERE {where} "
+            f"ORDER BY {column} {reverse}, id {reverse} LIMIT ?",
+            (*params, size)
+        ).fetchall()[::-1]
+        has_prev, has_next = total > size, False
+    else:
+        if after is not None:
+            where += f" AND {key} {forward_op} (?, ?)"
+            params = (*params, *after)
+        rows = db.execute(
+            f"SELECT {columns}, {column}, id FROM file_index WHERE {where} "
+            f"ORDER BY {column} {order}, id {order} LIMIT ? OFFSET ?",
+            (*params, limit + 1, 0 if after is not None else offset)
+        ).fetchall()
+        has_prev, has_next = after is not None or offset > 0, len(rows) > limit
+        rows = rows[:limit]
+
+    # Rows end with their sort key: (..., sort value, id)
+    prev_cursor = encode_cursor(rows[0][-2:]) if rows and has_prev else None
+    next_cursor = encode_cursor(rows[-1][-2:]) if rows and has_next else None
+    return rows, prev_cursor, next_cursor
+
+
+def index_parent_path(path):
+    """A browse path as stored in parent_path (a bare drive letter becomes its root)."""
+    parent_path = os.path.normpath(path)
+    if not os.path.splitdrive(parent_path)[1]:
+        parent_path = os.path.splitdrive(parent_path)[0] + '\\'
+    return parent_path
+
+
+# Row columns item dicts are built from (see _item_data)
+ITEM_COLUMNS = (
+    "name, path, type, size, modified_time, created_time, is_media, placeholder, avg_color, "
+    "width, height, duration"
+)
+
+
+def _item_data(row, url_for_func):
+    """Template / API dict of a file row selected with ITEM_COLUMNS first."""
+    from video_stream import needs_hls
+
+    (name, file_path, file_type, size, modified_time, created_time, is_media, placeholder, avg_color,
+     width, height, duration) = row[:12]
+
+    file_data = {
+        "name": name,
+        "path": file_path,
+        "type": file_type,
+        "size": size,
+        "modified_time": modified_time,
+        "modified": datetime.fromtimestamp(modified_time) if modified_time else None,
+        "created": datetime.fromtimestamp(created_time) if created_time else None,
+        "thumbnail_url": None,
+        "full_imgproxy_url": None,
+        "vid_stream_url": None,
+        "hls_url": None,
+        "icon_class": get_icon_class(name),
+        # Media URLs carrying the current version are cached as immutable
+        "version": media_version(modified_time, size),
+        # Painted by the gallery until the thumbnail arrives (enrichment.py)
+        "placeholder": placeholder,
+        "avg_color": avg_color,
+        # Header metadata (enrichment.py), None until enriched
+        "width": width,
+        "height": height,
+        "duration": duration
+    }
+
+    if is_media:
+        if file_type.lower() in VIDEO_EXTENSIONS:
+            file_data["vid_stream_url"] = url_for_func("media.serve_media", path=file_path)
+            if needs_hls(file_path, size):
+                file_data["hls_url"] = url_for_func("media.hls_playlist", path=file_path)
+        else:
+            file_data["full_image_url"] = url_for_func("media.serve_media", path=file_path)
+    return file_data
+
+
+def directory_page(db, parent_path, view_mode, limit, url_for_func, offset=0, after=None, before=None,
+                   last=False, total=0):
+    """
+    One page of a folder's files ("files" view, media included) or media
+    ("gallery" view) as item dicts, plus (previous, next) cursors.
+    `after` / `before` are decoded cursors (see _page_rows).
+    """
+    media_clause = "is_media = 1" if view_mode == "gallery" else "1 = 1"
+    rows, prev_cursor, next_cursor = _page_rows(
+        db,
+        ITEM_COLUMNS,
+        f"is_folder = 0 AND {media_clause} AND parent_path = ?",
+        (parent_path,),
+        view_mode, limit,
+        offset=offset,
+        after=after,
+        before=before,
+        last=last,
+        total=total,
+    )
+    return [_item_data(row, url_for_func) for row in rows], prev_cursor, next_cursor
+
+
+def timeline_page(db, url_for_func, online, drive=None, limit=80, after=None):
+    """
+    One page of the media timeline, newest first (sort_time DESC, id DESC),
+    of drive `drive` (UUID) or of every drive in `online` (UUIDs of plugged-in
+    drives, see drive_registry.online_drives), plus the next cursor.
+    Each drive is read by a keyset seek on idx_timeline and drives are merged
+    here, so a page costs the same however deep it is. `after` is a decoded
+    cursor. Items carry a "month" label to group by.
+    """
+    if drive:
+        drives = [drive] if drive in online else []
+    else:
+        # Rows indexed without a drive identity (drive_uuid NULL) form their own group
+        drives = [*online, None]
+
+    keyset = "AND (sort_time, id) < (?, ?)" if after else ""
+    streams = []
+    for uuid in drives:
+        streams.append(db.execute(
+            f"""
+            SELECT {ITEM_COLUMNS}, sort_time, id FROM file_index
+            WHERE drive_uuid IS ? AND is_media = 1 AND sort_time IS NOT NULL {keyset}
+            ORDER BY sort_time DESC, id DESC
+            LIMIT ?
+            """,
+            (uuid, *(after or ()), limit + 1)
+        ).fetchall())
+
+    rows = list(heapq.merge(*streams, key=lambda r: (r[-2], r[-1]), reverse=True))[:limit + 1]
+    next_cursor = encode_cursor(rows[limit - 1][-2:]) if len(rows) > limit else None
+
+    items = []
+    for row in rows[:limit]:
+        item = _item_data(row, url_for_func)
+        item["month"] = datetime.fromtimestamp(row[-2]).strftime("%B %Y")
+        items.append(item)
+    return items, next_cursor
+
+
+def list_directory_contents(path, offset=0, limit=40, view_mode="files", url_for_func=None, get_thumb_hash_func=None,
+                            after=None, before=None, last=False):
     """
     List contents of a directory from the file index database with pagination.
+    Pages are addressed by keyset cursors (`after` / `before`, see
+    encode_cursor) or `last`; `offset` is only used without them.
+    The last element returned is {"prev": cursor, "next": cursor}.
     """
     if not url_for_func or not get_thumb_hash_func:
         raise ValueError("url_for_func and get_thumb_hash_func must be provided.")
 
-    parent_path_value = os.path.normpath(path)
-
-    if not os.path.splitdrive(parent_path_value)[1]:
-        parent_path_value = os.path.splitdrive(parent_path_value)[0] + '\\'
+    parent_path_value = index_parent_path(path)
 
     db = get_file_index_db()
+    cursors = {"prev": None, "next": None}
 
     try:
-        total_media_asset_count = db.execute(
-            "SELECT COUNT(*) FROM file_index WHERE is_folder = 0 AND is_media = 1 AND parent_path = ?",
-            (parent_path_value,)
-        ).fetchone()[0]
-
-        total_file_count = db.execute(
-            "SELECT COUNT(*) FROM file_index WHERE is_folder = 0 AND is_media = 0 AND parent_path = ?",
-            (parent_path_value,)
-        ).fetchone()[0]
+        counts = count_directory(db, parent_path_value)
+        total_media_asset_count = counts["media"]
+        total_file_count = counts["files"]
 
         folders = db.execute(
             "SELECT name, path FROM file_index WHERE parent_path = ? AND is_folder = 1 ORDER BY name ASC",
@@ -139,65 +474,27 @@ def list_directory_contents(path, offset=0, limit=40, view_mode="files", url_for
         formatted_folders = [{"name": r[0], "path": r[1], "type": "folder"} for r in folders]
 
         if view_mode == "files":
-            media_clause = "1 = 1"
+            total_listed = total_file_count + total_media_asset_count
         elif view_mode == "gallery":
-            media_clause = "is_media = 1"
+            total_listed = total_media_asset_count
         else:
-            return formatted_folders, [], total_file_count, [], total_media_asset_count
-        
-        # Sort setup
-        if view_mode == "files":
-            sort_clause = "name ASC"
-        elif view_mode == "gallery":
-            sort_clause = "created_time DESC"
+            return formatted_folders, [], total_file_count, [], total_media_asset_count, cursors
+
+        items, cursors["prev"], cursors["next"] = directory_page(
+            db, parent_path_value, view_mode, limit, url_for_func,
+            offset=offset,
+            after=decode_cursor(after) if after else None,
+            before=decode_cursor(before) if before else None,
+            last=last,
+            total=total_listed,
+        )
 
-        items = db.execute(
-            f"""
-            SELECT name, path, type, size, modified_time, created_time, is_media
-            FROM file_index
-            WHERE is_folder = 0 AND {media_clause} AND parent_path = ?
-            ORDER BY {sort_clause}
-            LIMIT ? OFFSET ?
-            """,
-            (parent_path_value, limit, offset)
-        ).fetchall()
-        
-        paginated_files = []
-        paginated_media = []
-
-        for name, file_path, file_type, size, modified_time, created_time, is_media in items:
-
-            file_data = {
-                "name": name,
-                "path": file_path,
-                "type": file_type,
-                "size": size,
-                "modified": datetime.fromtimestamp(modified_time) if modified_time else None,
-                "created": datetime.fromtimestamp(created_time) if created_time else None,
-                "thumbnail_url": None,
-                "full_imgproxy_url": None,
-                "vid_stream_url": None,
-                "icon_class": get_icon_class(name)
-            }
-
-            if is_media:
-                if file_type.lower() in [".mp4", ".mov", ".webm"]:
-                    file_data["vid_stream_url"] = url_for_func("media.serve_media", path=file_path)
-                else:
-                    file_data["full_image_url"] = url_for_func("media.serve_media", path=file_path)
-                       
-                if view_mode == "gallery":
-                    paginated_media.append(file_data)
-                else:
-                    paginated_files.append(file_data)
-            else:
-                paginated_files.append(file_data)
         total_items = total_file_count + total_media_asset_count
         if view_mode == "files":
-            return formatted_folders, paginated_files, total_items, [], total_media_asset_count
+            return formatted_folders, items, total_items, [], total_media_asset_count, cursors
         else:
-            return formatted_folders, [], total_items, paginated_media, total_media_asset_count
+            return formatted_folders, [], total_items, items, total_media_asset_count, cursors
 
     except Exception as e:
         print(f"[DB BROWSE ERROR] Failed to query path {path}: {e}")
-        return [], [], 0, [], 0
\ No newline at end of file
+        return [], [], 0, [], 0, {"prev": None, "next": None}
@@ -0,0 +1,164 @@
+# video_stream.py
+#
+# HLS for videos browsers can't play directly (.mkv, .avi, .flv, ...). The
+# playlist splits a video into fixed HLS_SEGMENT_SECONDS segments; a segment
+# is transcoded by ffmpeg when first requested (accurate seek to its start,
+# H.264/AAC in MPEG-TS, so every segment stands alone) and kept in a
+# size-bounded cache. Seeking only costs the segments around the new position.
+
+import os
+import math
+import logging
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from disk_cache import segment_cache, cache_key
+from media_render import _run_ffmpeg, _video_duration, RenderBusy
+from singleflight import SingleFlight
+from storage_utils import WEB_VIDEO_EXTENSIONS, VIDEO_EXTENSIONS
+from config import (
+    FFMPEG_BIN, HLS_SEGMENT_SECONDS, HLS_WORKERS, HLS_PREFETCH, HLS_MAX_HEIGHT, HLS_MIN_MB,
+)
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_MIMETYPE = "video/mp2t"
+PLAYLIST_MIMETYPE = "application/vnd.apple.mpegurl"
+SEGMENT_TIMEOUT = 300    # seconds per ffmpeg run
+SLOT_WAIT = 30           # seconds a playback request waits for a free ffmpeg slot
+
+# Bounded ffmpeg concurrency shared by playback and prefetch
+_slots = threading.BoundedSemaphore(HLS_WORKERS)
+_prefetch_pool = ThreadPoolExecutor(max_workers=HLS_WORKERS, thread_name_prefix="hls-prefetch")
+segment_flight = SingleFlight("HLS", wait_timeout=SEGMENT_TIMEOUT)
+
+DURATION_CACHE_SIZE = 1024
+
+_durations = OrderedDict()  # (path, mtime, size) -> seconds, least recently used first
+_durations_lock = threading.Lock()
+
+
+def needs_hls(path, size=None):
+    """Whether a video is streamed as HLS instead of as its original file."""
+    if not FFMPEG_BIN:
+        return False
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in VIDEO_EXTENSIONS:
+        return False
+    if ext not in WEB_VIDEO_EXTENSIONS:
+        return True
+    return bool(HLS_MIN_MB and size and size >= HLS_MIN_MB * 1024 * 1024)
+
+
+def video_duration(path, modified_time, size):
+    """
+    Duration in seconds (probed once per file version) or None. Failed probes
+    are not cached, so a transient ffprobe error is retried on the next request.
+    """
+    identity = (path, modified_time, size)
+    with _durations_lock:
+        if identity in _durations:
+            _durations.move_to_end(identity)
+            return _durations[identity]
+    duration = _video_duration(path)
+    if duration is None:
+        return None
+    with _durations_lock:
+        _durations[identity] = duration
+        _durations.move_to_end(identity)
+        while len(_durations) > DURATION_CACHE_SIZE:
+            _durations.popitem(last=False)
+    return duration
+
+
+def segment_count(duration):
+    return max(1, math.ceil(duration / HLS_SEGMENT_SECONDS))
+
+
+def playlist(path, version, duration):
+    """VOD playlist; segment URIs are relative to the playlist URL."""
+    query = urllib.parse.urlencode({"path": path, "v": version})
+    count = segment_count(duration)
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{HLS_SEGMENT_SECONDS}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for index in range(count):
+        length = min(HLS_SEGMENT_SECONDS, duration - index * HLS_SEGMENT_SECONDS)
+        lines.append(f"#EXTINF:{length:.3f},")
+        lines.append(f"{index}.ts?{query}")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def segment_key(path, modified_time, size, index):
+    return cache_key(
+        os.path.normpath(path), modified_time, size, "hls", index, HLS_SEGMENT_SECONDS, HLS_MAX_HEIGHT
+    )
+
+
+def render_segment(path, index):
+    """Transcodes segment `index` of a video to MPEG-TS bytes."""
+    start = index * HLS_SEGMENT_SECONDS
+    data = _run_ffmpeg([
+        "-ss", str(start), "-i", path, "-t", str(HLS_SEGMENT_SECONDS),
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-pix_fmt", "yuv420p",
+        "-vf", f"scale=-2:'min({HLS_MAX_HEIGHT},ih)'",
+        "-c:a", "aac", "-b:a", "160k", "-ac", "2",
+        # Timestamps continue where the previous segment ends
+        "-output_ts_offset", str(start),
+        "-f", "mpegts", "pipe:1",
+    ], timeout=SEGMENT_TIMEOUT)
+    if not data:
+        raise RuntimeError(f"ffmpeg produced no segment {index} for {path}")
+    return data
+
+
+def _render_cached(path, modified_time, size, index, wait):
+    key = segment_key(path, modified_time, size, index)
+
+    def render():
+        if not _slots.acquire(timeout=wait):
+            raise RenderBusy()
+        try:
+            data = render_segment(path, index)
+        finally:
+            _slots.release()
+        try:
+            segment_cache.put(key, data, SEGMENT_MIMETYPE)
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"[HLS] Could not cache segment {index} of {path}: {e}")
+        return data
+
+    return segment_flight.do(key, render)[0]
+
+
+def _prefetch(path, modified_time, size, index):
+    try:
+        # Never queue behind playback: skip if every ffmpeg slot is busy
+        _render_cached(path, modified_time, size, index, wait=0)
+    except RenderBusy:
+        pass
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"[HLS] Prefetch of segment {index} of {path} failed: {e}")
+
+
+def get_segment(path, modified_time, size, index, count):
+    """
+    Segment bytes (cached or rendered now), queueing the next HLS_PREFETCH
+    segments in the background. Returns (file path, None) for a cache hit or
+    (None, bytes). Raises RenderBusy if no ffmpeg slot frees up in time.
+    """
+    for ahead in range(index + 1, min(index + 1 + HLS_PREFETCH, count)):
+        if segment_cache.get(segment_key(path, modified_time, size, ahead)) is None:
+            _prefetch_pool.submit(_prefetch, path, modified_time, size, ahead)
+
+    cached = segment_cache.get(segment_key(path, modified_time, size, index))
+    if cached:
+        return cached[0], None
+    return None, _render_cached(path, modified_time, size, index, wait=SLOT_WAIT)
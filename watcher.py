@@ -0,0 +1,404 @@
+# watcher.py
+#
+# Keeps file_index current for indexed drives without full rescans.
+# Run alongside Flask and Celery (run_all.py starts it): `python watcher.py`
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from helpers import connect_file_index_db, init_all_dbs
+from indexer import BatchWriter, sync_directory, subtree_bounds
+from drive_registry import drive_for_path
+from locks import DriveLock, LockLostError
+from scan_state import DriveFence
+from scanner import list_directory
+from config import WATCH_DEBOUNCE, WATCH_MAX_DELAY, WATCH_POLL_INTERVAL, WATCH_BATCH_SIZE
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+ROOT_REFRESH_INTERVAL = 30.0  # seconds between checks for newly indexed / unmounted drives
+
+
+# ---------------------------------------------------------
+# Backends
+# ---------------------------------------------------------
+class InotifyBackend:
+    """Linux inotify via ctypes: one watch per indexed folder, events map to dirty folders."""
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                  | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}  # wd -> folder path
+        self.wds = {}    # folder path -> wd
+        self.overflowed = False
+
+    @classmethod
+    def available(cls):
+        return sys.platform.startswith("linux")
+
+    def add(self, path):
+        """Watches one folder. Raises OSError(ENOSPC) when the watch limit is hit."""
+        if path in self.wds:
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            raise OSError(err, os.strerror(err), path)
+        self.paths[wd] = path
+        self.wds[path] = wd
+
+    def remove_tree(self, root_path):
+        low, high = subtree_bounds(root_path)
+        for path in [p for p in self.wds if p == root_path or low < p < high]:
+            wd = self.wds.pop(path)
+            self.paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """Waits up to `timeout` seconds; returns the set of folders that changed."""
+        dirty = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return dirty
+
+        try:
+            buf = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return dirty
+
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(buf, offset)
+            name = os.fsdecode(buf[offset + 16: offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            path = self.paths.get(wd)
+            if path is None:
+                continue
+            if mask & self.IN_IGNORED:
+                # Folder was deleted or unmounted; its parent gets its own event
+                self.paths.pop(wd, None)
+                self.wds.pop(path, None)
+                continue
+            if mask & self.IN_DELETE_SELF:
+                continue
+            if name.startswith('.'):
+                continue
+            dirty.add(path)
+        return dirty
+
+
+class PollingBackend:
+    """
+    Fallback for non-Linux hosts and drives beyond the inotify watch limit:
+    every WATCH_POLL_INTERVAL seconds, folder mtimes on disk are compared with
+    the indexed ones. Only folders are listed, files are not stat'ed, so
+    in-place edits that keep the folder mtime are picked up by the next scan.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.roots = set()
+        self._next_poll = 0.0
+
+    def add_root(self, root_path):
+        self.roots.add(root_path)
+
+    def remove_tree(self, root_path):
+        self.roots.discard(root_path)
+
+    def read(self, timeout):
+        now = time.monotonic()
+        if now < self._next_poll:
+            time.sleep(min(timeout, self._next_poll - now))
+            return set()
+        self._next_poll = now + WATCH_POLL_INTERVAL
+
+        dirty = set()
+        for root_path in list(self.roots):
+            dirty |= self._changed_folders(root_path)
+        return dirty
+
+    def _changed_folders(self, root_path):
+        low, high = subtree_bounds(root_path)
+        indexed = dict(self.db.execute(
+            "SELECT path, modified_time FROM file_index WHERE is_folder = 1 AND (path = ? OR (path > ? AND path < ?))",
+            (root_path, low, high)
+        ).fetchall())
+
+        dirty = set()
+        stack = [root_path]
+        while stack:
+            folder = stack.pop()
+            try:
+                if os.stat(folder).st_mtime != indexed.get(folder):
+                    dirty.add(folder)
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError:
+                continue
+        return dirty
+
+
+# ---------------------------------------------------------
+# Watcher Service
+# ---------------------------------------------------------
+class IndexWatcher:
+    """
+    Coalesces filesystem events into a set of dirty folders and re-syncs them
+    against file_index in small batched transactions (WATCH_BATCH_SIZE rows).
+    A folder is applied once it has been quiet for WATCH_DEBOUNCE seconds, or
+    at the latest WATCH_MAX_DELAY seconds after its first event, so a burst
+    of thousands of copied files turns into a handful of writes.
+    """
+
+    def __init__(self):
+        self.db = connect_file_index_db()
+        self.inotify = InotifyBackend() if InotifyBackend.available() else None
+        self.polling = PollingBackend(self.db)
+        self.roots = set()
+        self.drives = {}  # root -> DriveRef (None for drives without a filesystem UUID)
+        self.dirty = {}  # folder -> (first_seen, last_seen)
+        self._next_root_refresh = 0.0
+        from app import redis_client
+        self.redis = redis_client
+
+    # --- Roots ---
+    def indexed_roots(self):
+        """Drives with a completed (or failed, resumable) scan that are currently mounted."""
+        rows = self.db.execute(
+            "SELECT root_path FROM scan_checkpoints WHERE status IN ('complete', 'interrupted')"
+        ).fetchall()
+        return {r[0] for r in rows if os.path.isdir(r[0])}
+
+    def scanning_roots(self):
+        """
+        Watched drives a scan holds the lease of (locks.py). Without Redis
+        scans run unlocked, so their "running" checkpoints are used instead.
+        """
+        if self.redis is None:
+            rows = self.db.execute(
+                "SELECT root_path FROM scan_checkpoints WHERE status = 'running'"
+            ).fetchall()
+            return {r[0] for r in rows}
+        busy = set()
+        for root_path in self.roots:
+            try:
+                if DriveLock(self.redis, root_path).is_locked():
+                    busy.add(root_path)
+            except Exception as e:  # noqa: BLE001
+                # Redis unreachable: apply changes rather than stall the drive
+                logger.warning(f"[WATCH] Could not check the scan lease of {root_path}: {e}")
+        return busy
+
+    def refresh_roots(self):
+        current = self.indexed_roots()
+        for root_path in self.roots - current:
+            logger.info(f"[WATCH] Stopped watching {root_path}")
+            self.polling.remove_tree(root_path)
+            if self.inotify:
+                self.inotify.remove_tree(root_path)
+            self.drives.pop(root_path, None)
+        for root_path in current - self.roots:
+            self.watch_root(root_path)
+        self.roots = current
+
+    def watch_root(self, root_path):
+        self.drives[root_path] = drive_for_path(self.db, root_path)
+        if not self.inotify:
+            logger.info(f"[WATCH] Polling {root_path} every {WATCH_POLL_INTERVAL:.0f}s")
+            self.polling.add_root(root_path)
+            return
+
+        low, high = subtree_bounds(root_path)
+        folders = [r[0] for r in self.db.execute(
+            "SELECT path FROM file_index WHERE is_folder = 1 AND (path = ? OR (path > ? AND path < ?))",
+            (root_path, low, high)
+        )]
+        try:
+            for folder in folders:
+                self.inotify.add(folder)
+            logger.info(f"[WATCH] inotify on {root_path} ({len(folders)} folders)")
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            logger.warning(
+                f"[WATCH] inotify watch limit reached for {root_path}; falling back to polling "
+                f"(raise fs.inotify.max_user_watches to avoid this)."
+            )
+            self.inotify.remove_tree(root_path)
+            self.polling.add_root(root_path)
+
+    def _root_of(self, path):
+        """The innermost watched root containing `path` (roots can be nested)."""
+        best = None
+        for root_path in self.roots:
+            low, high = subtree_bounds(root_path)
+            if (path == root_path or low < path < high) and (best is None or len(root_path) > len(best)):
+                best = root_path
+        return best
+
+    # --- Event Handling ---
+    def collect(self, timeout):
+        now = time.monotonic()
+        changed = self.polling.read(timeout if not self.inotify else 0)
+        if self.inotify:
+            changed |= self.inotify.read(timeout)
+            if self.inotify.overflowed:
+                # Events were dropped: treat every watched folder as dirty
+                logger.warning("[WATCH] inotify queue overflow, re-syncing all watched folders.")
+                self.inotify.overflowed = False
+                changed |= set(self.inotify.wds)
+
+        for folder in changed:
+            first_seen, _ = self.dirty.get(folder, (now, now))
+            self.dirty[folder] = (first_seen, now)
+
+    def due_folders(self):
+        now = time.monotonic()
+        due = [
+            folder for folder, (first_seen, last_seen) in self.dirty.items()
+            if now - last_seen >= WATCH_DEBOUNCE or now - first_seen >= WATCH_MAX_DELAY
+        ]
+        if not due:
+            return []
+        # A scan holding this drive's lease owns its rows until it finishes
+        busy = self.scanning_roots()
+        return sorted(folder for folder in due if self._root_of(folder) not in busy)
+
+    def apply(self, folders):
+        """
+        Re-syncs dirty folders root by root, each under its drive's lease
+        (locks.py) with every batch fenced by its token (DriveFence), so a
+        scan starting meanwhile never writes alongside the watcher. Folders of
+        a drive whose lease is taken stay dirty until the scan is done.
+        """
+        by_root = {}
+        for folder in folders:
+            by_root.setdefault(self._root_of(folder), []).append(folder)
+
+        counts = {"inserted": 0, "updated": 0, "deleted": 0}
+        synced = 0
+        for root_path, root_folders in by_root.items():
+            lock = None
+            if self.redis is not None and root_path is not None:
+                lock = DriveLock(self.redis, root_path)
+                if lock.acquire() is None:
+                    continue
+                lock.start_renewing()
+            try:
+                writer = BatchWriter(
+                    self.db, batch_size=WATCH_BATCH_SIZE, drive=self.drives.get(root_path),
+                    checkpoint=DriveFence(self.db, lock.drive_id, lock.token) if lock else None,
+                )
+                synced += self._sync_folders(writer, root_path, root_folders, lock)
+                for key, value in writer.counts.items():
+                    counts[key] += value
+            except LockLostError as e:
+                logger.warning(f"[WATCH] {e}; leaving {root_path} to the scan.")
+                self.db.rollback()
+                now = time.monotonic()
+                for folder in root_folders:
+                    self.dirty.setdefault(folder, (now, now))
+            finally:
+                if lock:
+                    lock.release()
+
+        if any(counts.values()):
+            logger.info(
+                f"[WATCH] Synced {synced} folders: {counts['inserted']} inserted, "
+                f"{counts['updated']} updated, {counts['deleted']} deleted."
+            )
+
+    def _sync_folders(self, writer, root_path, folders, lock):
+        """Syncs `folders` of one root; newly created sub-folders are synced (and watched) recursively."""
+        queue = list(folders)
+        synced = 0
+
+        while queue:
+            folder = queue.pop()
+            self.dirty.pop(folder, None)
+
+            listing = list_directory(folder)
+            if not listing.ok:
+                # Folder is gone; the event on its parent removes it from the index
+                continue
+
+            if lock:
+                lock.check()
+            new_folders = sync_directory(writer, folder, listing.subdirs, listing.files)
+            try:
+                writer.update_folder(folder, os.path.getmtime(folder))
+            except OSError:
+                pass
+            synced += 1
+
+            for child in new_folders:
+                if os.path.basename(child) in listing.links:
+                    continue
+                queue.append(child)
+                if self.inotify and root_path not in self.polling.roots:
+                    try:
+                        self.inotify.add(child)
+                    except OSError as e:
+                        logger.warning(f"[WATCH] Could not watch {child}: {e}")
+
+        writer.flush()
+        return synced
+
+    def run(self):
+        logger.info("[WATCH] Index watcher started.")
+        while True:
+            now = time.monotonic()
+            if now >= self._next_root_refresh:
+                self.refresh_roots()
+                self._next_root_refresh = now + ROOT_REFRESH_INTERVAL
+
+            self.collect(timeout=WATCH_DEBOUNCE / 2)
+            due = self.due_folders()
+            if due:
+                try:
+                    self.apply(due)
+                except Exception as e:  # noqa: BLE001
+                    logger.error(f"[WATCH ERROR] Failed to apply changes: {e}")
+                    self.db.rollback()
+
+
+if __name__ == "__main__":
+    init_all_dbs()
+    try:
+        IndexWatcher().run()
+    except KeyboardInterrupt:
+        pass